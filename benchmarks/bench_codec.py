@@ -0,0 +1,116 @@
+"""
+Throughput of the XOR autokey codec used by tplink_smartplug, against the
+original byte-at-a-time loops and a table-driven loop, over payload sizes
+from 100 B to 64 KiB.
+
+Run from the project folder with:
+    $ python benchmarks/bench_codec.py
+"""
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from tplink_smartplug import protocol
+
+SIZES = [100, 1024, 4096, 16384, 65536]
+
+# XOR_TABLE[key][byte] == key ^ byte
+XOR_TABLE = [bytes(key ^ byte for byte in range(256)) for key in range(256)]
+
+
+def loop_encrypt(plainbytes):
+    # the original SmartPlug.encrypt loop, without the length prefix
+    key = protocol.KEY
+    buffer = bytearray()
+    for plainbyte in plainbytes:
+        key ^= plainbyte
+        buffer.append(key)
+    return bytes(buffer)
+
+
+def loop_decrypt(cipherbytes):
+    # the original SmartPlug.decrypt loop
+    key = protocol.KEY
+    buffer = []
+    for cipherbyte in cipherbytes:
+        buffer.append(key ^ cipherbyte)
+        key = cipherbyte
+    return bytes(buffer)
+
+
+def table_encrypt(plainbytes):
+    # the table-driven pure-Python fallback, for comparison with bigint
+    key = protocol.KEY
+    buffer = bytearray(len(plainbytes))
+    for i, plainbyte in enumerate(plainbytes):
+        key = buffer[i] = XOR_TABLE[key][plainbyte]
+    return bytes(buffer)
+
+
+def table_decrypt(cipherbytes):
+    key = protocol.KEY
+    buffer = bytearray(len(cipherbytes))
+    for i, cipherbyte in enumerate(cipherbytes):
+        buffer[i] = XOR_TABLE[key][cipherbyte]
+        key = cipherbyte
+    return bytes(buffer)
+
+
+def codecs():
+    """Returns list of (name, encrypt, decrypt) for every available path"""
+    out = [('loop', loop_encrypt, loop_decrypt),
+           ('table', table_encrypt, table_decrypt),
+           ('bigint',
+            lambda b: protocol.xor_encrypt(b, use_numpy=False),
+            lambda b: protocol.xor_decrypt(b, use_numpy=False))]
+    if protocol.numpy is not None:
+        out.append(('numpy',
+                    lambda b: protocol.xor_encrypt(b, use_numpy=True),
+                    lambda b: protocol.xor_decrypt(b, use_numpy=True)))
+    out.append(('default', protocol.xor_encrypt, protocol.xor_decrypt))
+    return out
+
+
+def throughput(func, payload, min_time=0.2):
+    """Returns MB/s for func(payload), timed over at least min_time seconds"""
+    timer = timeit.Timer(lambda: func(payload))
+    number, elapsed = timer.autorange()
+    number = max(number, int(number * min_time / max(elapsed, 1e-9)))
+    elapsed = min(timer.repeat(repeat=3, number=number))
+    return len(payload) * number / elapsed / 1e6
+
+
+def run(sizes=SIZES):
+    """Returns list of result dicts, checking every path against the loops"""
+    results = []
+    for size in sizes:
+        plain = os.urandom(size)
+        cipher = loop_encrypt(plain)
+        for name, encrypt, decrypt in codecs():
+            assert encrypt(plain) == cipher, f'{name} encrypt mismatch'
+            assert decrypt(cipher) == plain, f'{name} decrypt mismatch'
+            results.append({'size': size, 'codec': name,
+                            'encrypt_mb_s': throughput(encrypt, plain),
+                            'decrypt_mb_s': throughput(decrypt, cipher)})
+    return results
+
+
+def main():
+    results = run()
+    base = {r['size']: r for r in results if r['codec'] == 'loop'}
+    print('size'.rjust(8), 'codec'.ljust(8),
+          'enc MB/s'.rjust(10), 'x'.rjust(6),
+          'dec MB/s'.rjust(10), 'x'.rjust(6))
+    for r in results:
+        b = base[r['size']]
+        print(str(r['size']).rjust(8), r['codec'].ljust(8),
+              f"{r['encrypt_mb_s']:10.1f}",
+              f"{r['encrypt_mb_s'] / b['encrypt_mb_s']:6.1f}",
+              f"{r['decrypt_mb_s']:10.1f}",
+              f"{r['decrypt_mb_s'] / b['decrypt_mb_s']:6.1f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,350 @@
+"""
+Offline benchmarks of the plug client and the control loop, written as
+json so results from two versions can be compared.
+
+Micro-benchmarks time SmartPlug.encrypt/decrypt over payload sizes, the
+json packing and unpacking around SmartPlug.command, and panel xml
+parsing.  Macro-benchmarks time SmartPlug.command round trips against a
+plug stand-in on loopback, and whole main() loops against that plug and a
+panel stand-in served over http on loopback.
+
+Run from the project folder with:
+    $ python benchmarks/bench_suite.py --json results.json
+    $ python benchmarks/bench_suite.py --compare results.json
+
+Every result is in microseconds per operation, lower is better.
+"""
+import argparse
+import contextlib
+import io
+import json
+import logging
+import os
+import platform
+import socket
+import socketserver
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import timeit
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from tplink_smartplug import SmartPlug, protocol
+from tplink_smartplug.api import pack_batch, unpack_batch
+from pluggerlib.panel import parse_tags, tag_pattern
+
+SIZES = [64, 512, 4096, 65536]
+
+SYSINFO = {'sw_ver': '1.5.4 Build 180815 Rel.121440', 'hw_ver': '2.0',
+           'type': 'IOT.SMARTPLUGSWITCH', 'model': 'HS110(UK)',
+           'mac': '50:C7:BF:00:00:01', 'dev_name': 'Smart Wi-Fi Plug With Energy Monitoring',
+           'alias': 'bench plug', 'relay_state': 0, 'on_time': 0,
+           'active_mode': 'none', 'feature': 'TIM:ENE', 'updating': 0,
+           'icon_hash': '', 'rssi': -52, 'led_off': 0,
+           'longitude_i': -1000, 'latitude_i': 515000,
+           'hwId': '0' * 32, 'fwId': '0' * 32, 'deviceId': '8006' + '0' * 36,
+           'oemId': '0' * 32, 'next_action': {'type': -1}, 'err_code': 0}
+
+# a panel page of typical size, with the wanted tag near the end
+PANEL_XML = ''.join(f'<Tag{i}>{i}.5</Tag{i}>\n' for i in range(60)) \
+            + '<OutputPower>{output}</OutputPower>\n<line3>x</line3>\n'
+
+
+def time_per_op(func, min_time=0.2, repeat=5):
+    """Returns best microseconds per call of func, over repeat runs of at
+    least min_time seconds each
+    """
+    timer = timeit.Timer(func)
+    number, elapsed = timer.autorange()
+    number = max(number, int(number * min_time / max(elapsed, 1e-9)))
+    return min(timer.repeat(repeat=repeat, number=number)) / number * 1e6
+
+
+def time_each(func, count):
+    """Returns dict of median, p95 and mean microseconds over count calls"""
+    samples = []
+    for _ in range(count):
+        start = time.perf_counter()
+        func()
+        samples.append((time.perf_counter() - start) * 1e6)
+    samples.sort()
+    return {'median': statistics.median(samples),
+            'p95': samples[int(len(samples) * 0.95) - 1],
+            'mean': statistics.fmean(samples)}
+
+
+# stand-ins -------------------------------------------------------------
+
+class PlugHandler(socketserver.BaseRequestHandler):
+    # answers get_sysinfo and set_relay_state like an HS110, until the
+    # client closes the connection
+    def handle(self):
+        state = self.server.state
+        while True:
+            try:
+                frame = protocol.recv_frame(self.request)
+            except (OSError, protocol.ProtocolError):
+                return
+            request = json.loads(protocol.xor_decrypt(frame))
+            response = {}
+            for target, commands in request.items():
+                response[target] = {}
+                for cmd, args in commands.items():
+                    if cmd == 'get_sysinfo':
+                        reply = dict(state)
+                    elif cmd == 'set_relay_state':
+                        state['relay_state'] = args['state']
+                        reply = {'err_code': 0}
+                    else:
+                        reply = {'err_code': -2, 'err_msg': 'member not support'}
+                    response[target][cmd] = reply
+            payload = json.dumps(response).encode()
+            self.request.sendall(protocol.HEADER.pack(len(payload))
+                                 + protocol.xor_encrypt(payload))
+
+
+class PlugServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self):
+        super().__init__(('127.0.0.1', 0), PlugHandler)
+        self.state = dict(SYSINFO)
+
+
+class PanelHandler(BaseHTTPRequestHandler):
+    # serves PANEL_XML, alternating the output either side of 1.0 if the
+    # server is set to flap
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        super().setup()
+        # headers and body go out in separate writes: without this, nagle
+        # and delayed acks add ~40ms to every read
+        self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def do_GET(self):
+        server = self.server
+        server.reads += 1
+        output = 0.5 if server.flap and server.reads % 2 else 1.5
+        body = PANEL_XML.format(output=output).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/xml')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@contextlib.contextmanager
+def serving(server):
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        yield server
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+# benchmarks ------------------------------------------------------------
+# each takes wanted(name), true for the benchmarks to time, and skips the
+# rest before doing any of their work
+
+def everything(name):
+    return True
+
+
+def bench_codec(quick=False, wanted=everything):
+    plug = SmartPlug('127.0.0.1')
+    for size in SIZES[:2] if quick else SIZES:
+        text = json.dumps({'x': 'y' * max(0, size - 10)})[:size]
+        cipher = plug.encrypt(text)[protocol.HEADER.size:]
+        if wanted('encrypt'):
+            yield 'encrypt', {'size': size}, time_per_op(lambda: plug.encrypt(text))
+        if wanted('decrypt'):
+            yield 'decrypt', {'size': size}, time_per_op(lambda: plug.decrypt(cipher))
+
+
+def bench_json(quick=False, wanted=everything):
+    # the work SmartPlug.command and command_many do besides i/o
+    request = {'system': {'get_sysinfo': {}}}
+    response_text = json.dumps({'system': {'get_sysinfo': SYSINFO}})
+    if wanted('command_pack'):
+        yield 'command_pack', {}, time_per_op(lambda: json.dumps(request))
+    if wanted('command_unpack'):
+        yield 'command_unpack', {}, time_per_op(
+            lambda: json.loads(response_text)['system']['get_sysinfo'])
+
+    cmds = [('system', 'get_sysinfo'), ('emeter', 'get_realtime'),
+            ('schedule', 'get_rules'), ('time', 'get_time')]
+    packed, batch = pack_batch(cmds)
+    batch_text = json.dumps({target: {cmd: {'err_code': 0}
+                                      for cmd in commands}
+                             for target, commands in batch.items()})
+    if wanted('batch_pack'):
+        yield 'batch_pack', {'cmds': len(cmds)}, time_per_op(
+            lambda: json.dumps(pack_batch(cmds)[1]))
+    if wanted('batch_unpack'):
+        yield 'batch_unpack', {'cmds': len(cmds)}, time_per_op(
+            lambda: unpack_batch(packed, json.loads(batch_text)))
+
+
+def bench_panel_parse(quick=False, wanted=everything):
+    if not wanted('panel_parse'):
+        return
+    text = PANEL_XML.format(output=1.5)
+    pattern = tag_pattern(('OutputPower',))
+    yield 'panel_parse', {'bytes': len(text)}, time_per_op(
+        lambda: parse_tags(text, ('OutputPower',), pattern))
+
+
+def bench_command(quick=False, wanted=everything):
+    if not wanted('plug_command'):
+        return
+    count = 200 if quick else 2000
+    with serving(PlugServer()) as server:
+        port = server.server_address[1]
+        for persistent in (False, True):
+            plug = SmartPlug('127.0.0.1', port=port, persistent=persistent)
+            plug.command(('system', 'get_sysinfo'))     # warm up
+            stats = time_each(lambda: plug.command(('system', 'get_sysinfo')),
+                              count)
+            plug.close()
+            yield 'plug_command', {'persistent': persistent}, stats
+
+
+def bench_loop(quick=False, wanted=everything):
+    if not wanted('control_loop'):
+        return
+    import plugger
+
+    cycles = 50 if quick else 500
+    log = logging.getLogger('bench')
+    log.propagate = False
+    log.addHandler(logging.NullHandler())
+
+    with serving(PlugServer()) as plug_server, \
+         serving(ThreadingHTTPServer(('127.0.0.1', 0), PanelHandler)) as panel_server, \
+         tempfile.TemporaryDirectory() as tmp:
+        panel_ip = '127.0.0.1:%d/meters.xml' % panel_server.server_address[1]
+        for flap in (False, True):
+            panel_server.reads = 0
+            panel_server.flap = flap
+            plug = SmartPlug('127.0.0.1', port=plug_server.server_address[1],
+                             persistent=True)
+            with contextlib.redirect_stdout(io.StringIO()):
+                start = time.perf_counter()
+                plugger.main(panel_ip=panel_ip, plug=plug, threshold=1.0,
+                             log_file=os.path.join(tmp, f'{flap}.csv'),
+                             log=log, sleep=lambda seconds: None,
+                             max_cycles=cycles)
+                elapsed = time.perf_counter() - start
+            plug.close()
+            yield 'control_loop', {'switching': flap}, elapsed / cycles * 1e6
+
+
+BENCHMARKS = [('micro', bench_codec),
+              ('micro', bench_json),
+              ('micro', bench_panel_parse),
+              ('macro', bench_command),
+              ('macro', bench_loop),
+             ]
+
+
+def key(result):
+    params = ','.join(f'{k}={v}' for k, v in result['params'].items())
+    return f"{result['name']}[{params}]" if params else result['name']
+
+
+def metadata():
+    try:
+        commit = subprocess.run(['git', 'describe', '--always', '--dirty'],
+                                capture_output=True, text=True, timeout=10,
+                                cwd=os.path.dirname(os.path.abspath(__file__))
+                               ).stdout.strip() or None
+    except OSError:
+        commit = None
+    return {'commit': commit,
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'numpy': protocol.numpy is not None,
+           }
+
+
+def run(groups=('micro', 'macro'), only=None, quick=False):
+    """Returns list of result dicts with name, group, params, us (the
+    headline microseconds per op) and for macro-benchmarks the median, p95
+    and mean
+    """
+    def wanted(name):
+        return not only or any(word in name for word in only)
+
+    results = []
+    for group, bench in BENCHMARKS:
+        if group not in groups:
+            continue
+        for name, params, value in bench(quick, wanted):
+            result = {'name': name, 'group': group, 'params': params}
+            if isinstance(value, dict):
+                result.update(value)
+                result['us'] = value['median']
+            else:
+                result['us'] = value
+            results.append(result)
+            print(f"{key(result):40} {result['us']:12.2f} us", file=sys.stderr)
+    return results
+
+
+def compare(results, baseline):
+    """Print each result against the same benchmark in baseline"""
+    before = {key(r): r['us'] for r in baseline['results']}
+    print('benchmark'.ljust(40), 'before'.rjust(12), 'after'.rjust(12),
+          'change'.rjust(8))
+    for result in results:
+        name = key(result)
+        if name not in before:
+            print(name.ljust(40), 'n/a'.rjust(12), f"{result['us']:12.2f}")
+            continue
+        change = result['us'] / before[name] - 1
+        print(name.ljust(40), f'{before[name]:12.2f}', f"{result['us']:12.2f}",
+              f'{change:+8.1%}')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--json', help='write results to this file')
+    parser.add_argument('--compare', help='compare with results in this file')
+    parser.add_argument('--group', choices=['micro', 'macro'],
+                        help='only run this group')
+    parser.add_argument('--only', nargs='+',
+                        help='only benchmarks whose names contain one of these')
+    parser.add_argument('--quick', action='store_true',
+                        help='fewer sizes and iterations, for a smoke test')
+    args = parser.parse_args(argv)
+
+    groups = (args.group,) if args.group else ('micro', 'macro')
+    results = run(groups, args.only, args.quick)
+    document = {'meta': metadata(), 'results': results}
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(document, f, indent=1)
+    if args.compare:
+        with open(args.compare) as f:
+            compare(results, json.load(f))
+    elif not args.json:
+        json.dump(document, sys.stdout, indent=1)
+        print()
+
+
+if __name__ == '__main__':
+    main()
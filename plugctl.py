@@ -0,0 +1,47 @@
+"""
+Thin client for a running "python plugger.py daemon".
+
+Only loads the standard library, so it costs little more than starting
+python itself, and leaves the real work to the warm daemon.
+
+    $ python plugctl.py single      run one control cycle now
+    $ python plugctl.py status
+    $ python plugctl.py on          (or off) switch the plug by hand
+    $ python plugctl.py stop
+
+Pass --socket path if the daemon is not on the default socket (set by the
+PLUGGER_SOCKET environment variable, or /tmp/plugger.sock).  Exits 0 if
+the daemon reports success, 1 if not, 2 if it cannot be reached.
+"""
+import json
+import sys
+
+from pluggerlib.daemon import DEFAULT_SOCKET, request
+
+COMMANDS = ['single', 'status', 'on', 'off', 'ping', 'stop']
+
+
+def main(argv):
+    socket_path = DEFAULT_SOCKET
+    if '--socket' in argv:
+        i = argv.index('--socket')
+        socket_path = argv[i + 1]
+        argv = argv[:i] + argv[i + 2:]
+
+    if len(argv) != 1 or argv[0] not in COMMANDS:
+        print(__doc__)
+        return 2
+
+    try:
+        reply = request(argv[0], socket_path)
+    except OSError as e:
+        print(f'cannot reach plugger daemon on {socket_path}: {e}',
+              file=sys.stderr)
+        return 2
+
+    print(json.dumps(reply, indent=1))
+    return 0 if reply.get('ok') else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -1,12 +1,22 @@
 import time
-import logging
-from logging.handlers import TimedRotatingFileHandler
 import os
 import sys
-import csv
-import requests
+import json
+import threading
 
 from tplink_smartplug import SmartPlug
+from tplink_smartplug.discovery import find_plug
+from tplink_smartplug.rules import window_rules
+from pluggerlib.csvlog import BufferedCsvWriter
+from pluggerlib.daemon import DEFAULT_SOCKET, ControlServer, Controller, run_loop
+from pluggerlib.fleet import FleetController, Load
+from pluggerlib.history import HistoryStore
+from pluggerlib.logpipe import setup_logging as setup_log_pipe
+from pluggerlib.metrics import NULL, Registry, instrument_plug, serve
+from pluggerlib.panel import PanelReader, make_panel
+from pluggerlib.retry import CircuitBreaker, DeviceError, Guard, RetryPolicy
+from pluggerlib.scheduler import AdaptiveScheduler, Scheduler
+from pluggerlib.supervisor import Supervisor
 
 CSV_COLUMNS = ['datetime', 
                'mode',
@@ -15,8 +25,38 @@ CSV_COLUMNS = ['datetime',
                'socket_state',
                'action',
                'socket_state1',
+               'failure',
               ]
 
+# fleet mode writes one row per plug per cycle
+FLEET_CSV_COLUMNS = ['datetime',
+                     'mode',
+                     'panel_success',
+                     'panel_output',
+                     'plug',
+                     'rated',
+                     'priority',
+                     'socket_state',
+                     'action',
+                     'socket_state1',
+                     'error',
+                    ]
+
+# supervisor mode adds the site each plug belongs to
+SUPERVISOR_CSV_COLUMNS = ['datetime',
+                          'mode',
+                          'site',
+                          'panel_success',
+                          'panel_output',
+                          'plug',
+                          'rated',
+                          'priority',
+                          'socket_state',
+                          'action',
+                          'socket_state1',
+                          'error',
+                         ]
+
 pads = [35, 10]
 
 class TestPlug:
@@ -39,7 +79,16 @@ def main(panel_ip='192.168.1.161/meters.xml', socket_ip='192.168.1.61',
          log_file='C:\\Users\\eugen\\plugger\\log.csv', test_plug=False, 
          daily_log_dir='C:\\Users\\eugen\\plugger\\daily_logs\\', 
          timed_log_when='midnight', timed_log_interval=None,
-         days_to_log=28):
+         days_to_log=28, plug_cache_ttl=5, socket_mac=None,
+         broadcast='255.255.255.255', panel_deadline=5, panel_combine='sum',
+         panel_stale_after=None, log_flush_rows=10, log_flush_secs=300,
+         log_fsync=False, history_dir=None, plug=None, panel=None,
+         clock=time.time, sleep=time.sleep, max_cycles=None, log=None,
+         adaptive=False, min_interval=None, max_interval=None,
+         poll_jitter=0, monotonic=time.monotonic, structured_log=False,
+         metrics=None, metrics_port=None, retries=3, retry_base=0.5,
+         retry_budget_fraction=0.5, breaker_failures=3, breaker_reset=60,
+         deadman=None, device_windows=None, decider=None):
     """
     Do iterations over a loop which tests the power output at panel_ip,
     and manages the state of a plug at socket_ip, according to the threshold
@@ -50,6 +99,72 @@ def main(panel_ip='192.168.1.161/meters.xml', socket_ip='192.168.1.61',
 
     Otherwise will operate continuously. Interrupt with ctrl-c
 
+    plug_cache_ttl is how many seconds a plug's sysinfo is reused for, so
+    the splash screen and the read after switching do not each cost a round
+    trip.  Keep it well below interval so each loop starts from a fresh read.
+
+    panel_ip may be a list, for sites with several inverters.  They are
+    read concurrently, and any not answering within panel_deadline seconds
+    are treated as failed for that loop.  Their outputs are combined with
+    panel_combine ('sum', 'mean', 'max' or 'min'), and a failed inverter's
+    last good reading may stand in for up to panel_stale_after seconds.
+
+    Rows for log_file are buffered and written every log_flush_rows rows,
+    or once the oldest is log_flush_secs old, and always on exit, including
+    ctrl-c.  Pass log_fsync=True to force each batch to disk.
+
+    The daily log is written from a background thread, so the loop never
+    waits on the disk for it.  Pass structured_log=True to write it as
+    json lines, with the step id and logged values as separate fields.
+
+    Pass metrics_port to serve latency histograms, counters and state
+    gauges in Prometheus text format at http://127.0.0.1:metrics_port/metrics,
+    or a pluggerlib.metrics.Registry as metrics to read them in-process
+    (metrics.snapshot()).  With neither, nothing is recorded.
+
+    Failed panel and plug calls are retried up to retries times in all,
+    after retry_base, 2 x retry_base ... seconds with jitter, as long as
+    the retries end within retry_budget_fraction of the poll interval.  After
+    breaker_failures failed cycles in a row a device is left alone, but for
+    a single probe every breaker_reset seconds (doubling while it stays
+    down); pass breaker_failures=None to always try.  Failed cycles are
+    logged too, with the device and kind of failure (eg 'plug timeout',
+    see pluggerlib.retry) in the failure column.
+
+    Pass a pluggerlib.decide.Engine as decider to switch on a smoothed or
+    forecast output, with hysteresis and minimum on and off times, rather
+    than on each reading alone.  It keeps its window between loops, so
+    only helps in continuous operation; how many switches it held back is
+    logged and counted in the switches_suppressed_total metric.
+
+    Pass deadman (seconds) to have the plug turn itself off if plugger
+    stops: each turn-on arms a countdown on the plug itself, and each
+    'leave on' loop sets it again.  It must be longer than the longest
+    poll interval, with room for retries.  Pass device_windows, a list of
+    ('HH:MM', 'HH:MM') times, to have the plug switch itself on and off
+    at those times every day, whether or not plugger is running.
+
+    If history_dir is passed, each row is also appended to a compact
+    columnar store there (see pluggerlib.history), for fast analysis.
+
+    If socket_mac is passed, the plug is found by broadcasting to broadcast
+    when socket_ip is None, and found again whenever it stops answering, in
+    case DHCP has given it a new address.
+
+    Polls are on a fixed-rate grid, so the time each loop takes does not
+    stretch the period, with up to poll_jitter seconds of random delay.
+    With adaptive=True the interval moves between min_interval and
+    max_interval (default interval / 4 and x 4): faster when the output is
+    near threshold or changing quickly, slower when it is far from it and
+    steady, or dark (see pluggerlib.scheduler).
+
+    For simulation (see pluggerlib.simulate), pass a ready plug object as
+    plug and a panel object with a read(log) method returning a
+    PanelReading as panel, replace the clock and sleep functions, pass a
+    logger as log to skip setting up the log files, and stop continuous
+    operation after max_cycles loops.  monotonic is the clock polls are
+    scheduled on.
+
     To test:
         pass socket_ip=None and test_plug=True to simulate the plug
         pass a test xml page on localserver as panel_ip, eg:
@@ -62,31 +177,11 @@ def main(panel_ip='192.168.1.161/meters.xml', socket_ip='192.168.1.61',
 
     """
 
-    # make a daily logging directory if doesn't exist
-    if not os.path.exists(daily_log_dir):
-         os.mkdir(daily_log_dir)
-
-    # set up logging
-    formatter = logging.Formatter('%(asctime)-15s %(msg)-10s')
-    # formatter.datefmt = ('%d/%m/%y %H:%M:%S')
-    file_path = os.path.join(daily_log_dir, 'log')
-    print('made a folder for logs: {file_path}')
-
-    if timed_log_interval is None:
-        handler = TimedRotatingFileHandler(file_path, when=timed_log_when,
-                                           backupCount=days_to_log)
-
-    else:
-        handler = TimedRotatingFileHandler(file_path, when=timed_log_when,
-                                           interval=timed_log_interval,
-                                           backupCount=days_to_log)
-
-    handler.setLevel(logging.INFO)
-    handler.setFormatter(formatter)
-
-    log = logging.getLogger()
-    log.setLevel(logging.INFO)
-    log.addHandler(handler)
+    listener = None
+    if log is None:
+        log, listener = setup_logging(daily_log_dir, timed_log_when,
+                                      timed_log_interval, days_to_log,
+                                      structured_log)
 
     # initial entry
     log.info('')
@@ -97,10 +192,23 @@ def main(panel_ip='192.168.1.161/meters.xml', socket_ip='192.168.1.61',
     else:
         log.info('[main 0.02] Calling main, mode=cont')
 
+    # find the plug by mac address if no ip given
+    if plug is None and socket_ip is None and socket_mac is not None:
+        found = find_plug(socket_mac, target=broadcast)
+        if found is None:
+            print('Could not discover a plug with mac', socket_mac)
+            log.info('[main 0.10] initial plug NOT FOUND')
+            return 1
+        socket_ip = found.host
+        log.info('[main 0.04] discovered plug %s at %s', socket_mac, socket_ip)
+
     # create a plug instance
-    if socket_ip is not None:
+    if plug is not None:
+        log.info('[main 0.03] using plug passed in')
+
+    elif socket_ip is not None:
         try:
-            plug = SmartPlug(socket_ip)
+            plug = SmartPlug(socket_ip, cache_ttl=plug_cache_ttl)
             log.info('[main 0.05] initial plug found')
 
         except:
@@ -117,6 +225,36 @@ def main(panel_ip='192.168.1.161/meters.xml', socket_ip='192.168.1.61',
         log.info('[main 0.30] exiting as no plug')
         return 1
 
+    # the countdown must outlast the gap between polls, or it would switch
+    # the plug off under a running loop
+    if deadman is not None:
+        longest = interval
+        if adaptive:
+            longest = interval * 4 if max_interval is None else max_interval
+        if deadman <= longest + poll_jitter:
+            print(f'deadman ({deadman} sec) must be longer than the poll interval ({longest} sec)')
+            log.info('[main 0.31] deadman %s too short for interval %s', deadman, longest)
+            return 1
+        if not hasattr(plug, 'turn_on_for'):
+            print('plug has no countdown, running without deadman')
+            log.info('[main 0.31] plug has no countdown, deadman off')
+            deadman = None
+
+    if device_windows is not None:
+        try:
+            window_rules(device_windows)
+        except ValueError as e:
+            print('bad device_windows:', e)
+            log.info('[main 0.31] bad device_windows: %s', e)
+            return 1
+
+    if metrics is None:
+        metrics = NULL if metrics_port is None else Registry()
+    if metrics_port is not None:
+        serve(metrics, metrics_port)
+        log.info('[main 0.32] serving metrics on port %s', metrics_port)
+    instrument_plug(plug, metrics)
+    metrics.gauge('threshold', 'panel output switching threshold').set(threshold)
 
     interval_by_min = f'{str(interval // 60)} min, {str(interval % 60)} sec'
 
@@ -135,7 +273,8 @@ def main(panel_ip='192.168.1.161/meters.xml', socket_ip='192.168.1.61',
     print('Panel IP address:'.ljust(pads[0]), panel_ip)
     print('Panel power output threshold:'.ljust(pads[0]), threshold)
     print('')
-    print('Test interval:'.ljust(pads[0]), interval_by_min)
+    print('Test interval:'.ljust(pads[0]), interval_by_min,
+          '(adaptive)' if adaptive else '')
     print('Testing mode:'.ljust(pads[0]),
           'single shot' if single_shot else 'continuous')
     print('Max attempts (if single shot):'.ljust(pads[0]),
@@ -144,170 +283,617 @@ def main(panel_ip='192.168.1.161/meters.xml', socket_ip='192.168.1.61',
     print('*'*59)
     print('')
     
-    time.sleep(1)
+    sleep(1)
+
+
+    # initialise the log file if reqd, rows are written in batches
+    csv_log = BufferedCsvWriter(log_file, CSV_COLUMNS, max_rows=log_flush_rows,
+                                max_age=log_flush_secs, fsync=log_fsync)
+    history = None
+    if history_dir is not None:
+        history = HistoryStore(history_dir, max_rows=log_flush_rows, log=log)
+
+    if panel is None:
+        panel = make_panel(panel_ip, deadline=panel_deadline,
+                           combine=panel_combine,
+                           stale_after=panel_stale_after)
+    if adaptive:
+        scheduler = AdaptiveScheduler(interval, threshold,
+                                      min_interval=min_interval,
+                                      max_interval=max_interval,
+                                      jitter=poll_jitter, clock=monotonic,
+                                      sleep=sleep)
+    else:
+        scheduler = Scheduler(interval, jitter=poll_jitter, clock=monotonic,
+                              sleep=sleep)
+    scheduler.start()
+
+    def guard(name):
+        policy = RetryPolicy(attempts=retries, base=retry_base, sleep=sleep,
+                             clock=monotonic)
+        breaker = None
+        if breaker_failures is not None:
+            breaker = CircuitBreaker(breaker_failures, breaker_reset,
+                                     clock=monotonic)
+        return Guard(name, policy, breaker, log)
+
+    panel_guard = guard('panel')
+    plug_guard = guard('plug')
+
+    if device_windows is not None and not hasattr(plug, 'set_windows'):
+        print('plug has no schedule, not setting time windows')
+        log.info('[main 0.33] plug has no schedule, device_windows ignored')
+    elif device_windows is not None:
+        try:
+            plug_guard.call(plug.set_windows, device_windows)
+            log.info('[main 0.33] pushed %s time windows to plug', len(device_windows))
+        except DeviceError as e:
+            print('could not set time windows on plug:', e)
+            log.info('[main 0.33] could not set time windows on plug: %s', e)
 
+    def write_row(row, now):
+        csv_log.writerow(row)
+        if history is not None:
+            history.writerow(row, now)
 
-    # initialise the log file if reqd
-    if not os.path.exists(log_file):
-        with open(log_file, 'a', newline="") as f:
-            writer = csv.writer(f, delimiter=",")
-            writer.writerow(CSV_COLUMNS)
+    tries = 0
+    cycles = 0
 
+    try:
+        # main loop
+        while True:
+            if max_cycles is not None and cycles >= max_cycles:
+                log.info('[main 0.35] reached max cycles, exiting')
+                return 0
+            cycles += 1
+            log.info('[main 0.40] entering main loop')
+
+            now = clock()
+            ts = time.strftime('%d/%m/%y %H:%M:%S', time.localtime(now))
+            log_list = [ts, 'single' if single_shot else 'cont']
 
-    tries = 0
+            if single_shot:
+                print(ts, f'[{tries + 1}/{max_tries}]'.ljust(7), end=" ")
+            else:
+                print(ts, end=" ")
+
+
+            # try to read the panel's current output, retrying briefly
+            log.info('[main 0.50] ready to read panel')
+            budget = scheduler.next_interval() * retry_budget_fraction
+            failure = None
+            with metrics.timed('panel_read_seconds', 'panel read time'):
+                try:
+                    panel_output = panel_guard.call(read_panel_output, panel,
+                                                    'OutputPower', log,
+                                                    budget=budget)
+                    success = True
+                except DeviceError as e:
+                    success, panel_output = False, str(e)
+                    failure = 'panel ' + e.kind
+            metrics.counter('panel_reads_total',
+                            result='ok' if success else 'failed').inc()
+            log.info('[main 0.60] panel read: success=%s', success)
+            log.info('[main 0.60] panel read: output=%s', panel_output)
+            scheduler.update(panel_output if success else None)
+
+            if not success:
+                print(f'failed to get panel output, error: {panel_output}')
+                log.info('[main 0.65] %s: %s', failure, panel_output)
+                write_row(log_list + [False, '', '', '', '', failure], now)
+                if single_shot:
+                    tries += 1
+                    if tries == max_tries:
+                        log.info('[main 0.70] reached max tries, exiting')
+                        return 0
+                scheduler.wait()
+                continue
+
+            log_list.extend([success, panel_output])
+            metrics.gauge('panel_output', 'last panel output').set(panel_output)
+            print('panel reading: ' + str(panel_output).ljust(pads[1]), end= ' ')
+
+            try:
+                socket_state = plug_guard.call(lambda: plug.is_on,
+                                               budget=budget)
+                log.info('[main 0.80] read plug state: %s', socket_state)
+            except DeviceError as e:
+                print('cannot find plug:', e)
+                log.info('[main 0.90] cannot read plug (%s): %s', e.kind, e)
+                metrics.counter('plug_failures_total', 'failed plug operations',
+                                step='read', kind=e.kind).inc()
+                if socket_mac is not None and e.kind != 'open':
+                    found = find_plug(socket_mac, target=broadcast)
+                    if found is not None and found.host != plug.host:
+                        log.info('[main 0.95] plug %s moved from %s to %s',
+                                 socket_mac, plug.host, found.host)
+                        print('plug moved to', found.host)
+                        plug.host = found.host
+                        plug.invalidate()
+                        if plug_guard.breaker is not None:
+                            plug_guard.breaker.success()
+                        continue
+                write_row(log_list + ['', '', '', 'plug ' + e.kind], now)
+                if single_shot:
+                    tries += 1
+                    if tries == max_tries:
+                        log.info('[main 1.00] reached max tries, exiting')
+                        return 0
+                scheduler.wait()
+                continue
+
+            log_list.append(socket_state)
+
+            want = panel_output >= threshold
+            if decider is not None:
+                decision = decider.decide(monotonic(), panel_output,
+                                          socket_state, threshold)
+                want = decision.want
+                if decision.held is not None:
+                    log.info('[main 1.05] %s held plug %s, signal=%.3f',
+                             decision.held, 'on' if socket_state else 'off',
+                             decision.signal)
+                    metrics.counter('switches_suppressed_total',
+                                    'switches held back by the decider',
+                                    held=decision.held).inc()
+
+            if want:
+                if socket_state:
+                    log_list.append('leave on')
+                    log.info('[main 1.10] output over threshold, leaving on')
+                    print('leave on')
+                    if deadman is not None:
+                        try:
+                            plug_guard.call(plug.set_countdown, deadman,
+                                            budget=budget)
+                        except DeviceError as e:
+                            # the countdown left running may still switch
+                            # off early; the next loop turns it back on
+                            log.info('[main 1.15] cannot re-arm deadman (%s): %s',
+                                     e.kind, e)
+                            metrics.counter('plug_failures_total', step='rearm',
+                                            kind=e.kind).inc()
+
+                else:
+                    try:
+                        if deadman is not None:
+                            plug_guard.call(plug.turn_on_for, deadman,
+                                            budget=budget)
+                        else:
+                            plug_guard.call(plug.turn_on, budget=budget)
+                        log.info('[main 1.20] *** turned plug ON ***')
+                    except DeviceError as e:
+                        print('cannot turn on plug:', e)
+                        log.info('[main 1.30] cannot turn on plug (%s): %s',
+                                 e.kind, e)
+                        metrics.counter('plug_failures_total', step='turn_on',
+                                        kind=e.kind).inc()
+                        write_row(log_list + ['', '', 'plug ' + e.kind], now)
+                        if single_shot:
+                            tries += 1
+                            if tries == max_tries:
+                                log.info('[main 1.40] reached max tries, exiting')
+                                return 0
+                        scheduler.wait()
+                        continue
+                    print('** TURN ON **')
+                    metrics.counter('switches_total', 'plug switches made',
+                                    to='on').inc()
+                    log_list.append('activate')
 
-    # main loop
-    while True:
-        log.info('[main 0.40] entering main loop')
+            else:
+                if socket_state:
+                    try:
+                        plug_guard.call(plug.turn_off, budget=budget)
+                        log.info('[main 1.50] *** turned plug OFF ***')
+                    except DeviceError as e:
+                        print('cannot turn off plug:', e)
+                        log.info('[main 1.60] cannot turn off plug (%s): %s',
+                                 e.kind, e)
+                        metrics.counter('plug_failures_total', step='turn_off',
+                                        kind=e.kind).inc()
+                        write_row(log_list + ['', '', 'plug ' + e.kind], now)
+                        if single_shot:
+                            tries += 1
+                            if tries == max_tries:
+                                log.info('[main 1.70] reached max tries, exiting')
+                                return 0
+                        scheduler.wait()
+                        continue
+                    print('** TURN OFF **')
+                    metrics.counter('switches_total', to='off').inc()
+                    log_list.append('deactivate')
+
+                else:
+                    log_list.append('leave off')
+                    print('leave off')
+
+            # log a plug reading after any changes
+            try:
+                socket_state = plug_guard.call(lambda: plug.is_on,
+                                               budget=budget)
+                log.info('[main 1.80] got plug reading after changes: %s', socket_state)
+            except DeviceError as e:
+                print('cannot find plug:', e)
+                log.info('[main 1.90] cannot read plug after changes (%s): %s',
+                         e.kind, e)
+                metrics.counter('plug_failures_total', step='read_after',
+                                kind=e.kind).inc()
+                socket_state = ''
+                failure = 'plug ' + e.kind
+
+            log_list.extend([socket_state, failure])
+            metrics.gauge('socket_state', 'plug on (1) or off (0)').set(socket_state or 0)
+
+            # write out log
+            with metrics.timed('log_write_seconds', 'csv and history write time'):
+                write_row(log_list, now)
+            metrics.counter('cycles_total', 'completed control loops').inc()
+
+            # exit loop if only a single shot required
+            if single_shot:
+                return 0
+
+            log.info('[main 2.00] reached end of main loop')
+            scheduler.wait()
+
+    finally:
+        if decider is not None:
+            log.info('[main 2.10] decider made %s switches, held back %s: %s',
+                     decider.switches, decider.total_suppressed,
+                     decider.suppressed)
+        csv_log.close()
+        if history is not None:
+            history.close()
+        if listener is not None:
+            listener.stop()
+  
 
-        ts = time.strftime('%d/%m/%y %H:%M:%S')
-        log_list = [ts, 'single' if single_shot else 'cont']
+def main_fleet(loads, panel_ip='192.168.1.161/meters.xml', reserve=0,
+               interval=30, single_shot=False, max_tries=None,
+               log_file='fleet_log.csv', test_plug=False,
+               daily_log_dir='daily_logs', timed_log_when='midnight',
+               timed_log_interval=None, days_to_log=28, plug_cache_ttl=5,
+               panel_deadline=5, panel_combine='sum', panel_stale_after=None,
+               log_flush_rows=10, log_flush_secs=300, log_fsync=False,
+               structured_log=False):
+    """
+    Like main(), but shares the panel output at panel_ip across several
+    plugs.  Each cycle reads the panel once, allocates the output less
+    reserve to the loads by priority and rated power (see
+    pluggerlib.fleet.allocate), then reads and switches all plugs at once.
 
-        if single_shot:
-            print(ts, f'[{tries + 1}/{max_tries}]'.ljust(7), end=" ")
+    loads is a list of dicts with keys:
+        name        used in the logs
+        socket_ip   plug address (ignored if test_plug=True)
+        rated       power the load draws, same units as the panel output
+        priority    lower numbers are served first (default 0)
+
+    panel_ip may be a list of inverters, read as in main().
+
+    One row per plug per cycle is written to log_file, with FLEET_CSV_COLUMNS.
+    """
+    log, listener = setup_logging(daily_log_dir, timed_log_when,
+                                  timed_log_interval, days_to_log,
+                                  structured_log)
+    mode = 'single' if single_shot else 'cont'
+    log.info('[flt 0.01] Calling main_fleet, mode=%s', mode)
+
+    fleet_loads = []
+    for spec in loads:
+        if test_plug:
+            plug = TestPlug()
         else:
-            print(ts, end=" ")
+            plug = SmartPlug(spec['socket_ip'], cache_ttl=plug_cache_ttl)
+        fleet_loads.append(Load(spec['name'], plug, spec['rated'],
+                                spec.get('priority', 0)))
+    fleet = FleetController(fleet_loads, reserve=reserve)
+    panel = make_panel(panel_ip, deadline=panel_deadline,
+                       combine=panel_combine, stale_after=panel_stale_after)
 
+    print('')
+    print('*'*12, 'PLUGGER FLEET MODE', '*'*12)
+    print('')
+    print('Panel IP address:'.ljust(pads[0]), panel_ip)
+    print('Reserve:'.ljust(pads[0]), reserve)
+    for load in sorted(fleet_loads, key=lambda x: x.priority):
+        print(f'  [{load.priority}] {load.name}'.ljust(pads[0]), load.rated)
+    print('')
 
-        # try to read the panel's current output
-        log.info('[main 0.50] ready to read panel')
-        success, panel_output = get_panel_output(panel_ip=panel_ip,
-                                         target='OutputPower', log=log)
-        log.info(f'[main 0.60] panel read: success={success}')
-        log.info(f'[main 0.60] panel read: output={panel_output}')
+    csv_log = BufferedCsvWriter(log_file, FLEET_CSV_COLUMNS,
+                                max_rows=log_flush_rows * len(fleet_loads),
+                                max_age=log_flush_secs, fsync=log_fsync)
 
-        if not success:
-            print(f'failed to get panel output, error: {panel_output}')
-            if single_shot:
-                tries += 1
-                if tries == max_tries:
-                    log.info('[main 0.70] reached max tries, exiting')
-                    return 0
-            time.sleep(interval)
-            continue
+    tries = 0
 
-        log_list.extend([success, panel_output])
-        print('panel reading: ' + str(panel_output).ljust(pads[1]), end= ' ')
+    try:
+        while True:
+            ts = time.strftime('%d/%m/%y %H:%M:%S')
+            success, panel_output = get_panel_output(target='OutputPower',
+                                                     log=log, reader=panel)
+            log.info('[flt 0.60] panel read: success=%s output=%s',
+                     success, panel_output)
+
+            if not success:
+                print(ts, f'failed to get panel output, error: {panel_output}')
+                if single_shot:
+                    tries += 1
+                    if tries == max_tries:
+                        log.info('[flt 0.70] reached max tries, exiting')
+                        return 0
+                time.sleep(interval)
+                continue
+
+            results = fleet.cycle(panel_output)
+
+            print(ts, 'panel reading: ' + str(panel_output).ljust(pads[1]),
+                  ', '.join(f"{r['plug']}: {r['error'] or r['action']}"
+                            for r in results))
+
+            for result in results:
+                if result['action'] in ('activate', 'deactivate'):
+                    log.info('[flt 1.20] *** %s %s ***', result['plug'],
+                             result['action'])
+                if result['error'] is not None:
+                    log.info('[flt 1.30] %s: %s', result['plug'],
+                             result['error'])
+                csv_log.writerow([ts, mode, success, panel_output]
+                                 + [result[col] for col in
+                                    FLEET_CSV_COLUMNS[4:]])
 
-        try:
-            socket_state = plug.is_on
-            log.info(f'[main 0.80] read plug state: {socket_state}')
-        except:
-            print('cannot find plug')
-            log.info(f'[main 0.90] cannot read plug')
             if single_shot:
-                tries += 1
-                if tries == max_tries:
-                    log.info('[main 1.00] reached max tries, exiting')
-                    return 0
+                return 0
+
             time.sleep(interval)
-            continue
 
-        log_list.append(socket_state)
+    finally:
+        csv_log.close()
+        fleet.close()
+        listener.stop()
+
+
+def main_daemon(panel_ip='192.168.1.161/meters.xml', socket_ip='192.168.1.61',
+                threshold=0.7, interval=None, socket_path=DEFAULT_SOCKET,
+                log_file='C:\\Users\\eugen\\plugger\\log.csv', test_plug=False,
+                daily_log_dir='C:\\Users\\eugen\\plugger\\daily_logs\\',
+                timed_log_when='midnight', timed_log_interval=None,
+                days_to_log=28, plug_cache_ttl=5, panel_deadline=5,
+                panel_combine='sum', panel_stale_after=None,
+                log_flush_rows=10, log_flush_secs=300, log_fsync=False,
+                history_dir=None, structured_log=False, adaptive=False,
+                min_interval=None, max_interval=None, poll_jitter=0,
+                retries=3, retry_base=0.5, retry_budget_secs=10, breaker_failures=3,
+                breaker_reset=60, decider=None):
+    """
+    Run as a resident controller, serving requests on the unix domain
+    socket socket_path until sent "stop" or interrupted.
+
+    The plug connection, panel session, plug cache and log files stay
+    open between requests, so "python plugctl.py single" from a scheduler
+    runs one cycle of main() in milliseconds plus the cycle's own i/o.
+    plugctl.py also has status, on and off (see pluggerlib.daemon).
+
+    If interval is given, the daemon also runs main()'s loop itself on a
+    fixed-rate grid (adaptive as in main()).  Otherwise it only acts on
+    requests.  Device calls are retried and circuit broken as in main(),
+    but with retries ending within retry_budget_secs seconds, as there may
+    be no interval to take a fraction of.  Other arguments are as for
+    main().
+    """
+    log, listener = setup_logging(daily_log_dir, timed_log_when,
+                                  timed_log_interval, days_to_log,
+                                  structured_log)
+    log.info('[dmn 0.01] Calling main_daemon, socket=%s', socket_path)
 
-        if panel_output >= threshold:
-            if socket_state:
-                log_list.append('leave on')
-                log.info(f'[main 1.10] output over threshold, leaving on')
-                print('leave on')
-            
-            else:
-                try:
-                    plug.turn_on()
-                    log.info(f'[main 1.20] *** turned plug ON ***')
-                except:
-                    print('cannot turn on plug')
-                    log.info(f'[main 1.30] cannot turn on plug')
-                    if single_shot:
-                        tries += 1
-                        if tries == max_tries:
-                            log.info('[main 1.40] reached max tries, exiting')
-                            return 0
-                    time.sleep(interval)
-                    continue
-                print('** TURN ON **')
-                log_list.append('activate')
-
-        elif panel_output < threshold:
-            if socket_state:
-                try:
-                    plug.turn_off()
-                    log.info(f'[main 1.50] *** turned plug OFF ***')
-                except:
-                    print('cannot find plug')
-                    log.info(f'[main 1.60] cannot turn off plug')
-                    if single_shot:
-                        tries += 1
-                        if tries == max_tries:
-                            log.info('[main 1.70] reached max tries, exiting')
-                            return 0
-                    time.sleep(interval)
-                    continue
-                print('** TURN OFF **')
-                log_list.append('deactivate')
-            
-            else:
-                log_list.append('leave off')
-                print('leave off')
+    if test_plug:
+        plug = TestPlug()
+    else:
+        plug = SmartPlug(socket_ip, persistent=True, cache_ttl=plug_cache_ttl)
+    panel = make_panel(panel_ip, deadline=panel_deadline,
+                       combine=panel_combine, stale_after=panel_stale_after)
+    csv_log = BufferedCsvWriter(log_file, CSV_COLUMNS, max_rows=log_flush_rows,
+                                max_age=log_flush_secs, fsync=log_fsync)
+    history = None
+    if history_dir is not None:
+        history = HistoryStore(history_dir, max_rows=log_flush_rows, log=log)
+
+    def guard(name):
+        policy = RetryPolicy(attempts=retries, base=retry_base,
+                             budget=retry_budget_secs)
+        breaker = None
+        if breaker_failures is not None:
+            breaker = CircuitBreaker(breaker_failures, breaker_reset)
+        return Guard(name, policy, breaker, log)
+
+    controller = Controller(plug, panel, threshold, csv_log, history, log,
+                            panel_guard=guard('panel'), plug_guard=guard('plug'),
+                            decider=decider)
+    server = ControlServer(controller, socket_path)
+    print('plugger daemon listening on', socket_path)
+
+    stop = threading.Event()
+    loop = None
+    if interval is not None:
+        if adaptive:
+            scheduler = AdaptiveScheduler(interval, threshold,
+                                          min_interval=min_interval,
+                                          max_interval=max_interval,
+                                          jitter=poll_jitter, sleep=stop.wait)
+        else:
+            scheduler = Scheduler(interval, jitter=poll_jitter, sleep=stop.wait)
+        loop = threading.Thread(target=run_loop,
+                                args=(controller, scheduler, stop),
+                                name='control-loop', daemon=True)
+        loop.start()
 
-        # log a plug reading after any changes
-        try:
-            socket_state = plug.is_on
-            log.info(f'[main 1.80] got plug reading after changes: {socket_state}')
-        except:
-            print('cannot find plug')
-            log.info(f'[main 1.90] cannot read plug after changes')
-            socket_state = 'not found after changes'
-            continue
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        stop.set()
+        server.server_close()
+        # let a cycle under way finish writing before the logs are closed
+        if loop is not None:
+            loop.join()
+        with controller.lock:
+            csv_log.close()
+            if history is not None:
+                history.close()
+            if hasattr(plug, 'close'):
+                plug.close()
+        log.info('[dmn 9.00] daemon stopped')
+        listener.stop()
+    return 0
+
+
+def main_supervisor(sites, workers=None, interval=30,
+                    log_file='supervisor_log.csv', test_plug=False,
+                    daily_log_dir='daily_logs', timed_log_when='midnight',
+                    timed_log_interval=None, days_to_log=28, plug_cache_ttl=5,
+                    panel_deadline=5, panel_combine='sum',
+                    panel_stale_after=None, poll_jitter=0, report_every=None,
+                    log_flush_rows=1000, log_flush_secs=300, log_fsync=False,
+                    structured_log=False, metrics=None, metrics_port=None,
+                    rebalance_every=None, duration=None):
+    """
+    Run main_fleet()'s loop for many sites at once, sharded across workers
+    processes (default one per cpu), for fleets too big for one process.
+
+    sites is a list of dicts with keys:
+        name        used in the logs, and unique
+        panel_ip    the site's inverter(s), as for main()
+        loads       the site's plugs, as for main_fleet(); socket_port
+                    may be given too
+        reserve     as for main_fleet() (default 0)
+
+    Each worker polls its sites every interval seconds and reports to
+    this process every report_every seconds (default interval), which
+    writes the rows to log_file with SUPERVISOR_CSV_COLUMNS and keeps the
+    metrics (served on metrics_port as in main()).  Crashed or hung
+    workers are restarted, and sites are moved between workers every
+    rebalance_every seconds if some are much busier (see
+    pluggerlib.supervisor).  Runs until ctrl-c, or for duration seconds.
+    """
+    log, listener = setup_logging(daily_log_dir, timed_log_when,
+                                  timed_log_interval, days_to_log,
+                                  structured_log)
+    log.info('[sup 0.01] Calling main_supervisor, %s sites', len(sites))
+
+    if metrics is None:
+        metrics = NULL if metrics_port is None else Registry()
+    if metrics_port is not None:
+        serve(metrics, metrics_port)
+        log.info('[sup 0.02] serving metrics on port %s', metrics_port)
+
+    csv_log = BufferedCsvWriter(log_file, SUPERVISOR_CSV_COLUMNS,
+                                max_rows=log_flush_rows,
+                                max_age=log_flush_secs, fsync=log_fsync)
+
+    def on_report(worker_id, rows, counts):
+        switched = errors = 0
+        for row in rows:
+            csv_log.writerow(row)
+            if row[9] in ('activate', 'deactivate'):
+                switched += 1
+                log.info('[sup 1.20] *** %s %s %s ***', row[2], row[5], row[9])
+            if row[11]:
+                errors += 1
+                log.info('[sup 1.30] %s %s: %s', row[2], row[5], row[11])
+        print(time.strftime('%d/%m/%y %H:%M:%S'), f'worker {worker_id}:',
+              f'{len(counts)} sites, {len(rows)} rows,',
+              f'{switched} switched, {errors} errors')
+
+    supervisor = Supervisor(sites, workers=workers, interval=interval,
+                            on_report=on_report, log=log, metrics=metrics,
+                            report_every=report_every,
+                            rebalance_every=rebalance_every,
+                            poll_jitter=poll_jitter,
+                            plug_factory=make_test_plug if test_plug else None,
+                            plug_cache_ttl=plug_cache_ttl,
+                            panel_deadline=panel_deadline,
+                            panel_combine=panel_combine,
+                            panel_stale_after=panel_stale_after)
 
-        log_list.append(socket_state)
+    print('')
+    print('*'*12, 'PLUGGER SUPERVISOR MODE', '*'*12)
+    print('')
+    print('Sites:'.ljust(pads[0]), len(sites))
+    print('Plugs:'.ljust(pads[0]), sum(len(site['loads']) for site in sites))
+    print('Workers:'.ljust(pads[0]), len(supervisor.handles))
+    print('')
 
-        # write out log 
-        with open(log_file, 'a', newline="") as f:
-            writer = csv.writer(f, delimiter=",")
-            writer.writerow(log_list)
+    try:
+        supervisor.run(duration=duration)
+    finally:
+        csv_log.close()
+        log.info('[sup 9.10] supervisor exiting')
+        listener.stop()
+    return 0
+
+
+def make_test_plug(spec, cache_ttl=None):
+    """Returns a TestPlug, for the supervisor's workers to make"""
+    return TestPlug()
+
+
+def setup_logging(daily_log_dir, timed_log_when='midnight',
+                  timed_log_interval=None, days_to_log=28, structured=False):
+    """Returns tuple of the root logger, writing to a timed rotating file
+    in daily_log_dir (made if it doesn't exist), and the listener writing
+    it.
+
+    Records are queued and written by the listener's background thread,
+    and rotated files are gzipped off the loop too (see
+    pluggerlib.logpipe).  Stop the listener to flush the queue on the way
+    out; it is also stopped at exit.  With structured=True each line is
+    json, with the step id as a field.
+    """
+    file_path = os.path.join(daily_log_dir, 'log')
+    print(f'logging to: {file_path}')
 
-        # exit loop if only a single shot required
-        if single_shot:
-            return 0
+    log, listener = setup_log_pipe(daily_log_dir, timed_log_when,
+                                   timed_log_interval, days_to_log,
+                                   structured=structured)
+    return log, listener
 
-        log.info(f'[main 2.00] reached end of main loop')
-        time.sleep(interval)
-  
 
-def get_panel_output(panel_ip=None, target=None, log=None):
+def get_panel_output(panel_ip=None, target=None, log=None, reader=None):
     """Returns tuple of success flag and value.
     If success, value is the power output of the panel.
-    Otherwise it is the http response.
+    Otherwise it is the error message.
 
-    xml_text parameter is for testing (without getting url)
+    Reads through reader (a PanelReader) if passed, otherwise through one
+    kept per panel_ip and target, so the http connection is reused and
+    the read times out rather than hanging.
     """
 
-    log.info('[getp 0.00] calling get_panel_output')
-    url = 'http://' + panel_ip
-    log.info(f'[getp 0.10] making url {url}')
+    if reader is None:
+        key = (panel_ip, target)
+        if key not in _panel_readers:
+            _panel_readers[key] = PanelReader(panel_ip, tags=(target,))
+        reader = _panel_readers[key]
 
     try:
-        response = requests.get(url)
-        log.info(f'[getp 0.20] got response {response}')
-    except:
-        log.info(f'[getp 0.30] no response')
-        return False, "no response from " + url
+        return True, read_panel_output(reader, target, log)
+    except DeviceError as e:
+        return False, str(e)
 
-    if not response.ok:
-        return False, str(response)
 
-    xml_text = response.text
+def read_panel_output(reader, target=None, log=None):
+    """Returns the value of target (default the reader's first tag) from
+    one read of reader, raising DeviceError with the kind of failure if
+    the read fails
+    """
+    reading = reader.read(log)
 
-    result = None
+    if not reading.success:
+        raise DeviceError(reading.failure or 'error', reading.error)
 
-    try:
-        result = float(xml_text.split(target)[1][1:-2])
-    except:
-        return False, f'cannot find {target} in xml'
+    return reading.values[target or reader.tags[0]]
 
-    log.info('[getp 0.40] leaving get_panel_output')
-    return True, float(result) 
+
+_panel_readers = {}
 
 
 if __name__ == "__main__":
@@ -329,6 +915,28 @@ if __name__ == "__main__":
     elif len(sys.argv) == 1:
         main()
 
+    elif (len(sys.argv) == 3) & (sys.argv[1] == 'fleet'):
+        # config is a json file with main_fleet's arguments, eg:
+        #   {"panel_ip": "192.168.1.161/meters.xml", "interval": 60,
+        #    "loads": [{"name": "immersion", "socket_ip": "192.168.1.61",
+        #               "rated": 3.0, "priority": 0}, ...]}
+        with open(sys.argv[2]) as f:
+            main_fleet(**json.load(f))
+
+    elif (len(sys.argv) == 3) & (sys.argv[1] == 'supervisor'):
+        # config is a json file with main_supervisor's arguments, eg:
+        #   {"workers": 4, "interval": 30,
+        #    "sites": [{"name": "barn", "panel_ip": "192.168.1.161/meters.xml",
+        #               "loads": [{"name": "immersion", "socket_ip": "192.168.1.61",
+        #                          "rated": 3.0}, ...]}, ...]}
+        with open(sys.argv[2]) as f:
+            main_supervisor(**json.load(f))
+
+    elif (len(sys.argv) in (2, 3)) & (sys.argv[1] == 'daemon'):
+        # serve single shots etc from plugctl.py, running the loop itself
+        # too if given an interval
+        main_daemon(interval=int(sys.argv[2]) if len(sys.argv) == 3 else None)
+
     elif (len(sys.argv) == 2) & (sys.argv[1] == 'single'):
         main(single_shot=True, max_tries=100)
 
@@ -0,0 +1,3 @@
+"""
+Building blocks for plugger.py, the panel-driven smart plug controller.
+"""
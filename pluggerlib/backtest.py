@@ -0,0 +1,304 @@
+"""
+Replay switching policies over recorded panel output, to choose threshold
+and interval without running main() live for weeks.
+
+Policies are computed for all samples and many candidate settings at once
+with numpy, so a sweep over hundreds of thresholds on a year of 30 second
+readings takes well under a second, and hysteresis sweeps a few seconds.
+
+    $ python -m pluggerlib.backtest log.csv 0.2 3.0 0.1
+
+Units follow the log: panel output and load in kW, energy in kWh.
+"""
+import csv
+import time
+
+import numpy as np
+
+from pluggerlib.history import CSV_TIME_FORMAT, HistoryStore
+
+# most samples x candidates handled in one block, to bound memory
+BLOCK_CELLS = 16_000_000
+
+
+def load_series(source):
+    """Returns (ts, output) float64 arrays of the successful panel reads in
+    source, which is a HistoryStore, its directory, or a csv log path
+    """
+    if isinstance(source, str) and source.endswith('.csv'):
+        ts, output = [], []
+        with open(source, newline="") as f:
+            for row in csv.DictReader(f):
+                if row.get('panel_success') != 'True':
+                    continue
+                try:
+                    output.append(float(row['panel_output']))
+                    ts.append(time.mktime(time.strptime(row['datetime'],
+                                                        CSV_TIME_FORMAT)))
+                except ValueError:
+                    continue
+        ts = np.array(ts, dtype=np.float64)
+        output = np.array(output, dtype=np.float64)
+    else:
+        store = HistoryStore(source) if isinstance(source, str) else source
+        columns = store.query(columns=['ts', 'panel_success', 'panel_output'])
+        ok = np.frombuffer(columns['panel_success'], dtype=np.int8) == 1
+        ts = np.frombuffer(columns['ts'], dtype=np.int64)[ok].astype(np.float64)
+        output = np.frombuffer(columns['panel_output'], dtype=np.float64)[ok]
+
+    order = np.argsort(ts, kind='stable')
+    ts, output = ts[order], output[order]
+    keep = ~np.isnan(output)
+    return ts[keep], output[keep]
+
+
+def resample(ts, output, interval):
+    """Returns (ts, output) as main() would have seen polling every
+    interval seconds: the latest reading at or before each poll time
+    """
+    polls = np.arange(ts[0], ts[-1] + 1, interval)
+    idx = np.searchsorted(ts, polls, side='right') - 1
+    return polls, output[idx]
+
+
+def durations(ts, max_gap=None):
+    """Returns seconds each sample's decision holds for: until the next
+    sample, capped at max_gap (default 3 x the median spacing) so outages
+    in the log are not counted as time on.  The last sample gets the
+    median spacing.
+    """
+    if len(ts) < 2:
+        return np.zeros(len(ts))
+    gaps = np.diff(ts)
+    typical = np.median(gaps)
+    if max_gap is None:
+        max_gap = 3 * typical
+    return np.append(np.minimum(gaps, max_gap), typical)
+
+
+def threshold_states(output, thresholds):
+    """main()'s rule: on at each reading >= threshold, otherwise off.
+    Returns bool array (samples, thresholds).
+    """
+    return output[:, None] >= np.asarray(thresholds, dtype=np.float64)[None, :]
+
+
+def hysteresis_states(output, on_levels, off_levels, initial=False):
+    """Turn on at a reading >= on_level, off at a reading < off_level, and
+    otherwise stay as is.  Returns bool array (samples, candidates).
+
+    Vectorised by carrying forward the index of the last reading that
+    triggered either switch.
+    """
+    on_levels = np.asarray(on_levels, dtype=np.float64)[None, :]
+    off_levels = np.asarray(off_levels, dtype=np.float64)[None, :]
+    turn_on = output[:, None] >= on_levels
+    turn_off = output[:, None] < off_levels
+
+    rows = np.arange(len(output))[:, None]
+    last = np.where(turn_on | turn_off, rows, -1)
+    np.maximum.accumulate(last, axis=0, out=last)
+
+    cols = np.broadcast_to(np.arange(last.shape[1])[None, :], last.shape)
+    states = turn_on[np.maximum(last, 0), cols]
+    states[last < 0] = initial
+    return states
+
+
+def dwell_states(ts, wanted, min_on=0, min_off=0, initial=None):
+    """Hold each switch for at least min_on / min_off seconds before
+    following wanted (bool array (samples,) or (samples, candidates)) again.
+
+    The plug starts in initial at ts[0], so leaving it is held too; with
+    initial=None it starts in wanted's first state.
+
+    Dwell is path dependent, so this steps over runs of unchanged wanted
+    state rather than samples; it is fast when the input rarely changes,
+    as after hysteresis.
+    """
+    wanted = np.asarray(wanted, dtype=bool)
+    squeeze = wanted.ndim == 1
+    if squeeze:
+        wanted = wanted[:, None]
+    states = np.empty_like(wanted)
+
+    for k in range(wanted.shape[1]):
+        col = wanted[:, k]
+        change = np.flatnonzero(col[1:] != col[:-1]) + 1
+        starts = np.concatenate(([0], change))
+        state = col[0] if initial is None else bool(initial)
+        since = ts[0]       # when state was last switched
+        pos = 0
+        for start in starts:
+            if start < pos:
+                continue
+            want = col[start]
+            if want == state:
+                continue
+            # earliest sample at which the current state may be left
+            hold = min_on if state else min_off
+            earliest = np.searchsorted(ts, since + hold, side='left')
+            switch_at = max(start, earliest)
+            if switch_at >= len(col):
+                break
+            if switch_at > start:
+                # still wanted when the dwell runs out?
+                if col[switch_at] == state:
+                    continue
+            states[pos:switch_at, k] = state
+            state = not state
+            since = ts[switch_at]
+            pos = switch_at
+        states[pos:, k] = state
+
+    return states[:, 0] if squeeze else states
+
+
+def evaluate(ts, output, states, load, max_gap=None):
+    """Returns dict of per-candidate arrays scoring bool states
+    (samples, candidates) against panel output, for a load drawing load kW
+    (a scalar, or one per candidate):
+
+        switches        number of on/off changes
+        hours_on        time on
+        captured_kwh    load energy covered by the panel
+        imported_kwh    load energy drawn beyond the panel output
+        spilled_kwh     panel output not used by the load
+    """
+    hours = durations(ts, max_gap)[:, None] / 3600.0
+    load = np.broadcast_to(np.asarray(load, dtype=np.float64),
+                           (states.shape[1],))[None, :]
+    out = output[:, None]
+
+    covered = np.minimum(out, load)
+    on_hours = np.where(states, hours, 0.0)
+    return {
+        'switches': np.count_nonzero(states[1:] != states[:-1], axis=0),
+        'hours_on': on_hours.sum(axis=0),
+        'captured_kwh': (covered * on_hours).sum(axis=0),
+        'imported_kwh': ((load - covered) * on_hours).sum(axis=0),
+        'spilled_kwh': (out * hours).sum(axis=0)
+                       - (covered * on_hours).sum(axis=0),
+    }
+
+
+def _blocks(n_samples, n_candidates):
+    size = max(1, BLOCK_CELLS // max(1, n_samples))
+    for start in range(0, n_candidates, size):
+        yield slice(start, min(start + size, n_candidates))
+
+
+def _merge(parts):
+    return {key: np.concatenate([part[key] for part in parts])
+            for key in parts[0]}
+
+
+def sweep_thresholds(ts, output, thresholds, load=None, interval=None,
+                     max_gap=None):
+    """Score main()'s rule for every threshold, returning the same keys
+    as evaluate() plus 'threshold'.
+
+    load defaults to each threshold itself, ie a load that just fits the
+    output at which it is switched on.  If interval is given the series is
+    first resampled to that polling interval.
+
+    No (samples x thresholds) matrix is built: with the readings sorted
+    once, each total is a tail sum found by binary search, and a pair of
+    consecutive readings switches the plug exactly when the threshold lies
+    in (lower, higher] of the pair.
+    """
+    if interval is not None:
+        ts, output = resample(ts, output, interval)
+    thresholds = np.asarray(thresholds, dtype=np.float64)
+    loads = thresholds if load is None else np.broadcast_to(
+        np.asarray(load, dtype=np.float64), thresholds.shape)
+
+    hours = durations(ts, max_gap) / 3600.0
+    order = np.argsort(output, kind='stable')
+    ordered = output[order]
+
+    def tail_sum(weights):
+        # x -> sum of weights where output >= x
+        sums = np.append(np.cumsum(weights[order][::-1])[::-1], 0.0)
+        return lambda x: sums[np.searchsorted(ordered, x, side='left')]
+
+    hours_above = tail_sum(hours)
+    kwh_above = tail_sum(hours * output)
+
+    hours_on = hours_above(thresholds)
+    captured = np.where(loads > thresholds,
+                        kwh_above(thresholds) - kwh_above(loads)
+                        + loads * hours_above(loads),
+                        loads * hours_on)
+
+    lower = np.sort(np.minimum(output[:-1], output[1:]))
+    higher = np.sort(np.maximum(output[:-1], output[1:]))
+    switches = (np.searchsorted(lower, thresholds, side='left')
+                - np.searchsorted(higher, thresholds, side='left'))
+
+    return {
+        'switches': switches,
+        'hours_on': hours_on,
+        'captured_kwh': captured,
+        'imported_kwh': loads * hours_on - captured,
+        'spilled_kwh': (hours * output).sum() - captured,
+        'threshold': thresholds,
+    }
+
+
+def sweep_hysteresis(ts, output, on_levels, bands, load=None, min_on=0,
+                     min_off=0, interval=None):
+    """Score hysteresis (on at on_level, off below on_level - band), with
+    optional minimum on and off times, for every on_level x band pair.
+    """
+    if interval is not None:
+        ts, output = resample(ts, output, interval)
+    on_grid, band_grid = np.meshgrid(np.asarray(on_levels, dtype=np.float64),
+                                     np.asarray(bands, dtype=np.float64),
+                                     indexing='ij')
+    on_levels = on_grid.ravel()
+    bands = band_grid.ravel()
+    loads = on_levels if load is None else np.broadcast_to(load, on_levels.shape)
+
+    parts = []
+    for block in _blocks(len(output), len(on_levels)):
+        states = hysteresis_states(output, on_levels[block],
+                                   on_levels[block] - bands[block])
+        if min_on or min_off:
+            states = dwell_states(ts, states, min_on, min_off)
+        parts.append(evaluate(ts, output, states, loads[block]))
+    result = _merge(parts)
+    result['on_level'] = on_levels
+    result['band'] = bands
+    return result
+
+
+def print_table(result, keys):
+    """Print one line per candidate"""
+    columns = keys + ['switches', 'hours_on', 'captured_kwh', 'imported_kwh']
+    print(' '.join(col.rjust(13) for col in columns))
+    for i in range(len(result[keys[0]])):
+        print(' '.join(f'{result[col][i]:13.3f}'.replace('.000', '    ')
+                       for col in columns))
+
+
+if __name__ == "__main__":
+    import sys
+
+    if len(sys.argv) not in (5, 6):
+        print('usage: python -m pluggerlib.backtest log.csv|history_dir'
+              ' low high step [interval]')
+        sys.exit(1)
+
+    ts, output = load_series(sys.argv[1])
+    thresholds = np.arange(float(sys.argv[2]), float(sys.argv[3]),
+                           float(sys.argv[4]))
+    interval = float(sys.argv[5]) if len(sys.argv) == 6 else None
+
+    start = time.perf_counter()
+    result = sweep_thresholds(ts, output, thresholds, interval=interval)
+    elapsed = time.perf_counter() - start
+
+    print_table(result, ['threshold'])
+    print(f'\n{len(thresholds)} thresholds x {len(output)} samples'
+          f' in {elapsed:.2f}s')
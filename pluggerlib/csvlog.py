@@ -0,0 +1,110 @@
+"""
+A long-lived csv log writer that buffers rows and writes them in batches,
+so an SD card sees one write every few minutes rather than an open, write
+and close every cycle.
+"""
+import atexit
+import csv
+import os
+import time
+
+
+def read_header(path):
+    """Returns the first row of the csv file at path, [] if it is empty"""
+    with open(path, newline="") as f:
+        return next(csv.reader(f), [])
+
+
+def rotated_path(path):
+    """Returns a free name for path's file to be moved to, stamped with
+    its modification time
+    """
+    root, ext = os.path.splitext(path)
+    stamp = time.strftime('%Y%m%d-%H%M%S',
+                          time.localtime(os.path.getmtime(path)))
+    rotated = f'{root}.{stamp}{ext}'
+    n = 1
+    while os.path.exists(rotated):
+        rotated = f'{root}.{stamp}-{n}{ext}'
+        n += 1
+    return rotated
+
+
+class BufferedCsvWriter:
+    # append rows to a csv file in batches
+    def __init__(self, path, columns=None, max_rows=10, max_age=300,
+                 fsync=False):
+        """
+        Rows are held in memory and written when max_rows are buffered, or
+        when a row arrives and the oldest buffered row is max_age seconds
+        old.  Anything still buffered is written by close(), which also
+        runs at interpreter exit, so use the writer as a context manager or
+        close it in a finally block to keep rows through ctrl-c and errors.
+
+        columns are written as a header if the file does not exist yet.
+        If it exists with a different header, as after columns are added,
+        it is renamed with its modification time added to the name (eg
+        log.20240601-120000.csv) and a new file started, so rows never sit
+        under the wrong header.  With fsync=True each batch is forced to
+        disk before returning, otherwise it is left to the OS.
+        """
+        self.path = path
+        self.max_rows = max_rows
+        self.max_age = max_age
+        self.fsync = fsync
+        self.rows = []
+        self.oldest = None
+        self.closed = False
+
+        if columns is not None:
+            header = read_header(path) if os.path.exists(path) else []
+            if header and header != list(columns):
+                os.rename(path, rotated_path(path))
+            if not os.path.exists(path) or not os.path.getsize(path):
+                self.rows.append(list(columns))
+                self.flush()
+
+        atexit.register(self.close)
+
+    def writerow(self, row):
+        """Buffer a row, writing the batch out if it is due"""
+        if self.closed:
+            raise ValueError(f'writer for {self.path} is closed')
+        if not self.rows:
+            self.oldest = time.monotonic()
+        self.rows.append(list(row))
+
+        if (len(self.rows) >= self.max_rows
+                or time.monotonic() - self.oldest >= self.max_age):
+            self.flush()
+
+    def writerows(self, rows):
+        for row in rows:
+            self.writerow(row)
+
+    def flush(self):
+        """Write out all buffered rows"""
+        if not self.rows:
+            return
+        with open(self.path, 'a', newline="") as f:
+            writer = csv.writer(f, delimiter=",")
+            writer.writerows(self.rows)
+            if self.fsync:
+                f.flush()
+                os.fsync(f.fileno())
+        self.rows = []
+        self.oldest = None
+
+    def close(self):
+        """Write out buffered rows and stop accepting more"""
+        if self.closed:
+            return
+        self.flush()
+        self.closed = True
+        atexit.unregister(self.close)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -0,0 +1,257 @@
+"""
+A resident controller answering requests on a unix domain socket.
+
+One long-lived process owns the plug, the panel reader and the log files,
+so a single shot from a scheduler costs a socket round trip and the
+cycle's own network i/o, not a python start-up, imports, log set-up and a
+fresh plug handshake.
+
+The protocol is one json object per line each way:
+
+    {"cmd": "single"}   run one control cycle now, returning its result
+    {"cmd": "status"}   the last cycle, counts and uptime
+    {"cmd": "on"}       switch the plug on (and "off")
+    {"cmd": "ping"}
+    {"cmd": "stop"}     shut the daemon down
+
+Replies are {"ok": true, ...} or {"ok": false, "error": "..."}.  This
+module only imports the standard library, so clients (see plugctl.py)
+can use request() without loading the controller's dependencies.
+"""
+import json
+import os
+import socket
+import socketserver
+import threading
+import time
+import traceback
+
+from pluggerlib.retry import DeviceError, Guard, RetryPolicy
+
+DEFAULT_SOCKET = os.environ.get('PLUGGER_SOCKET', '/tmp/plugger.sock')
+
+CSV_TIME_FORMAT = '%d/%m/%y %H:%M:%S'
+
+
+def request(cmd, socket_path=DEFAULT_SOCKET, timeout=30, **args):
+    """Send one command to the daemon at socket_path, returning its reply
+    as a dict
+    """
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(timeout)
+    try:
+        sock.connect(socket_path)
+        sock.sendall(json.dumps(dict(args, cmd=cmd)).encode() + b'\n')
+        with sock.makefile('rb') as f:
+            line = f.readline()
+    finally:
+        sock.close()
+    if not line:
+        raise ConnectionError('daemon closed the connection without replying')
+    return json.loads(line)
+
+
+class Controller:
+    # the control decision of main(), kept warm between requests
+    def __init__(self, plug, panel, threshold, csv_log=None, history=None,
+                 log=None, clock=time.time, panel_guard=None, plug_guard=None,
+                 decider=None, monotonic=time.monotonic):
+        """
+        plug is a SmartPlug (ideally persistent, with a cache_ttl), panel
+        has a read(log) method returning a PanelReading, as from
+        pluggerlib.panel.make_panel.  Each cycle writes a row of
+        plugger.CSV_COLUMNS to csv_log and history if given, failed ones
+        included.  panel_guard and plug_guard are pluggerlib.retry.Guards
+        to call the devices through (default: one try, no breaker).
+        decider is a pluggerlib.decide.Engine to switch by, as in main().
+        """
+        self.plug = plug
+        self.panel = panel
+        self.threshold = threshold
+        self.csv_log = csv_log
+        self.history = history
+        self.log = log
+        self.clock = clock
+        self.panel_guard = panel_guard or Guard('panel', RetryPolicy(attempts=1))
+        self.plug_guard = plug_guard or Guard('plug', RetryPolicy(attempts=1))
+        self.decider = decider
+        self.monotonic = monotonic
+        self.lock = threading.Lock()
+        self.started = clock()
+        self.cycles = 0
+        self.failures = 0
+        self.switches = 0
+        self.last = None
+
+    def _info(self, msg, *args):
+        if self.log is not None:
+            self.log.info(msg, *args)
+
+    def cycle(self, mode='single', stop=None):
+        """Read the panel and plug, switch if needed and log the row, as one
+        loop of main().  Returns dict of the row's fields, plus error (None
+        if the cycle completed, otherwise the message; failure is its kind),
+        or None if the stop event was set while waiting for the lock.
+        """
+        with self.lock:
+            if stop is not None and stop.is_set():
+                return None
+            result = self._cycle(mode)
+            self.cycles += 1
+            if result['error'] is not None:
+                self.failures += 1
+            self.last = result
+            return result
+
+    def _cycle(self, mode):
+        now = self.clock()
+        ts = time.strftime(CSV_TIME_FORMAT, time.localtime(now))
+        result = {'datetime': ts, 'mode': mode, 'panel_success': False,
+                  'panel_output': None, 'socket_state': None, 'action': None,
+                  'socket_state1': None, 'failure': None, 'error': None}
+        try:
+            self._decide(result)
+        except DeviceError as e:
+            result['error'] = str(e)
+            result['failure'] = result.pop('device') + ' ' + e.kind
+            self._info('[dmn 0.90] %s: %s', result['failure'], e)
+        result.pop('device', None)
+
+        row = [result[col] for col in ('datetime', 'mode', 'panel_success',
+                                       'panel_output', 'socket_state',
+                                       'action', 'socket_state1', 'failure')]
+        if self.csv_log is not None:
+            self.csv_log.writerow(row)
+        if self.history is not None:
+            self.history.writerow(row, now)
+        return result
+
+    def _decide(self, result):
+        # fills in result, raising DeviceError with result['device'] set to
+        # the device that failed
+        plug, panel = self.plug, self.panel
+
+        def read_panel():
+            reading = panel.read(self.log)
+            if not reading.success:
+                raise DeviceError(reading.failure or 'error', reading.error)
+            return reading.values[panel.tags[0]]
+
+        result['device'] = 'panel'
+        output = self.panel_guard.call(read_panel)
+        result.update(panel_success=True, panel_output=output, device='plug')
+
+        state = result['socket_state'] = self.plug_guard.call(lambda: plug.is_on)
+        want = output >= self.threshold
+        if self.decider is not None:
+            decision = self.decider.decide(self.monotonic(), output, state,
+                                           self.threshold)
+            want = decision.want
+            if decision.held is not None:
+                self._info('[dmn 1.10] %s held plug %s', decision.held,
+                           'on' if state else 'off')
+        if want == state:
+            result['action'] = 'leave on' if state else 'leave off'
+        else:
+            self.plug_guard.call(plug.turn_on if want else plug.turn_off)
+            result['action'] = 'activate' if want else 'deactivate'
+            self.switches += 1
+            self._info('[dmn 1.20] *** %s ***', result['action'])
+        result['socket_state1'] = self.plug_guard.call(lambda: plug.is_on)
+
+    def switch(self, on):
+        """Switch the plug by hand, returning its state after"""
+        with self.lock:
+            self.plug.turn_on() if on else self.plug.turn_off()
+            self._info('[dmn 2.00] manual switch %s', 'on' if on else 'off')
+            return self.plug.is_on
+
+    def status(self):
+        with self.lock:
+            return {'threshold': self.threshold,
+                    'uptime': self.clock() - self.started,
+                    'cycles': self.cycles,
+                    'failures': self.failures,
+                    'switches': self.switches,
+                    'last': self.last,
+                    'suppressed': None if self.decider is None
+                                  else dict(self.decider.suppressed),
+                   }
+
+    def handle(self, message):
+        """Returns the reply to one decoded request"""
+        cmd = message.get('cmd')
+        if cmd == 'ping':
+            return {'ok': True}
+        if cmd == 'single':
+            result = self.cycle('single')
+            return dict(result, ok=result['error'] is None)
+        if cmd == 'status':
+            return dict(self.status(), ok=True)
+        if cmd in ('on', 'off'):
+            return {'ok': True, 'socket_state': self.switch(cmd == 'on')}
+        return {'ok': False, 'error': f'unknown command {cmd!r}'}
+
+
+class _Handler(socketserver.StreamRequestHandler):
+    def handle(self):
+        for line in self.rfile:
+            try:
+                message = json.loads(line)
+                if message.get('cmd') == 'stop':
+                    reply = {'ok': True}
+                    threading.Thread(target=self.server.shutdown).start()
+                else:
+                    reply = self.server.controller.handle(message)
+            except Exception as e:
+                reply = {'ok': False, 'error': repr(e)}
+            self.wfile.write(json.dumps(reply).encode() + b'\n')
+            self.wfile.flush()
+
+
+class ControlServer(socketserver.ThreadingUnixStreamServer):
+    # serves a Controller on a unix domain socket
+    daemon_threads = True
+
+    def __init__(self, controller, socket_path=DEFAULT_SOCKET):
+        """
+        Refuses to start if another daemon is answering on socket_path,
+        and replaces a stale socket file left by one that died.
+        """
+        if os.path.exists(socket_path):
+            try:
+                request('ping', socket_path, timeout=2)
+            except OSError:
+                os.unlink(socket_path)
+            else:
+                raise RuntimeError(f'a daemon is already running on {socket_path}')
+        self.controller = controller
+        self.socket_path = socket_path
+        super().__init__(socket_path, _Handler)
+        os.chmod(socket_path, 0o600)
+
+    def server_close(self):
+        super().server_close()
+        try:
+            os.unlink(self.socket_path)
+        except FileNotFoundError:
+            pass
+
+
+def run_loop(controller, scheduler, stop):
+    """Run continuous cycles on scheduler until the stop event is set.  A
+    cycle that fails other than on a device is logged and the loop goes on.
+    """
+    scheduler.start()
+    while not stop.is_set():
+        try:
+            result = controller.cycle('cont', stop)
+        except Exception:
+            controller._info('[dmn 0.95] cycle failed:\n%s',
+                             traceback.format_exc())
+            result = {'panel_success': False}
+        if result is None:
+            break
+        scheduler.update(result['panel_output'] if result['panel_success']
+                         else None)
+        scheduler.wait()
@@ -0,0 +1,402 @@
+"""
+Switching decisions from a rolling window of panel readings, rather than
+the single `output >= threshold` comparison main() makes, so a passing
+cloud does not cost an off and an on, with their plug round trips and
+relay wear.
+
+An Engine runs up to three stages, each optional:
+
+    signal      what is compared with the threshold: the latest reading,
+                an Ewma of the readings, or a Trend forecast a little ahead
+    band        hysteresis: on at signal >= threshold, off only once it is
+                below threshold - band
+    dwell       min_on / min_off seconds to hold each switch before the
+                next is allowed
+
+Live, Engine.decide() is pure python over a small preallocated window, so
+main() needs nothing more.  Engine.states() runs the same stages over a
+whole series at once with numpy, reusing the backtest's hysteresis and
+dwell helpers, and score() compares engines on recorded output:
+
+    ts, output = backtest.load_series('log.csv')
+    score(ts, output, [Engine(), Engine(Ewma(300), band=0.2)], threshold=0.7)
+
+Both count the switches the policy suppressed: readings at which the
+plain threshold rule would have switched the plug but the engine held it.
+Live and batch runs give the same states for the same series and starting
+state; to check that on random series:
+
+    $ python -m pluggerlib.decide
+"""
+import math
+from array import array
+from collections import namedtuple
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# most rows of a sliding window handled in one block, to bound memory
+BLOCK_ROWS = 1_000_000
+
+# largest decay (in time constants) within one block of the batch ewma,
+# keeping exp(decay) well inside float range
+EWMA_SPAN = 50.0
+
+# want is whether the plug should be on; signal is the value compared with
+# the threshold; held is the stage that kept the plug from switching where
+# the plain threshold rule would have ('signal', 'band' or 'dwell'), or None
+Decision = namedtuple('Decision', ['want', 'signal', 'held'])
+
+
+class Window:
+    # the last size readings, in preallocated arrays overwritten in turn
+    def __init__(self, size=32):
+        if size < 1:
+            raise ValueError('size must be at least 1')
+        self.size = size
+        self.ts = array('d', bytes(8 * size))
+        self.values = array('d', bytes(8 * size))
+        self.count = 0      # readings held, at most size
+        self.head = 0       # slot the next reading goes in
+
+    def __len__(self):
+        return self.count
+
+    def append(self, ts, value):
+        self.ts[self.head] = ts
+        self.values[self.head] = value
+        self.head = (self.head + 1) % self.size
+        if self.count < self.size:
+            self.count += 1
+
+    def latest(self, n=None):
+        """Returns (ts, values) lists of the newest n readings (default all),
+        oldest first
+        """
+        n = self.count if n is None else min(n, self.count)
+        start = (self.head - n) % self.size
+        if start + n <= self.size:
+            return list(self.ts[start:start + n]), list(self.values[start:start + n])
+        wrap = start + n - self.size
+        return (list(self.ts[start:]) + list(self.ts[:wrap]),
+                list(self.values[start:]) + list(self.values[:wrap]))
+
+    def clear(self):
+        self.count = 0
+        self.head = 0
+
+
+class Latest:
+    # the newest reading as is: main()'s own signal
+    def reset(self):
+        pass
+
+    def update(self, window):
+        return window.values[(window.head - 1) % window.size]
+
+    def batch(self, ts, output):
+        return output
+
+
+class Ewma:
+    # exponentially weighted mean, with time constant tau seconds
+    def __init__(self, tau):
+        """
+        Weights fall by e every tau seconds, and are spaced by the time
+        between readings, so a missed poll counts for what it was.
+        """
+        if tau <= 0:
+            raise ValueError('tau must be positive')
+        self.tau = tau
+        self.reset()
+
+    def reset(self):
+        self.value = None
+        self.last = None
+
+    def update(self, window):
+        i = (window.head - 1) % window.size
+        ts, value = window.ts[i], window.values[i]
+        if self.value is None:
+            self.value = value
+        else:
+            alpha = 1 - math.exp(-max(0.0, ts - self.last) / self.tau)
+            self.value += alpha * (value - self.value)
+        self.last = ts
+        return self.value
+
+    def batch(self, ts, output):
+        """Returns the ewma after each reading, as update() would.
+
+        s[i] = sum over j <= i of a[j] x[j] exp(-(L[i] - L[j])), with L
+        the cumulative decay, is a cumulative sum once scaled by exp(L[j]).
+        That is done in blocks of at most EWMA_SPAN decay, carrying the
+        ewma across, so the scale never overflows.
+        """
+        if not len(output):
+            return numpy.empty(0)
+        decay = numpy.diff(ts, prepend=ts[:1]) / self.tau
+        numpy.maximum(decay, 0, out=decay)
+        weight = -numpy.expm1(-decay)
+        weight[:1] = 1.0
+        level = numpy.cumsum(decay)
+        bounds = numpy.searchsorted(level, numpy.arange(EWMA_SPAN, level[-1] + EWMA_SPAN, EWMA_SPAN))
+        result = numpy.empty(len(output))
+        carry, start = 0.0, 0
+        for stop in list(bounds) + [len(output)]:
+            if stop <= start:
+                continue
+            rel = level[start:stop] - level[start]
+            scaled = numpy.cumsum(weight[start:stop] * output[start:stop] * numpy.exp(rel))
+            result[start:stop] = numpy.exp(-rel) * (scaled + carry * math.exp(-decay[start]))
+            carry, start = result[stop - 1], stop
+        return result
+
+
+class Trend:
+    # a straight line fitted to the last samples readings, projected ahead
+    def __init__(self, horizon, samples=8):
+        """
+        Forecasts the output horizon seconds after the newest reading, eg
+        one poll interval, so the plug goes off as output falls through the
+        threshold rather than a poll after.
+        """
+        if samples < 2:
+            raise ValueError('need at least 2 samples for a trend')
+        self.horizon = horizon
+        self.samples = samples
+
+    def reset(self):
+        pass
+
+    def update(self, window):
+        ts, values = window.latest(self.samples)
+        return forecast(ts, values, self.horizon)
+
+    def batch(self, ts, output):
+        """Returns the forecast after each reading, as update() would: from
+        the readings so far until there are samples of them, then from a
+        window sliding over a (readings, samples) strided view.
+        """
+        n = self.samples
+        result = numpy.empty(len(output))
+        head = min(n - 1, len(output))
+        for i in range(head):
+            result[i] = forecast(ts[:i + 1], output[:i + 1], self.horizon)
+        if len(output) < n:
+            return result
+        windows_ts = numpy.lib.stride_tricks.sliding_window_view(ts, n)
+        windows = numpy.lib.stride_tricks.sliding_window_view(output, n)
+        for start in range(0, len(windows), BLOCK_ROWS):
+            t = windows_ts[start:start + BLOCK_ROWS]
+            x = windows[start:start + BLOCK_ROWS]
+            # times relative to the newest reading, for precision
+            t = t - t[:, -1:]
+            t_mean = t.mean(axis=1, keepdims=True)
+            x_mean = x.mean(axis=1, keepdims=True)
+            dt = t - t_mean
+            var = (dt * dt).sum(axis=1)
+            cov = (dt * (x - x_mean)).sum(axis=1)
+            slope = numpy.divide(cov, var, out=numpy.zeros_like(cov), where=var > 0)
+            result[head + start:head + start + len(x)] = (
+                x_mean[:, 0] + slope * (self.horizon - t_mean[:, 0]))
+        return result
+
+
+def forecast(ts, values, horizon):
+    """Returns the least squares line through (ts, values), horizon seconds
+    after the last of them; the mean if they are all at one time
+    """
+    n = len(values)
+    t_last = ts[n - 1]
+    t_mean = sum(t - t_last for t in ts) / n
+    x_mean = sum(values) / n
+    var = cov = 0.0
+    for t, x in zip(ts, values):
+        dt = t - t_last - t_mean
+        var += dt * dt
+        cov += dt * (x - x_mean)
+    slope = cov / var if var > 0 else 0.0
+    return x_mean + slope * (horizon - t_mean)
+
+
+class Engine:
+    # decides the plug's state from a window of readings, live or in batch
+    def __init__(self, signal=None, band=0.0, min_on=0, min_off=0, size=32):
+        """
+        signal is Latest() (the default), Ewma(tau) or Trend(horizon),
+        band the hysteresis below the threshold before switching off, and
+        min_on and min_off the seconds each switch is held for.  size is
+        the readings kept; it only needs to cover a Trend's samples.
+        """
+        self.signal = Latest() if signal is None else signal
+        self.band = band
+        self.min_on = min_on
+        self.min_off = min_off
+        self.window = Window(size)
+        self.suppressed = {'signal': 0, 'band': 0, 'dwell': 0}
+        self.switches = 0
+        self.reset()
+
+    def reset(self):
+        """Forget the readings and states, keeping the counts"""
+        self.window.clear()
+        self.signal.reset()
+        self.wanted = None      # the hysteresis stage's state
+        self.state = None       # the plug's state, as last decided
+        self.since = None       # when it last switched
+
+    @property
+    def total_suppressed(self):
+        return sum(self.suppressed.values())
+
+    def decide(self, now, value, state, threshold):
+        """Returns a Decision on the plug's state given a new reading value
+        at time now, the plug's current state (True for on) and threshold.
+        """
+        self.window.append(now, value)
+        signal = self.signal.update(self.window)
+
+        # the plug switched other than as last decided, by hand or failing
+        if self.state is None or bool(state) != self.state:
+            self.since = now
+        self.state = bool(state)
+        if self.wanted is None:
+            self.wanted = self.state
+
+        # hysteresis, on its own state so it matches the batch run
+        if signal >= threshold:
+            self.wanted = True
+        elif signal < threshold - self.band:
+            self.wanted = False
+        want = self.wanted
+
+        # dwell, on the plug's state
+        hold = self.min_on if self.state else self.min_off
+        dwelling = want != self.state and now - self.since < hold
+        if dwelling:
+            want = self.state
+
+        held = None
+        if (value >= threshold) != self.state and want == self.state:
+            if dwelling:
+                held = 'dwell'
+            elif (signal >= threshold) != self.state:
+                held = 'band'
+            else:
+                held = 'signal'
+            self.suppressed[held] += 1
+        if want != self.state:
+            self.switches += 1
+            self.state = want
+            self.since = now
+        return Decision(want, signal, held)
+
+    def states(self, ts, output, threshold, initial=False):
+        """Returns bool array of the state after each reading of a series
+        (float arrays ts, output), as decide() would have left the plug
+        starting from initial, if every switch were made.
+        """
+        from pluggerlib.backtest import dwell_states, hysteresis_states
+
+        signal = self.signal.batch(ts, output)
+        states = hysteresis_states(signal, [threshold], [threshold - self.band],
+                                   initial)[:, 0]
+        if self.min_on or self.min_off:
+            states = dwell_states(ts, states, self.min_on, self.min_off,
+                                  initial)
+        return states
+
+    def replay(self, ts, output, threshold, initial=False):
+        """Returns list of the states decide() gives over a series, the plug
+        starting in initial and making every switch; the engine is reset
+        first, so this is what states() computes in batch
+        """
+        self.reset()
+        state = initial
+        states = []
+        for now, value in zip(ts, output):
+            state = self.decide(now, value, state, threshold).want
+            states.append(state)
+        return states
+
+
+def suppressed_counts(output, states, threshold, initial=False):
+    """Returns the number of readings at which the threshold rule would
+    have switched from the previous state in states (bool array (samples,
+    candidates)) but the state was kept, per candidate
+    """
+    before = numpy.vstack([numpy.full((1, states.shape[1]), initial), states[:-1]])
+    raw = (output >= threshold)[:, None]
+    return numpy.count_nonzero((raw != before) & (states == before), axis=0)
+
+
+def score(ts, output, engines, threshold, load=None, interval=None, max_gap=None):
+    """Score each of engines over a recorded series, returning the keys of
+    backtest.evaluate() (one value per engine) plus
+
+        suppressed      readings where a threshold switch was held back
+        raw_switches    switches the plain threshold rule makes
+
+    load defaults to threshold.  If interval is given the series is first
+    resampled to that polling interval.
+    """
+    from pluggerlib.backtest import evaluate, resample, threshold_states
+
+    if interval is not None:
+        ts, output = resample(ts, output, interval)
+    ts = numpy.asarray(ts, dtype=numpy.float64)
+    output = numpy.asarray(output, dtype=numpy.float64)
+    states = numpy.column_stack([engine.states(ts, output, threshold)
+                                 for engine in engines])
+    result = evaluate(ts, output, states, threshold if load is None else load,
+                      max_gap)
+    raw = threshold_states(output, [threshold])
+    result['suppressed'] = suppressed_counts(output, states, threshold)
+    result['raw_switches'] = numpy.repeat(
+        numpy.count_nonzero(raw[1:] != raw[:-1]), len(engines))
+    return result
+
+
+def mismatch(engine, ts, output, threshold, initial=False):
+    """Returns the index of the first reading at which engine's live run
+    (replay()) and batch run (states()) differ, or None if they agree
+    """
+    live = numpy.array(engine.replay(ts, output, threshold, initial), dtype=bool)
+    batch = engine.states(ts, output, threshold, initial)
+    differ = numpy.flatnonzero(live != batch)
+    return int(differ[0]) if len(differ) else None
+
+
+if __name__ == "__main__":
+    import sys
+
+    # check live and batch runs agree on random series, starting both on
+    # and off, above and below the threshold
+    rng = numpy.random.default_rng(int(sys.argv[1]) if len(sys.argv) > 1 else 0)
+    makers = [lambda: Engine(),
+              lambda: Engine(Ewma(300)),
+              lambda: Engine(Trend(30, 6), band=0.1),
+              lambda: Engine(min_off=60),
+              lambda: Engine(min_on=90, min_off=60),
+              lambda: Engine(Ewma(120), band=0.2, min_on=300, min_off=120),
+              lambda: Engine(Trend(60), band=0.1, min_on=200)]
+    runs = failed = 0
+    for trial in range(50):
+        n = int(rng.integers(2, 400))
+        ts = numpy.cumsum(rng.uniform(10, 60, n))
+        output = 1 + rng.uniform(-0.5, 0.5) + 0.6 * numpy.sin(ts / rng.uniform(500, 5000)) \
+            + rng.normal(0, 0.3, n)
+        for initial in (False, True):
+            for make in makers:
+                engine = make()
+                at = mismatch(engine, ts, output, 1.0, initial)
+                runs += 1
+                if at is not None:
+                    failed += 1
+                    print(f'trial {trial}: {vars(engine)} initial={initial}'
+                          f' differs at reading {at}')
+    print(f'{runs - failed} of {runs} live and batch runs agree')
+    sys.exit(1 if failed else 0)
@@ -0,0 +1,109 @@
+"""
+Share out panel output across several plugs by priority and rated power,
+and run one control cycle over all of them concurrently.
+"""
+from concurrent.futures import ThreadPoolExecutor
+
+
+class Load:
+    # one switchable load: a plug and what it draws when on
+    def __init__(self, name, plug, rated, priority=0):
+        """
+        name is used in the logs, plug is a SmartPlug (or TestPlug), rated
+        is the power drawn when on, in the same units as the panel output.
+        Lower priority numbers are served first.
+        """
+        self.name = name
+        self.plug = plug
+        self.rated = rated
+        self.priority = priority
+
+    def __repr__(self):
+        return f'Load({self.name!r}, rated={self.rated}, priority={self.priority})'
+
+
+def allocate(available, loads):
+    """Returns dict of load name to wanted on/off state.
+
+    Loads are taken in priority order, and each one is switched on if its
+    rated power fits in what is still available.  A load that does not fit
+    does not block smaller, lower priority loads behind it.
+
+    With a single load whose rating is the threshold, this is the same
+    decision as main(): on if panel output >= threshold.
+    """
+    wanted = {}
+    for load in sorted(loads, key=lambda x: x.priority):
+        if load.rated <= available:
+            wanted[load.name] = True
+            available -= load.rated
+        else:
+            wanted[load.name] = False
+    return wanted
+
+
+class FleetController:
+    # applies allocations to a set of loads, talking to all plugs at once
+    def __init__(self, loads, reserve=0, max_workers=None):
+        """
+        reserve is panel output kept back for the rest of the house, and is
+        not offered to any load.
+        """
+        names = [load.name for load in loads]
+        if len(set(names)) != len(names):
+            raise ValueError(f'load names must be unique: {names}')
+
+        self.loads = list(loads)
+        self.reserve = reserve
+        self.executor = ThreadPoolExecutor(max_workers=max(1, max_workers or len(self.loads)),
+                                           thread_name_prefix='fleet')
+
+    def cycle(self, panel_output):
+        """Returns list of one result dict per load, in load order.
+
+        Each plug is read, switched if needed and read again in its own
+        worker, so a cycle takes as long as the slowest plug.
+        """
+        wanted = allocate(panel_output - self.reserve, self.loads)
+        futures = [self.executor.submit(self.apply, load, wanted[load.name])
+                   for load in self.loads]
+        return [future.result() for future in futures]
+
+    def apply(self, load, want_on):
+        """Returns dict with the plug state before and after, and the action"""
+        result = {'plug': load.name,
+                  'rated': load.rated,
+                  'priority': load.priority,
+                  'socket_state': None,
+                  'action': None,
+                  'socket_state1': None,
+                  'error': None,
+                 }
+        step = 'read'
+        try:
+            socket_state = load.plug.is_on
+            result['socket_state'] = socket_state
+
+            if want_on and socket_state:
+                result['action'] = 'leave on'
+            elif want_on:
+                step = 'turn on'
+                load.plug.turn_on()
+                result['action'] = 'activate'
+            elif socket_state:
+                step = 'turn off'
+                load.plug.turn_off()
+                result['action'] = 'deactivate'
+            else:
+                result['action'] = 'leave off'
+
+            step = 'read after changes'
+            result['socket_state1'] = load.plug.is_on
+
+        except Exception as e:
+            result['error'] = f'cannot {step}: {type(e).__name__}: {e}'
+
+        return result
+
+    def close(self):
+        self.executor.shutdown(wait=False)
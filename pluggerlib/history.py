@@ -0,0 +1,324 @@
+"""
+A compact, append-only columnar store for the control log.
+
+Each column is a file of fixed-width binary values, and rows are split into
+chunks of up to chunk_rows rows, one directory per chunk:
+
+    history/
+        index.json              first and last timestamp and rows per chunk
+        000000/ts.q             int64 epoch seconds
+        000000/panel_output.d   float64
+        000000/socket_state.b   int8, 1 on, 0 off, -1 unknown
+        ...
+
+Queries look up the chunks covering a time range in the index and
+memory-map only those column files.
+"""
+import csv
+import json
+import logging
+import math
+import mmap
+import os
+import time
+from array import array
+from bisect import bisect_left
+
+# column name and array typecode, in row order
+SCHEMA = [('ts', 'q'),
+          ('mode', 'b'),
+          ('panel_success', 'b'),
+          ('panel_output', 'd'),
+          ('socket_state', 'b'),
+          ('action', 'b'),
+          ('socket_state1', 'b'),
+         ]
+
+COLUMNS = [name for name, code in SCHEMA]
+TYPECODES = dict(SCHEMA)
+
+MODES = ['single', 'cont']
+ACTIONS = ['leave off', 'leave on', 'activate', 'deactivate']
+
+CSV_TIME_FORMAT = '%d/%m/%y %H:%M:%S'
+
+
+def encode_flag(value):
+    """Returns 1, 0 or -1 (unknown) for a bool, or its csv text"""
+    if value in (True, 'True'):
+        return 1
+    if value in (False, 'False'):
+        return 0
+    return -1
+
+
+def encode_code(value, names):
+    """Returns the index of value in names, or -1 if it is not there"""
+    try:
+        return names.index(value)
+    except ValueError:
+        return -1
+
+
+def encode_row(row, ts=None):
+    """Returns a typed tuple in SCHEMA order from a row of CSV_COLUMNS.
+
+    The datetime may be a string as written by main(), or epoch seconds.
+    ts (epoch seconds) is used instead if given: local time strings repeat
+    an hour when the clocks go back.
+    """
+    datetime, mode, success, output, state, action, state1 = (list(row) + [None] * 7)[:7]
+    if ts is None:
+        ts = datetime
+    if isinstance(ts, str):
+        ts = time.mktime(time.strptime(ts, CSV_TIME_FORMAT))
+    try:
+        output = float(output)
+    except (TypeError, ValueError):
+        output = math.nan
+    return (int(ts),
+            encode_code(mode, MODES),
+            encode_flag(success),
+            output,
+            encode_flag(state),
+            encode_code(action, ACTIONS),
+            encode_flag(state1))
+
+
+class HistoryStore:
+    # append-only chunked column files with a time-range query api
+    def __init__(self, directory, chunk_rows=65536, max_rows=10, log=None):
+        """
+        directory is made if it does not exist.  Appended rows are
+        buffered and written every max_rows rows, and on flush() or close().
+        """
+        self.directory = directory
+        self.chunk_rows = chunk_rows
+        self.max_rows = max_rows
+        self.log = log or logging.getLogger(__name__)
+        self.buffer = {name: array(code) for name, code in SCHEMA}
+
+        os.makedirs(directory, exist_ok=True)
+        self.index_path = os.path.join(directory, 'index.json')
+        if os.path.exists(self.index_path):
+            with open(self.index_path) as f:
+                self.index = json.load(f)
+        else:
+            self.index = []
+
+    @property
+    def last_ts(self):
+        """Timestamp of the newest row, buffered or stored, or None"""
+        if len(self.buffer['ts']):
+            return self.buffer['ts'][-1]
+        if self.index:
+            return self.index[-1]['last']
+        return None
+
+    def __len__(self):
+        return sum(chunk['rows'] for chunk in self.index) + len(self.buffer['ts'])
+
+    def append(self, values):
+        """Buffer one typed row, in SCHEMA order.  A row older than the last
+        one (the clock was stepped back) is stored at the last one's time,
+        to keep the rows in time order.
+        """
+        last = self.last_ts
+        if last is not None and values[0] < last:
+            self.log.warning('[hist 0.10] row at %s is older than last row at %s, '
+                             'storing it at %s', values[0], last, last)
+            values = (last,) + tuple(values[1:])
+        for (name, code), value in zip(SCHEMA, values):
+            self.buffer[name].append(value)
+        if len(self.buffer['ts']) >= self.max_rows:
+            self.flush()
+
+    def writerow(self, row, ts=None):
+        """Buffer a row of CSV_COLUMNS, as main() writes to the csv log,
+        at ts epoch seconds (default the row's datetime)
+        """
+        self.append(encode_row(row, ts))
+
+    def flush(self):
+        """Write buffered rows to the column files"""
+        pending = len(self.buffer['ts'])
+        done = 0
+        while done < pending:
+            if not self.index or self.index[-1]['rows'] >= self.chunk_rows:
+                chunk = {'name': '%06d' % len(self.index), 'rows': 0,
+                         'first': None, 'last': None}
+                os.makedirs(os.path.join(self.directory, chunk['name']),
+                            exist_ok=True)
+                self.index.append(chunk)
+            chunk = self.index[-1]
+
+            n = min(self.chunk_rows - chunk['rows'], pending - done)
+            for name, code in SCHEMA:
+                with open(self._path(chunk, name), 'ab') as f:
+                    # the index says how many rows are good: drop anything
+                    # written after them by a flush that did not finish
+                    f.truncate(chunk['rows'] * self.buffer[name].itemsize)
+                    self.buffer[name][done:done + n].tofile(f)
+
+            if chunk['first'] is None:
+                chunk['first'] = self.buffer['ts'][done]
+            chunk['last'] = self.buffer['ts'][done + n - 1]
+            chunk['rows'] += n
+            done += n
+
+        if pending:
+            self.buffer = {name: array(code) for name, code in SCHEMA}
+            tmp = self.index_path + '.tmp'
+            with open(tmp, 'w') as f:
+                json.dump(self.index, f)
+            os.replace(tmp, self.index_path)
+
+    def close(self):
+        self.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _path(self, chunk, name):
+        return os.path.join(self.directory, chunk['name'],
+                            f'{name}.{TYPECODES[name]}')
+
+    def _chunks(self, start, end):
+        # chunks that may hold rows with start <= ts < end
+        return [chunk for chunk in self.index
+                if chunk['rows']
+                and (start is None or chunk['last'] >= start)
+                and (end is None or chunk['first'] < end)]
+
+    def scan(self, start=None, end=None, columns=None):
+        """Yields one dict per chunk, of column name to a read-only
+        memoryview over the rows with start <= ts < end.
+
+        The views are onto memory-mapped files and are only valid until
+        the next item is requested: copy anything to be kept.
+        """
+        columns = COLUMNS if columns is None else list(columns)
+        for chunk in self._chunks(start, end):
+            maps = {}
+            views = {}
+            rows = {}
+            try:
+                maps['ts'] = self._map(chunk, 'ts')
+                views['ts'] = memoryview(maps['ts']).cast('q')[:chunk['rows']]
+                lo = 0 if start is None else bisect_left(views['ts'], start)
+                hi = chunk['rows'] if end is None else bisect_left(views['ts'], end)
+                if lo >= hi:
+                    continue
+
+                for name in columns:
+                    if name not in maps:
+                        maps[name] = self._map(chunk, name)
+                        views[name] = memoryview(maps[name]).cast(TYPECODES[name])
+                    rows[name] = views[name][lo:hi]
+                yield rows
+            finally:
+                # views must go before the maps they point into, even if
+                # the caller stopped early and still holds some of them
+                for view in rows.values():
+                    view.release()
+                for view in views.values():
+                    view.release()
+                for column_map in maps.values():
+                    column_map.close()
+
+    def _map(self, chunk, name):
+        with open(self._path(chunk, name), 'rb') as f:
+            return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def query(self, start=None, end=None, columns=None):
+        """Returns dict of column name to array of the rows with
+        start <= ts < end (epoch seconds, either may be None for no limit)
+        """
+        self.flush()
+        columns = COLUMNS if columns is None else list(columns)
+        out = {name: array(TYPECODES[name]) for name in columns}
+        for views in self.scan(start, end, columns):
+            for name, view in views.items():
+                out[name].frombytes(view.tobytes())
+        return out
+
+    def downsample(self, bucket, start=None, end=None, column='panel_output',
+                   how='mean'):
+        """Returns list of (bucket start, value) for each bucket seconds wide
+        holding any rows, with value the 'mean', 'max', 'min' or 'last' of
+        column over the bucket.  NaN values are skipped.
+        """
+        self.flush()
+        out = []
+        current = None
+        acc = None
+        n = 0
+
+        def close_bucket():
+            if n:
+                out.append((current, acc / n if how == 'mean' else acc))
+
+        for views in self.scan(start, end, ['ts', column]):
+            for ts, value in zip(views['ts'], views[column]):
+                if value != value:      # nan
+                    continue
+                key = ts - ts % bucket
+                if key != current:
+                    close_bucket()
+                    current, acc, n = key, None, 0
+                if acc is None or how == 'last':
+                    acc = value
+                elif how == 'mean':
+                    acc += value
+                elif how == 'max':
+                    acc = max(acc, value)
+                elif how == 'min':
+                    acc = min(acc, value)
+                n += 1
+        close_bucket()
+        return out
+
+
+def import_csv(csv_path, store):
+    """Append the rows of a csv log written by main() to a HistoryStore.
+
+    Rows are sorted by time, and any not newer than the store's last row
+    are skipped, so importing the same growing log again only adds the
+    new rows.  Returns the number of rows added.
+    """
+    with open(csv_path, newline="") as f:
+        reader = csv.reader(f)
+        rows = []
+        for row in reader:
+            if not row or row[0] == 'datetime':
+                continue
+            try:
+                rows.append(encode_row(row))
+            except ValueError:
+                continue    # unreadable timestamp
+
+    rows.sort(key=lambda row: row[0])
+    last = store.last_ts
+    added = 0
+    for row in rows:
+        if last is not None and row[0] <= last:
+            continue
+        store.append(row)
+        added += 1
+    store.flush()
+    return added
+
+
+if __name__ == "__main__":
+    import sys
+
+    if len(sys.argv) != 3:
+        print('usage: python -m pluggerlib.history log.csv history_dir')
+        sys.exit(1)
+
+    with HistoryStore(sys.argv[2], max_rows=65536) as store:
+        added = import_csv(sys.argv[1], store)
+    print(f'imported {added} rows into {sys.argv[2]}, {len(store)} in total')
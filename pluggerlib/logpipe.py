@@ -0,0 +1,131 @@
+"""
+Logging that keeps disk work off the control loop.
+
+The loop's logger only puts records on a queue.  A listener thread
+formats them and writes them to a timed rotating file, and each rotated
+file is gzipped by a thread of its own, so neither formatting, writing,
+midnight rotation, clean-up of old files nor compression runs inline.
+
+Log calls should pass values as arguments rather than formatting them,
+eg log.info('[main 0.60] panel read: output=%s', output), so messages
+below the log level are never formatted and the rest are formatted on the
+listener thread.  The '[main 0.60]' step id is parsed into a step field,
+and with structured=True each record is written as a line of json with
+the step, message and argument values as separate fields.
+"""
+import atexit
+import gzip
+import json
+import logging
+import os
+import queue
+import re
+import shutil
+import threading
+from logging.handlers import QueueHandler, QueueListener, TimedRotatingFileHandler
+
+STEP = re.compile(r'^\[([^\]]+)\]\s*')
+
+# argument types safe to format later, on the listener thread
+SCALARS = (str, int, float, bool, type(None))
+
+
+class LazyQueueHandler(QueueHandler):
+    # queues records without formatting them, where that is safe
+    def prepare(self, record):
+        args = record.args
+        if isinstance(args, dict):
+            args = args.values()
+        if args and not all(isinstance(arg, SCALARS) for arg in args):
+            # a mutable argument could change before the listener gets to
+            # it, so freeze the message now
+            record.msg = record.getMessage()
+            record.args = None
+        return record
+
+
+class StepFilter(logging.Filter):
+    # adds record.step, the '[main 0.60]' step id if the message has one
+    def filter(self, record):
+        match = STEP.match(str(record.msg))
+        record.step = match.group(1) if match else ''
+        return True
+
+
+class JsonFormatter(logging.Formatter):
+    # one json object per record, with the step and values as fields
+    def format(self, record):
+        message = record.getMessage()
+        entry = {'time': self.formatTime(record),
+                 'level': record.levelname,
+                 'step': getattr(record, 'step', ''),
+                 'msg': STEP.sub('', message),
+                }
+        if isinstance(record.args, tuple) and record.args:
+            entry['values'] = [arg if isinstance(arg, SCALARS) else repr(arg)
+                               for arg in record.args]
+        if record.exc_info:
+            entry['exc'] = self.formatException(record.exc_info)
+        return json.dumps(entry)
+
+
+class LogListener(QueueListener):
+    # a queue listener that can be stopped more than once
+    def stop(self):
+        if self._thread is not None:
+            super().stop()
+
+
+def compress(path):
+    """Gzip path to path.gz and remove it"""
+    with open(path, 'rb') as src, gzip.open(path + '.gz', 'wb') as dst:
+        shutil.copyfileobj(src, dst)
+    os.remove(path)
+
+
+class CompressingRotatingHandler(TimedRotatingFileHandler):
+    # rotated files are renamed at once and gzipped in the background
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.namer = lambda name: name + '.gz'
+        self.rotator = self.rotate_and_compress
+
+    def rotate_and_compress(self, source, dest):
+        plain = dest[:-len('.gz')]
+        if os.path.exists(source):
+            os.rename(source, plain)
+            threading.Thread(target=compress, args=(plain,),
+                             name='log-compress', daemon=False).start()
+
+
+def setup_logging(daily_log_dir, timed_log_when='midnight',
+                  timed_log_interval=None, days_to_log=28, structured=False,
+                  logger=None):
+    """Returns (logger, listener): the logger only queues records, and the
+    listener thread writes them to a compressing timed rotating file,
+    'log' in daily_log_dir.  The listener is stopped, writing out whatever
+    is queued, at interpreter exit or by calling listener.stop().
+    """
+    os.makedirs(daily_log_dir, exist_ok=True)
+    file_path = os.path.join(daily_log_dir, 'log')
+
+    kwargs = {'when': timed_log_when, 'backupCount': days_to_log}
+    if timed_log_interval is not None:
+        kwargs['interval'] = timed_log_interval
+    handler = CompressingRotatingHandler(file_path, **kwargs)
+    handler.setLevel(logging.INFO)
+    handler.addFilter(StepFilter())
+    if structured:
+        handler.setFormatter(JsonFormatter())
+    else:
+        handler.setFormatter(logging.Formatter('%(asctime)-15s %(message)-10s'))
+
+    records = queue.SimpleQueue()
+    listener = LogListener(records, handler, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+
+    log = logging.getLogger() if logger is None else logger
+    log.setLevel(logging.INFO)
+    log.addHandler(LazyQueueHandler(records))
+    return log, listener
@@ -0,0 +1,276 @@
+"""
+Counters, gauges and latency histograms for the control loop, readable
+in-process or over http in Prometheus text format.
+
+    metrics = Registry()
+    with metrics.timed('panel_read_seconds'):
+        reading = panel.read()
+    metrics.counter('panel_reads_total', result='ok').inc()
+    serve(metrics, 9100)        # GET http://127.0.0.1:9100/metrics
+
+When metrics are off, code records into NULL instead, whose methods do
+nothing and allocate nothing, so the instrumented paths cost one method
+call each.
+"""
+import threading
+import time
+from bisect import bisect_left
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+PREFIX = 'plugger_'
+
+# seconds, from a loopback plug round trip up to a panel read timing out
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+                   0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Counter:
+    # a count that only goes up
+    kind = 'counter'
+
+    def __init__(self, lock):
+        self.lock = lock
+        self.value = 0
+
+    def inc(self, amount=1):
+        with self.lock:
+            self.value += amount
+
+
+class Gauge:
+    # a value that is set, eg the last panel output
+    kind = 'gauge'
+
+    def __init__(self, lock):
+        self.value = 0
+
+    def set(self, value):
+        self.value = value
+
+
+class Histogram:
+    # counts of observations in fixed buckets, with their sum
+    kind = 'histogram'
+
+    def __init__(self, lock, buckets=LATENCY_BUCKETS):
+        self.lock = lock
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)     # last is +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        i = bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[i] += 1
+            self.sum += value
+            self.count += 1
+
+    @property
+    def value(self):
+        return {'count': self.count, 'sum': self.sum,
+                'mean': self.sum / self.count if self.count else None}
+
+
+class Timer:
+    # context manager observing its elapsed time into a histogram
+    __slots__ = ('histogram', 'start')
+
+    def __init__(self, histogram):
+        self.histogram = histogram
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.start)
+
+
+class Registry:
+    # named, labelled metrics
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.metrics = {}       # (name, labels) -> metric
+        self.help = {}
+
+    def _get(self, cls, name, help, labels):
+        key = (name, tuple(sorted(labels.items())))
+        metric = self.metrics.get(key)
+        if metric is None:
+            with self.lock:
+                metric = self.metrics.get(key)
+                if metric is None:
+                    metric = self.metrics[key] = cls(self.lock)
+                    if help:
+                        self.help[name] = help
+        return metric
+
+    def counter(self, name, help='', **labels):
+        return self._get(Counter, name, help, labels)
+
+    def gauge(self, name, help='', **labels):
+        return self._get(Gauge, name, help, labels)
+
+    def histogram(self, name, help='', **labels):
+        return self._get(Histogram, name, help, labels)
+
+    def timed(self, name, help='', **labels):
+        """Returns a context manager timing its block into histogram name"""
+        return Timer(self.histogram(name, help, **labels))
+
+    def get(self, name, **labels):
+        """Returns the current value of a metric, or None if it has not
+        been recorded: a number, or for histograms a dict of count, sum
+        and mean
+        """
+        metric = self.metrics.get((name, tuple(sorted(labels.items()))))
+        return None if metric is None else metric.value
+
+    def snapshot(self):
+        """Returns dict of every metric's value, keyed as 'name{label="value"}'"""
+        return {name + _labels(labels): metric.value
+                for (name, labels), metric in list(self.metrics.items())}
+
+    def render(self):
+        """Returns all metrics in Prometheus text exposition format"""
+        families = {}
+        for (name, labels), metric in sorted(list(self.metrics.items()),
+                                             key=lambda item: item[0]):
+            families.setdefault(name, []).append((labels, metric))
+
+        lines = []
+        for name, members in families.items():
+            full = PREFIX + name
+            if name in self.help:
+                lines.append(f'# HELP {full} {self.help[name]}')
+            lines.append(f'# TYPE {full} {members[0][1].kind}')
+            for labels, metric in members:
+                if metric.kind != 'histogram':
+                    lines.append(f'{full}{_labels(labels)} {_number(metric.value)}')
+                    continue
+                cumulative = 0
+                for bound, count in zip(metric.buckets + ('+Inf',), metric.counts):
+                    cumulative += count
+                    le = labels + (('le', bound if bound == '+Inf' else repr(bound)),)
+                    lines.append(f'{full}_bucket{_labels(le)} {cumulative}')
+                lines.append(f'{full}_sum{_labels(labels)} {_number(metric.sum)}')
+                lines.append(f'{full}_count{_labels(labels)} {metric.count}')
+        return '\n'.join(lines) + '\n'
+
+
+def _labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join('%s="%s"' % (key, str(value).replace('"', '\\"'))
+                          for key, value in labels) + '}'
+
+
+def _number(value):
+    if value is True or value is False:
+        return str(int(value))
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _NullMetric:
+    # stands in for every metric when metrics are off
+    __slots__ = ()
+
+    def inc(self, amount=1):
+        pass
+
+    def set(self, value):
+        pass
+
+    def observe(self, value):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+
+class NullRegistry:
+    # a Registry that records nothing
+    _metric = _NullMetric()
+
+    def counter(self, name, help='', **labels):
+        return self._metric
+
+    gauge = histogram = timed = counter
+
+    def get(self, name, **labels):
+        return None
+
+    def snapshot(self):
+        return {}
+
+    def render(self):
+        return ''
+
+
+NULL = NullRegistry()
+
+
+def instrument_plug(plug, metrics):
+    """Time a SmartPlug's round trips and its encrypt/decrypt into metrics,
+    counting failed requests.  Wraps this instance's methods only, and
+    leaves plugs without them (eg TestPlug) alone.  Returns plug.
+    """
+    if metrics is NULL:
+        return plug
+
+    def wrap(method, name, **labels):
+        histogram = metrics.histogram(name, **labels)
+
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return method(*args, **kwargs)
+            except Exception as e:
+                metrics.counter('plug_request_errors_total',
+                                error=type(e).__name__).inc()
+                raise
+            finally:
+                histogram.observe(time.perf_counter() - start)
+        return timed
+
+    if hasattr(plug, 'request'):
+        plug.request = wrap(plug.request, 'plug_request_seconds',
+                            help='plug command round trip time')
+    for op in ('encrypt', 'decrypt'):
+        if hasattr(plug, op):
+            setattr(plug, op, wrap(getattr(plug, op), 'codec_seconds', op=op))
+    return plug
+
+
+class _Handler(BaseHTTPRequestHandler):
+    registry = NULL
+
+    def do_GET(self):
+        if self.path.split('?')[0] not in ('/metrics', '/'):
+            self.send_error(404)
+            return
+        body = self.registry.render().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def serve(registry, port=9100, host='127.0.0.1'):
+    """Serve registry at http://host:port/metrics from a daemon thread.
+    Returns the server; call its shutdown() to stop it.
+    """
+    handler = type('Handler', (_Handler,), {'registry': registry})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='metrics',
+                     daemon=True).start()
+    return server
@@ -0,0 +1,247 @@
+"""
+Reading values from the panels' (inverters') xml status pages.
+"""
+import re
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, wait
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from pluggerlib.retry import classify
+
+# result of one panel read.  values maps tag to float, and is empty unless
+# success.  latency is the seconds the http request and parse took.  failure
+# is the kind of failure (see pluggerlib.retry) if not success.
+PanelReading = namedtuple('PanelReading',
+                          ['success', 'values', 'error', 'latency', 'timestamp',
+                           'failure'], defaults=[None])
+
+
+def tag_pattern(tags):
+    """Returns a compiled regex matching <tag ...> value </tag> for any of tags,
+    tolerating attributes and whitespace around the value
+    """
+    names = '|'.join(re.escape(tag) for tag in tags)
+    return re.compile(r'<(' + names + r')(?:\s[^>]*)?>\s*([^<]*?)\s*</\1\s*>')
+
+
+def parse_tags(xml_text, tags, pattern=None):
+    """Returns dict of tag to float for each of tags found in xml_text.
+
+    One pass over the text, stopping as soon as every tag has been seen.
+    Where a tag appears more than once the first value is used.
+    """
+    if pattern is None:
+        pattern = tag_pattern(tags)
+
+    values = {}
+    for match in pattern.finditer(xml_text):
+        tag = match.group(1)
+        if tag not in values:
+            values[tag] = float(match.group(2))
+            if len(values) == len(tags):
+                break
+    return values
+
+
+class PanelReader:
+    # reads one panel over a kept-alive http connection
+    def __init__(self, panel_ip, tags=('OutputPower',), connect_timeout=3.05,
+                 read_timeout=10, session=None):
+        """
+        panel_ip is the address and page, eg 192.168.1.161/meters.xml.
+        tags are the xml elements to read on each call, eg
+        ('OutputPower', 'EnergyToday').  An unresponsive panel fails the
+        read after connect_timeout or read_timeout seconds, rather than
+        blocking the loop.
+        """
+        self.url = panel_ip if '://' in panel_ip else 'http://' + panel_ip
+        self.tags = tuple(tags)
+        self.timeout = (connect_timeout, read_timeout)
+        self.pattern = tag_pattern(self.tags)
+        self.last = None
+
+        if session is None:
+            session = requests.Session()
+            session.mount('http://', HTTPAdapter(pool_connections=1,
+                                                 pool_maxsize=1))
+        self.session = session
+
+    def read(self, log=None):
+        """Returns a PanelReading for all of the reader's tags.
+
+        The read only succeeds if every tag is found and is a number.
+        """
+        start = time.perf_counter()
+        timestamp = time.time()
+
+        def failed(error, kind):
+            self.last = PanelReading(False, {}, error,
+                                     time.perf_counter() - start, timestamp,
+                                     kind)
+            if log is not None:
+                log.info('[getp 0.30] %s', error)
+            return self.last
+
+        try:
+            response = self.session.get(self.url, timeout=self.timeout)
+        except requests.Timeout:
+            return failed(f'timeout from {self.url}', 'timeout')
+        except requests.RequestException as e:
+            return failed(f'no response from {self.url}: {type(e).__name__}',
+                          classify(e))
+
+        if not response.ok:
+            return failed(str(response), 'http')
+
+        try:
+            values = parse_tags(response.text, self.tags, self.pattern)
+        except ValueError as e:
+            return failed(f'bad value in xml: {e}', 'protocol')
+
+        missing = [tag for tag in self.tags if tag not in values]
+        if missing:
+            return failed(f'cannot find {", ".join(missing)} in xml',
+                          'protocol')
+
+        self.last = PanelReading(True, values, None,
+                                 time.perf_counter() - start, timestamp)
+        if log is not None:
+            log.info('[getp 0.40] read %s in %.3fs', values, self.last.latency)
+        return self.last
+
+    def close(self):
+        self.session.close()
+
+
+COMBINE = {'sum': sum,
+           'mean': lambda xs: sum(xs) / len(xs),
+           'max': max,
+           'min': min,
+          }
+
+
+class PanelGroup:
+    # reads several panels at once and combines their values
+    def __init__(self, readers, deadline=5.0, combine='sum', stale_after=None,
+                 require_all=True):
+        """
+        readers are PanelReaders, all reading the same tags.  Each cycle
+        they are read concurrently, and any not back within deadline seconds
+        count as failed for that cycle.  A late read is not started again
+        while it is still running, and when it ends its reading only counts
+        as a panel's last good one, for stale_after: it is never taken as a
+        fresh value in a later cycle.
+
+        combine is 'sum', 'mean', 'max', 'min', or a function of a list of
+        values, applied per tag.
+
+        stale_after is how many seconds a panel's last good reading may
+        stand in for a failed or late one (default: never).  With
+        require_all=True the group read fails if any panel has no usable
+        value, otherwise whatever panels are usable are combined.
+        """
+        if not readers:
+            raise ValueError('need at least one panel reader')
+        tags = {reader.tags for reader in readers}
+        if len(tags) != 1:
+            raise ValueError(f'panel readers have different tags: {tags}')
+
+        self.readers = list(readers)
+        self.tags = self.readers[0].tags
+        self.deadline = deadline
+        self.combine = COMBINE[combine] if isinstance(combine, str) else combine
+        self.stale_after = stale_after
+        self.require_all = require_all
+        self.last = None
+
+        self.executor = ThreadPoolExecutor(max_workers=len(self.readers),
+                                           thread_name_prefix='panel')
+        self._pending = [None] * len(self.readers)
+        self._good = [None] * len(self.readers)
+
+    def read(self, log=None):
+        """Returns a PanelReading combining all panels, with latency being
+        the time until every panel answered or the deadline passed
+        """
+        start = time.perf_counter()
+        timestamp = time.time()
+
+        for i, reader in enumerate(self.readers):
+            future = self._pending[i]
+            if future is not None and future.done():
+                # a read that missed an earlier cycle's deadline
+                self._keep_good(i, future.result())
+                future = None
+            if future is None:
+                self._pending[i] = self.executor.submit(reader.read)
+        wait(self._pending, timeout=self.deadline)
+
+        usable = []
+        errors = []
+        failures = []
+        for i, reader in enumerate(self.readers):
+            future = self._pending[i]
+            fresh = False
+            if future.done():
+                self._pending[i] = None
+                reading = future.result()
+                self._keep_good(i, reading)
+                # only a read started this cycle is current
+                fresh = reading.timestamp >= timestamp
+            if fresh and reading.success:
+                usable.append(reading.values)
+                continue
+            if fresh:
+                error = reading.error
+                failures.append(reading.failure)
+            else:
+                error = f'no reading from {reader.url} within {self.deadline}s'
+                failures.append('timeout')
+
+            good = self._good[i]
+            if (self.stale_after is not None and good is not None
+                    and timestamp - good.timestamp <= self.stale_after):
+                usable.append(good.values)
+                error += ', using reading from %.0fs ago' % (timestamp - good.timestamp)
+            errors.append(error)
+
+        if log is not None:
+            for error in errors:
+                log.info('[getp 0.50] %s', error)
+
+        latency = time.perf_counter() - start
+        if not usable or (self.require_all and len(usable) < len(self.readers)):
+            self.last = PanelReading(False, {}, '; '.join(errors), latency,
+                                     timestamp, failures[0])
+        else:
+            values = {tag: self.combine([v[tag] for v in usable])
+                      for tag in self.tags}
+            self.last = PanelReading(True, values,
+                                     '; '.join(errors) or None, latency,
+                                     timestamp)
+        return self.last
+
+    def _keep_good(self, i, reading):
+        if reading.success and (self._good[i] is None
+                                or reading.timestamp > self._good[i].timestamp):
+            self._good[i] = reading
+
+    def close(self):
+        self.executor.shutdown(wait=False)
+        for reader in self.readers:
+            reader.close()
+
+
+def make_panel(panel_ip, tags=('OutputPower',), deadline=5.0, combine='sum',
+               stale_after=None):
+    """Returns a PanelReader for a single panel_ip, or a PanelGroup if
+    panel_ip is a list of them
+    """
+    if isinstance(panel_ip, str):
+        return PanelReader(panel_ip, tags=tags)
+    return PanelGroup([PanelReader(ip, tags=tags) for ip in panel_ip],
+                      deadline=deadline, combine=combine,
+                      stale_after=stale_after)
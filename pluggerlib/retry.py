@@ -0,0 +1,218 @@
+"""
+Retries, backoff and circuit breaking for plug and panel i/o.
+
+A Guard runs each call to one device under a RetryPolicy, which retries
+transient failures after short exponential backoff with jitter, within a
+time budget smaller than the poll interval, and a CircuitBreaker, which
+stops calling a device that keeps failing and lets a single cheap call
+through now and then to see if it is back.
+
+Failures are raised as DeviceError, with kind one of
+
+    timeout      no answer in time
+    refused      nothing listening, eg the plug rebooting
+    reset        the connection dropped mid request
+    unreachable  no route, or the name did not resolve
+    protocol     an answer that could not be understood
+    http         the panel answered with an http error
+    open         not tried, as the device's circuit is open
+    error        anything else
+"""
+import random
+import time
+
+KINDS = ['timeout', 'refused', 'reset', 'unreachable', 'protocol', 'http',
+         'open', 'error']
+
+# kinds worth trying again straight away
+TRANSIENT = ('timeout', 'refused', 'reset', 'unreachable', 'protocol')
+
+
+class DeviceError(Exception):
+    # a device call failed, after any retries
+    def __init__(self, kind, message, attempts=1):
+        super().__init__(message)
+        self.kind = kind
+        self.attempts = attempts
+
+
+class CircuitOpen(DeviceError):
+    # the call was not made, as the device's circuit is open
+    def __init__(self, name, retry_in):
+        super().__init__('open', f'{name} circuit open, next probe in {retry_in:.0f}s')
+        self.retry_in = retry_in
+
+
+def _chain(exc):
+    # exc and what it wraps, outermost first
+    chain = []
+    while exc is not None and len(chain) < 10 and exc not in chain:
+        chain.append(exc)
+        inner = exc.__cause__ or exc.__context__ or getattr(exc, 'reason', None)
+        if inner is None and exc.args and isinstance(exc.args[0], BaseException):
+            inner = exc.args[0]
+        exc = inner if isinstance(inner, BaseException) else None
+    return chain
+
+
+def classify(exc):
+    """Returns the kind of failure exc is, from the innermost exception it
+    wraps that says, so eg a refused connection wrapped by requests and
+    urllib3 is 'refused'
+    """
+    if isinstance(exc, DeviceError):
+        return exc.kind
+    chain = _chain(exc)
+    for inner in reversed(chain):
+        if isinstance(inner, TimeoutError):
+            return 'timeout'
+        if isinstance(inner, ConnectionRefusedError):
+            return 'refused'
+        if isinstance(inner, (ConnectionResetError, ConnectionAbortedError,
+                              BrokenPipeError)):
+            return 'reset'
+        if isinstance(inner, OSError):
+            return 'unreachable'
+        if isinstance(inner, (ValueError, KeyError, TypeError, IndexError)):
+            return 'protocol'
+    if any('Timeout' in type(inner).__name__ for inner in chain):
+        return 'timeout'
+    return 'error'
+
+
+class RetryPolicy:
+    # how often and how soon to retry a failed call
+    def __init__(self, attempts=3, base=0.5, cap=5.0, jitter=0.5,
+                 budget=None, retry_on=TRANSIENT, sleep=time.sleep,
+                 clock=time.monotonic, seed=None):
+        """
+        Up to attempts calls, waiting base, 2 x base, 4 x base ... seconds
+        (at most cap) between them, each cut by up to jitter of itself at
+        random so devices recovering together are not retried in step.
+        No retry is started that would end more than budget seconds after
+        the first call began.
+        """
+        self.attempts = attempts
+        self.base = base
+        self.cap = cap
+        self.jitter = jitter
+        self.budget = budget
+        self.retry_on = retry_on
+        self.sleep = sleep
+        self.clock = clock
+        self.random = random.Random(seed)
+
+    def delay(self, retry):
+        """Returns the seconds to wait before retry number retry (from 0)"""
+        delay = min(self.cap, self.base * 2 ** retry)
+        return delay * (1 - self.jitter * self.random.random())
+
+    def call(self, func, *args, budget=None, **kwargs):
+        """Returns func(*args, **kwargs), retrying transient failures.
+        Raises DeviceError for the last failure.
+        """
+        budget = self.budget if budget is None else budget
+        start = self.clock()
+        for attempt in range(1, self.attempts + 1):
+            try:
+                return func(*args, **kwargs)
+            except Exception as e:
+                kind = classify(e)
+                error = e
+            if attempt == self.attempts or kind not in self.retry_on:
+                break
+            delay = self.delay(attempt - 1)
+            if budget is not None and self.clock() + delay - start > budget:
+                break
+            self.sleep(delay)
+        raise DeviceError(kind, str(error) or type(error).__name__,
+                          attempt) from error
+
+
+class CircuitBreaker:
+    # stops calls to a device after repeated failures, probing until it is back
+    def __init__(self, failures=3, reset_after=60, max_reset_after=900,
+                 clock=time.monotonic):
+        """
+        After failures failed calls in a row the circuit opens: calls are
+        refused for reset_after seconds, then one probe is let through.  If
+        it fails the wait doubles, up to max_reset_after; if it succeeds
+        the circuit closes.
+        """
+        self.failures = failures
+        self.reset_after = reset_after
+        self.max_reset_after = max_reset_after
+        self.clock = clock
+        self.state = 'closed'
+        self.failed = 0
+        self.wait = reset_after
+        self.opened = None
+
+    def allow(self):
+        """Returns 'call' to call as normal, 'probe' for a single probe
+        call, or None if the circuit is open
+        """
+        if self.state == 'closed':
+            return 'call'
+        if self.clock() - self.opened >= self.wait:
+            self.state = 'half-open'
+            return 'probe'
+        return None
+
+    def retry_in(self):
+        """Returns seconds until the next probe, 0 if the circuit is closed"""
+        if self.state == 'closed':
+            return 0
+        return max(0, self.opened + self.wait - self.clock())
+
+    def success(self):
+        self.state = 'closed'
+        self.failed = 0
+        self.wait = self.reset_after
+
+    def failure(self):
+        self.failed += 1
+        if self.state == 'half-open':
+            self.wait = min(self.wait * 2, self.max_reset_after)
+        if self.state == 'half-open' or self.failed >= self.failures:
+            self.state = 'open'
+            self.opened = self.clock()
+
+
+class Guard:
+    # a device's retry policy and circuit breaker together
+    def __init__(self, name, policy=None, breaker=None, log=None):
+        self.name = name
+        self.policy = RetryPolicy() if policy is None else policy
+        self.breaker = breaker
+        self.log = log
+
+    def call(self, func, *args, budget=None, **kwargs):
+        """Returns func(*args, **kwargs) under the policy and breaker.
+        Raises DeviceError, or CircuitOpen without calling func.
+        """
+        allowed = 'call' if self.breaker is None else self.breaker.allow()
+        if allowed is None:
+            raise CircuitOpen(self.name, self.breaker.retry_in())
+        try:
+            if allowed == 'probe':
+                # one try only: a dead device is not worth the backoff
+                try:
+                    result = func(*args, **kwargs)
+                except Exception as e:
+                    raise DeviceError(classify(e), str(e) or type(e).__name__) from e
+            else:
+                result = self.policy.call(func, *args, budget=budget, **kwargs)
+        except DeviceError as e:
+            if self.breaker is not None:
+                was = self.breaker.state
+                self.breaker.failure()
+                if self.breaker.state == 'open' and was == 'closed' and self.log:
+                    self.log.info('[rtry 1.00] %s circuit opened after %s: %s',
+                                  self.name, e.kind, e)
+            raise
+        if self.breaker is not None:
+            if self.breaker.state != 'closed' and self.log:
+                self.log.info('[rtry 2.00] %s is back, circuit closed', self.name)
+            self.breaker.success()
+        return result
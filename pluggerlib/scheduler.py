@@ -0,0 +1,120 @@
+"""
+Poll timing for the control loop.
+
+Scheduler waits on a fixed-rate grid of the monotonic clock, so the time
+each loop's work takes does not push later polls back.  AdaptiveScheduler
+also moves its interval with the panel output: fast near the threshold or
+when output is changing quickly, slow when it is far away and steady, or
+dark.
+"""
+import random
+import time
+
+
+class Scheduler:
+    # fixed-rate polling on the monotonic clock
+    def __init__(self, interval, jitter=0.0, clock=time.monotonic,
+                 sleep=time.sleep, seed=None):
+        """
+        interval is the seconds between polls.  Each wait is delayed by up
+        to jitter seconds at random, so a fleet of controllers started
+        together does not poll in step, but the delay is not carried into
+        the next deadline.
+        """
+        self.interval = interval
+        self.jitter = jitter
+        self.clock = clock
+        self.sleep = sleep
+        self.random = random.Random(seed)
+        self.deadline = None
+        self.missed = 0
+
+    def start(self):
+        """Start the grid now: the first wait() ends one interval from now"""
+        self.deadline = self.clock()
+
+    def next_interval(self):
+        return self.interval
+
+    def update(self, value):
+        """Take note of a reading (None if it failed), returning the interval"""
+        return self.interval
+
+    def wait(self):
+        """Sleep until the next poll is due, returning the seconds slept.
+
+        If the loop overran one or more polls they are skipped, not run
+        back to back.
+        """
+        now = self.clock()
+        if self.deadline is None:
+            self.deadline = now
+        interval = self.next_interval()
+        self.deadline += interval
+        if self.deadline < now:
+            behind = now - self.deadline
+            skipped = int(behind // interval) + 1
+            self.missed += skipped
+            self.deadline += skipped * interval
+
+        delay = self.deadline - now
+        if self.jitter:
+            delay += self.random.uniform(0, self.jitter)
+        self.sleep(delay)
+        return delay
+
+
+class AdaptiveScheduler(Scheduler):
+    # polls faster where a switch is likely, slower where it is not
+    def __init__(self, interval, threshold, min_interval=None,
+                 max_interval=None, band=None, dark=0.01, growth=1.5,
+                 **kwargs):
+        """
+        interval is the starting interval, and the one used after a failed
+        read.  Polls are min_interval apart (default interval / 4) while
+        output is within band of threshold (default 20% of it), and up to
+        max_interval apart (default interval x 4) when it is far off and
+        steady, or below dark.  In between, the interval is half the time
+        the output would take to reach threshold at its current rate of
+        change.  The interval shrinks at once but grows by at most growth
+        times per poll.
+        """
+        super().__init__(interval, **kwargs)
+        self.base = interval
+        self.threshold = threshold
+        self.min_interval = interval / 4 if min_interval is None else min_interval
+        self.max_interval = interval * 4 if max_interval is None else max_interval
+        self.band = abs(threshold) * 0.2 if band is None else band
+        self.dark = dark
+        self.growth = growth
+        self.current = interval
+        self.last = None
+
+    def next_interval(self):
+        return self.current
+
+    def update(self, value):
+        """Adjust the interval for a new reading, or None if the read failed.
+        Returns the new interval.
+        """
+        now = self.clock()
+        if value is None:
+            self.current = min(self.current, self.base)
+            return self.current
+
+        distance = abs(value - self.threshold)
+        if distance <= self.band:
+            target = self.min_interval
+        elif value <= self.dark:
+            target = self.max_interval
+        else:
+            target = self.max_interval
+            if self.last is not None and now > self.last[0]:
+                rate = abs(value - self.last[1]) / (now - self.last[0])
+                if rate > 0:
+                    target = min(target, (distance - self.band) / rate / 2)
+        self.last = (now, value)
+
+        target = max(self.min_interval, min(self.max_interval, target))
+        self.current = min(target, self.current * self.growth)
+        return self.current
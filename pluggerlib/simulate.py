@@ -0,0 +1,247 @@
+"""
+Run main()'s control loop against a recorded or synthetic panel trace and
+simulated plugs, on a virtual clock, so a day of operation takes
+milliseconds and faults can be injected deterministically.
+
+    from pluggerlib.simulate import Faults, simulate, synthetic_trace
+    result = simulate(synthetic_trace(days=1), threshold=0.7, interval=30,
+                      panel_faults=Faults(timeout=0.05, seed=1))
+"""
+import contextlib
+import csv
+import io
+import logging
+import math
+import os
+import random
+import tempfile
+import time
+from bisect import bisect_right
+
+from pluggerlib.panel import PanelReading
+from pluggerlib.retry import classify
+
+
+class EndOfSimulation(Exception):
+    # raised from the simulated sleep once the trace has been played out
+    pass
+
+
+class VirtualClock:
+    # time that only moves when something sleeps or takes time
+    def __init__(self, start=None):
+        self.now = time.time() if start is None else start
+
+    def time(self):
+        return self.now
+
+    def monotonic(self):
+        return self.now
+
+    def sleep(self, seconds):
+        if seconds > 0:
+            self.now += seconds
+
+
+class Faults:
+    # what can go wrong, and how often
+    def __init__(self, timeout=0.0, error=0.0, latency=0.0, jitter=0.0,
+                 seed=None):
+        """
+        timeout and error are the chances (0-1) that a call times out or
+        raises at once.  A timed out call costs timeout_after seconds of
+        virtual time.  latency is the virtual seconds every call takes,
+        plus up to jitter more at random.  seed makes the faults repeatable.
+        """
+        self.timeout = timeout
+        self.error = error
+        self.latency = latency
+        self.jitter = jitter
+        self.timeout_after = 5.0
+        self.random = random.Random(seed)
+
+    def call(self, clock, what):
+        """Spend a call's latency on clock, and raise if it fails"""
+        roll = self.random.random()
+        if roll < self.timeout:
+            clock.sleep(self.timeout_after)
+            raise TimeoutError(f'simulated timeout in {what}')
+        clock.sleep(self.latency + self.jitter * self.random.random())
+        if roll < self.timeout + self.error:
+            raise ConnectionRefusedError(f'simulated error in {what}')
+
+
+NO_FAULTS = Faults()
+
+
+class SimPanel:
+    # panel reader replaying a trace of (timestamp, output) on a virtual clock
+    def __init__(self, trace, clock, faults=NO_FAULTS, tags=('OutputPower',)):
+        """
+        trace is a list of (timestamp, output) in time order, or a
+        function of the timestamp.  Reads return the latest trace value at
+        or before the clock's time.
+        """
+        self.clock = clock
+        self.faults = faults
+        self.tags = tuple(tags)
+        self.reads = 0
+        self.failures = 0
+        if callable(trace):
+            self.value_at = trace
+        else:
+            times = [t for t, value in trace]
+            values = [value for t, value in trace]
+            self.value_at = lambda t: values[max(0, bisect_right(times, t) - 1)]
+
+    def read(self, log=None):
+        self.reads += 1
+        start = self.clock.time()
+        try:
+            self.faults.call(self.clock, 'panel read')
+        except OSError as e:
+            self.failures += 1
+            return PanelReading(False, {}, str(e), self.clock.time() - start,
+                                start, classify(e))
+        value = self.value_at(start)
+        return PanelReading(True, {tag: value for tag in self.tags}, None,
+                            self.clock.time() - start, start)
+
+
+class SimPlug:
+    # a plug whose relay, failures and latency run on a virtual clock
+    def __init__(self, clock, faults=NO_FAULTS, name='Sim Plug'):
+        self.clock = clock
+        self.faults = faults
+        self.info = {'alias': name, 'model': 'Sim Plug'}
+        self.state = False
+        self.switches = 0
+        self.on_seconds = 0.0
+        self.changed = clock.time()
+
+    @property
+    def is_on(self):
+        self.faults.call(self.clock, 'is_on')
+        return self.state
+
+    def turn_on(self):
+        self.faults.call(self.clock, 'turn_on')
+        self._set(True)
+
+    def turn_off(self):
+        self.faults.call(self.clock, 'turn_off')
+        self._set(False)
+
+    def _set(self, state):
+        if state == self.state:
+            return
+        now = self.clock.time()
+        if self.state:
+            self.on_seconds += now - self.changed
+        self.state = state
+        self.changed = now
+        self.switches += 1
+
+    def settle(self):
+        """Count time on up to the clock's time, returning on_seconds"""
+        if self.state:
+            now = self.clock.time()
+            self.on_seconds += now - self.changed
+            self.changed = now
+        return self.on_seconds
+
+
+def synthetic_trace(days=1, step=30, peak=3.0, cloudiness=0.3, start=None,
+                    seed=None):
+    """Returns a list of (timestamp, output) following a clear-sky daylight
+    curve peaking at peak at noon, with passing clouds cutting it by up to
+    cloudiness, every step seconds from local midnight of start
+    """
+    rng = random.Random(seed)
+    if start is None:
+        start = time.time()
+    local = time.localtime(start)
+    midnight = time.mktime(local[:3] + (0, 0, 0) + local[6:8] + (-1,))
+
+    trace = []
+    cloud = 0.0
+    for i in range(int(days * 86400 / step)):
+        t = midnight + i * step
+        hour = (t - midnight) % 86400 / 3600
+        sun = max(0.0, math.sin((hour - 6) / 12 * math.pi))
+        cloud = min(1.0, max(0.0, cloud + rng.gauss(0, 0.1)))
+        trace.append((t, round(peak * sun * (1 - cloudiness * cloud), 3)))
+    return trace
+
+
+def simulate(trace, threshold=0.7, interval=30, duration=None,
+             panel_faults=NO_FAULTS, plug_faults=NO_FAULTS, log_file=None,
+             **main_kwargs):
+    """Run plugger.main over trace on a virtual clock, returning a dict of
+
+        cycles          panel reads made
+        switches        plug on/off changes
+        on_seconds      virtual time the plug was on
+        panel_failures  failed panel reads
+        rows            the csv log rows written
+        wall_seconds    real time taken, ie the loop's own overhead
+        per_cycle_us    wall_seconds per cycle, in microseconds (None if
+                        no cycle ran)
+
+    duration defaults to the length of the trace.  Extra keyword arguments
+    go to main(), eg adaptive=True or single_shot=True.
+    """
+    import plugger
+
+    if duration is None:
+        duration = trace[-1][0] - trace[0][0] if not callable(trace) else 86400
+    start = trace[0][0] if not callable(trace) else time.time()
+
+    clock = VirtualClock(start)
+    panel = SimPanel(trace, clock, panel_faults)
+    plug = SimPlug(clock, plug_faults)
+    end = start + duration
+
+    def sleep(seconds):
+        # main() has no end of its own in continuous mode: stop it at the
+        # end of the trace, from the only place it waits
+        if clock.time() + seconds > end:
+            clock.sleep(end - clock.time())
+            raise EndOfSimulation
+        clock.sleep(seconds)
+
+    log = logging.getLogger('plugger.simulate')
+    log.propagate = False
+    if not log.handlers:
+        log.addHandler(logging.NullHandler())
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = log_file or os.path.join(tmp, 'log.csv')
+        wall = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            try:
+                plugger.main(threshold=threshold, interval=interval,
+                             log_file=path, plug=plug, panel=panel,
+                             clock=clock.time, sleep=sleep,
+                             monotonic=clock.monotonic, log=log,
+                             **main_kwargs)
+            except EndOfSimulation:
+                pass
+        wall = time.perf_counter() - wall
+
+        # main() makes the log after its start-up sleep, which a short
+        # enough run ends in
+        rows = []
+        if os.path.exists(path):
+            with open(path, newline="") as f:
+                rows = list(csv.reader(f))[1:]
+
+    cycles = panel.reads
+    return {'cycles': cycles,
+            'switches': plug.switches,
+            'on_seconds': plug.settle(),
+            'panel_failures': panel.failures,
+            'rows': rows,
+            'wall_seconds': wall,
+            'per_cycle_us': wall / cycles * 1e6 if cycles else None,
+           }
@@ -0,0 +1,579 @@
+"""
+Run the fleets of many sites across a pool of worker processes.
+
+One process runs out of cpu for json, the XOR codec and logging somewhere
+in the thousands of plugs, however its i/o is done.  The Supervisor splits
+the sites (a panel and the loads sharing its output, as in main_fleet())
+into shards, one per worker process, and each worker runs its own control
+loop over its shard.  A site is never split, so its allocation stays
+whole.
+
+Workers send the parent one batched message per report_every seconds over
+a pipe: the csv rows, per site counts and cycle times, and the worker's
+cpu use.  Only the parent writes the logs and serves metrics.  It restarts
+a worker that dies or stops reporting, after a backoff.  When the busiest
+worker's measured cpu use is both high and well over the others', it moves
+a few of that worker's sites to the least busy ones.  A moving site is
+first taken off its old worker, and only given to its new one once the old
+one has let it go, so no two workers ever switch the same plugs.
+
+Workers are started with the spawn method, so they do not inherit the
+parent's log and metrics threads.
+"""
+import logging
+import multiprocessing
+import signal
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing.connection import wait
+
+from pluggerlib.fleet import FleetController, Load
+from pluggerlib.metrics import NULL
+from pluggerlib.panel import make_panel
+from pluggerlib.scheduler import Scheduler
+
+# most threads a worker talks to one site's plugs, or runs sites, with
+SITE_THREADS = 16
+
+
+def make_plug(spec, cache_ttl=5):
+    """Returns a persistent SmartPlug for a load spec with socket_ip and,
+    optionally, socket_port
+    """
+    from tplink_smartplug import SmartPlug
+
+    return SmartPlug(spec['socket_ip'], spec.get('socket_port', 9999),
+                     persistent=True, cache_ttl=cache_ttl)
+
+
+def shard(costs, workers):
+    """Returns a list of workers lists of site names, sharing out costs
+    (dict of site name to cost) as evenly as possible, largest first
+    """
+    shards = [[] for _ in range(workers)]
+    totals = [0.0] * workers
+    for name in sorted(costs, key=lambda name: (-costs[name], name)):
+        i = totals.index(min(totals))
+        shards[i].append(name)
+        totals[i] += costs[name]
+    return shards
+
+
+class Site:
+    # one site's panel and fleet, inside a worker
+    def __init__(self, spec, plug_factory=None, plug_cache_ttl=5,
+                 panel_deadline=5, panel_combine='sum', panel_stale_after=None):
+        """
+        spec is a dict with name, panel_ip, loads (as for main_fleet()) and
+        optionally reserve.  Plugs are made by plug_factory(load_spec,
+        plug_cache_ttl) (default make_plug).
+        """
+        plug_factory = plug_factory or make_plug
+        self.name = spec['name']
+        self.panel = make_panel(spec['panel_ip'], deadline=panel_deadline,
+                                combine=panel_combine,
+                                stale_after=panel_stale_after)
+        loads = [Load(load['name'], plug_factory(load, plug_cache_ttl),
+                      load['rated'], load.get('priority', 0))
+                 for load in spec['loads']]
+        self.fleet = FleetController(loads, reserve=spec.get('reserve', 0),
+                                     max_workers=min(len(loads), SITE_THREADS))
+
+    def cycle(self, ts, mode):
+        """Returns (rows, counts) for one read of the panel and switch of
+        the site's plugs; counts is [panel_failures, switched on, switched
+        off, plug errors, seconds taken]
+        """
+        start = time.perf_counter()
+        reading = self.panel.read()
+        if not reading.success:
+            row = [ts, mode, self.name, False, reading.error,
+                   '', '', '', '', '', '', 'panel ' + (reading.failure or 'error')]
+            return [row], [1, 0, 0, 0, time.perf_counter() - start]
+
+        output = reading.values[self.panel.tags[0]]
+        rows = []
+        counts = [0, 0, 0, 0, 0.0]
+        for result in self.fleet.cycle(output):
+            if result['action'] == 'activate':
+                counts[1] += 1
+            elif result['action'] == 'deactivate':
+                counts[2] += 1
+            if result['error'] is not None:
+                counts[3] += 1
+            rows.append([ts, mode, self.name, True, output, result['plug'],
+                         result['rated'], result['priority'],
+                         result['socket_state'], result['action'],
+                         result['socket_state1'], result['error']])
+        counts[4] = time.perf_counter() - start
+        return rows, counts
+
+    def close(self):
+        self.fleet.close()
+        self.panel.close()
+        for load in self.fleet.loads:
+            if hasattr(load.plug, 'close'):
+                load.plug.close()
+
+
+class _Stop(Exception):
+    pass
+
+
+class Worker:
+    # the control loop over one shard, in a worker process
+    def __init__(self, worker_id, conn, interval=30, report_every=None,
+                 poll_jitter=0, mode='cont', **site_options):
+        self.worker_id = worker_id
+        self.conn = conn
+        self.interval = interval
+        self.report_every = interval if report_every is None else report_every
+        self.poll_jitter = poll_jitter
+        self.mode = mode
+        self.site_options = site_options
+        self.sites = {}
+        self.executor = None
+        self._reset_batch()
+
+    def _reset_batch(self):
+        self.rows = []
+        self.counts = {}
+        self.batch_started = time.monotonic()
+        self.cpu_started = time.process_time()
+
+    def assign(self, specs):
+        """Run specs' sites from the next cycle, closing any others"""
+        names = {spec['name'] for spec in specs}
+        for name in list(self.sites):
+            if name not in names:
+                self.sites.pop(name).close()
+        for spec in specs:
+            if spec['name'] not in self.sites:
+                self.sites[spec['name']] = Site(spec, **self.site_options)
+        if self.executor is not None:
+            self.executor.shutdown(wait=False)
+        self.executor = ThreadPoolExecutor(
+            max_workers=max(1, min(len(self.sites), SITE_THREADS)),
+            thread_name_prefix='site')
+
+    def _command(self, message):
+        if message[0] == 'stop':
+            raise _Stop
+        if message[0] == 'assign':
+            self.assign(message[1])
+            # tells the parent which sites this worker has let go of
+            self.conn.send(('assigned', self.worker_id, sorted(self.sites)))
+
+    def pause(self, seconds):
+        """Sleep for seconds, acting on the parent's messages meanwhile"""
+        end = time.monotonic() + seconds
+        while True:
+            left = end - time.monotonic()
+            if left <= 0:
+                return
+            try:
+                if self.conn.poll(left):
+                    self._command(self.conn.recv())
+            except EOFError:
+                # the parent has gone
+                raise _Stop
+
+    def cycle(self):
+        ts = time.strftime('%d/%m/%y %H:%M:%S')
+        futures = [(name, self.executor.submit(site.cycle, ts, self.mode))
+                   for name, site in self.sites.items()]
+        for name, future in futures:
+            try:
+                rows, counts = future.result()
+            except Exception as e:
+                rows = [[ts, self.mode, name, False, '', '', '', '', '', '',
+                         '', f'site failed: {type(e).__name__}: {e}']]
+                counts = [1, 0, 0, 0, 0.0]
+            self.rows.extend(rows)
+            totals = self.counts.setdefault(name, [0, 0, 0, 0, 0, []])
+            totals[0] += 1
+            for i in range(4):
+                totals[i + 1] += counts[i]
+            totals[5].append(counts[4])
+
+    def report(self):
+        """Send the batch so far to the parent in one message"""
+        elapsed = time.monotonic() - self.batch_started
+        self.conn.send(('report', self.worker_id,
+                        {'rows': self.rows,
+                         'sites': self.counts,
+                         'cpu': time.process_time() - self.cpu_started,
+                         'elapsed': elapsed,
+                        }))
+        self._reset_batch()
+
+    def run(self, specs):
+        self.assign(specs)
+        self.conn.send(('ready', self.worker_id, None))
+        scheduler = Scheduler(self.interval, jitter=self.poll_jitter,
+                              sleep=self.pause)
+        scheduler.start()
+        try:
+            while True:
+                self.cycle()
+                if time.monotonic() - self.batch_started >= self.report_every:
+                    self.report()
+                scheduler.wait()
+        except _Stop:
+            if self.rows:
+                self.report()
+        finally:
+            for site in self.sites.values():
+                site.close()
+
+
+def run_worker(worker_id, conn, specs, options):
+    """Worker process entry point"""
+    # ctrl-c goes to the whole process group: leave stopping to the parent
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    try:
+        Worker(worker_id, conn, **options).run(specs)
+    except Exception:
+        try:
+            conn.send(('error', worker_id, traceback.format_exc()))
+        except OSError:
+            pass
+        raise
+
+
+class _Handle:
+    # the parent's view of one worker
+    def __init__(self, worker_id):
+        self.worker_id = worker_id
+        self.process = None
+        self.conn = None
+        self.sites = []
+        self.started = None
+        self.last_seen = None
+        self.reported = None    # when this process last reported
+        self.restart_at = None
+        self.crashes = 0        # in a row, for the backoff
+        self.restarts = 0
+        self.load = 0.0         # cpu seconds per second, last report
+
+    @property
+    def alive(self):
+        return self.process is not None and self.process.is_alive()
+
+
+class Supervisor:
+    # runs sites in worker processes, restarting and rebalancing them
+    def __init__(self, sites, workers=None, interval=30, on_report=None,
+                 log=None, metrics=NULL, report_every=None, stall_after=None,
+                 restart_base=1.0, restart_cap=60.0, rebalance_every=None,
+                 rebalance_ratio=1.5, rebalance_cpu=0.5, **worker_options):
+        """
+        sites is a list of site specs (see Site).  workers defaults to the
+        number of cpus, and to no more than there are sites.
+
+        on_report(worker_id, rows, counts) is called in the parent for each
+        report, with the rows' columns as pluggerlib.supervisor.Site.cycle
+        makes them.  A worker not heard from for stall_after seconds
+        (default 3 reports plus a minute) is killed and restarted, as is
+        one that dies, after restart_base seconds doubling to restart_cap
+        while it keeps failing.  Every rebalance_every seconds (default 10
+        intervals) sites are moved off the busiest worker if its measured
+        cpu use (cpu seconds per second) is at least rebalance_cpu and over
+        rebalance_ratio times the mean.
+
+        Other keyword arguments go to the workers: poll_jitter, mode,
+        plug_factory (picklable), plug_cache_ttl and the panel options.
+        """
+        names = [spec['name'] for spec in sites]
+        if len(set(names)) != len(names):
+            raise ValueError(f'site names must be unique: {names}')
+        if workers is None:
+            workers = multiprocessing.cpu_count()
+        workers = max(1, min(workers, len(sites)))
+
+        self.specs = {spec['name']: spec for spec in sites}
+        self.interval = interval
+        self.on_report = on_report
+        self.log = log or logging.getLogger(__name__)
+        self.metrics = metrics
+        self.report_every = interval if report_every is None else report_every
+        self.stall_after = (3 * max(self.interval, self.report_every) + 60
+                            if stall_after is None else stall_after)
+        self.restart_base = restart_base
+        self.restart_cap = restart_cap
+        self.rebalance_every = (10 * interval if rebalance_every is None
+                                else rebalance_every)
+        self.rebalance_ratio = rebalance_ratio
+        self.rebalance_cpu = rebalance_cpu
+        self.worker_options = dict(worker_options, interval=interval,
+                                   report_every=self.report_every)
+        self.context = multiprocessing.get_context('spawn')
+
+        self.handles = [_Handle(i) for i in range(workers)]
+        for handle, names in zip(self.handles, shard(
+                {name: len(spec['loads']) + 1
+                 for name, spec in self.specs.items()}, workers)):
+            handle.sites = names
+        # site name: (from handle, to handle) for sites being moved
+        self.moving = {}
+        self.last_rebalance = None
+        self.rebalances = 0
+
+    def _info(self, msg, *args):
+        self.log.info(msg, *args)
+
+    def _spawn(self, handle):
+        parent_conn, child_conn = self.context.Pipe()
+        specs = [self.specs[name] for name in handle.sites]
+        handle.process = self.context.Process(
+            target=run_worker, name=f'plugger-worker-{handle.worker_id}',
+            args=(handle.worker_id, child_conn, specs, self.worker_options),
+            daemon=True)
+        handle.process.start()
+        child_conn.close()
+        handle.conn = parent_conn
+        handle.started = handle.last_seen = time.monotonic()
+        handle.reported = None
+        handle.restart_at = None
+        self.metrics.gauge('worker_sites', 'sites run by each worker',
+                           worker=str(handle.worker_id)).set(len(handle.sites))
+        self._info('[sup 0.20] started worker %s (pid %s) with %s sites',
+                   handle.worker_id, handle.process.pid, len(handle.sites))
+
+    def start(self):
+        for handle in self.handles:
+            self._spawn(handle)
+        self.last_rebalance = time.monotonic()
+
+    def _send(self, handle, message):
+        try:
+            handle.conn.send(message)
+            return True
+        except (OSError, ValueError):
+            return False
+
+    def _receive(self, handle):
+        # act on every message waiting from handle's worker
+        try:
+            while handle.conn.poll():
+                kind, worker_id, payload = handle.conn.recv()
+                handle.last_seen = time.monotonic()
+                if kind == 'report':
+                    self._report(handle, payload)
+                elif kind == 'assigned':
+                    self._released(handle, payload)
+                elif kind == 'error':
+                    self._info('[sup 0.90] worker %s failed:\n%s', worker_id,
+                               payload)
+        except (EOFError, OSError):
+            # the worker has gone: _check() restarts it
+            handle.conn.close()
+            handle.conn = None
+
+    def _report(self, handle, payload):
+        metrics = self.metrics
+        worker = str(handle.worker_id)
+        if payload['elapsed'] > 0:
+            handle.load = payload['cpu'] / payload['elapsed']
+            handle.reported = time.monotonic()
+            metrics.gauge('worker_cpu_ratio', 'worker cpu seconds per second',
+                          worker=worker).set(handle.load)
+        histogram = metrics.histogram('site_cycle_seconds',
+                                      'time to run one site cycle',
+                                      worker=worker)
+        for name, (cycles, panel_failures, on, off, errors,
+                   seconds) in payload['sites'].items():
+            metrics.counter('site_cycles_total', 'site control cycles',
+                            site=name).inc(cycles)
+            if panel_failures:
+                metrics.counter('panel_failures_total', 'failed panel reads',
+                                site=name).inc(panel_failures)
+            if on or off:
+                metrics.counter('switches_total', 'plug switches made',
+                                site=name).inc(on + off)
+            if errors:
+                metrics.counter('plug_errors_total', 'failed plug operations',
+                                site=name).inc(errors)
+            for value in seconds:
+                histogram.observe(value)
+        if self.on_report is not None:
+            self.on_report(handle.worker_id, payload['rows'], payload['sites'])
+
+    def _check(self):
+        # restart workers that have died or stalled, once their backoff ends
+        now = time.monotonic()
+        for handle in self.handles:
+            if handle.restart_at is not None:
+                if now >= handle.restart_at:
+                    self._spawn(handle)
+                continue
+            stalled = now - handle.last_seen > self.stall_after
+            if handle.alive and not stalled:
+                continue
+            if handle.conn is not None:
+                self._receive(handle)
+            if stalled and handle.alive:
+                self._info('[sup 1.00] worker %s silent for %.0fs, killing it',
+                           handle.worker_id, now - handle.last_seen)
+                handle.process.kill()
+            handle.process.join(timeout=5)
+            if handle.conn is not None:
+                handle.conn.close()
+                handle.conn = None
+            # none of its sites are running now
+            self._released(handle, ())
+
+            # a worker that ran a good while before failing starts afresh
+            if now - handle.started > self.restart_cap:
+                handle.crashes = 0
+            delay = min(self.restart_cap, self.restart_base * 2 ** handle.crashes)
+            handle.crashes += 1
+            handle.restarts += 1
+            handle.restart_at = now + delay
+            self.metrics.counter('worker_restarts_total', 'workers restarted',
+                                 worker=str(handle.worker_id)).inc()
+            self._info('[sup 1.10] worker %s exited (code %s), restarting in %.1fs',
+                       handle.worker_id, handle.process.exitcode, delay)
+
+    def _released(self, handle, names):
+        # hand the sites moving off handle's worker, that it no longer
+        # runs (names), to their new workers
+        for name, (source, _) in list(self.moving.items()):
+            if source is handle and name not in names:
+                _, dest = self.moving.pop(name)
+                dest.sites.append(name)
+                self._assign(dest)
+
+    def _assign(self, handle):
+        self.metrics.gauge('worker_sites', 'sites run by each worker',
+                           worker=str(handle.worker_id)).set(len(handle.sites))
+        # a worker waiting to restart picks up its sites then
+        if handle.alive and handle.conn is not None:
+            self._send(handle, ('assign',
+                                [self.specs[name] for name in handle.sites]))
+
+    def loads(self):
+        """Returns (costs, totals): dict of each site's share of its
+        worker's measured cpu use, split by plug count, and dict of worker
+        id to cpu use, for the running workers that have reported
+        """
+        costs, totals = {}, {}
+        for handle in self.handles:
+            if not handle.alive or handle.reported is None:
+                continue
+            totals[handle.worker_id] = handle.load
+            plugs = {name: len(self.specs[name]['loads']) + 1
+                     for name in handle.sites}
+            for name, count in plugs.items():
+                costs[name] = handle.load * count / sum(plugs.values())
+        return costs, totals
+
+    def rebalance(self, force=False):
+        """Move the fewest sites needed off the busiest worker if it is
+        busy and the load is uneven (or force), returning the number of
+        sites moved
+        """
+        if self.moving:
+            # the last moves are not finished
+            return 0
+        costs, totals = self.loads()
+        if len(totals) < 2:
+            return 0
+        before = dict(totals)
+        handles = {handle.worker_id: handle for handle in self.handles}
+        moves = []
+        while True:
+            busiest = max(totals, key=totals.get)
+            idlest = min(totals, key=totals.get)
+            mean = sum(totals.values()) / len(totals)
+            if not (force and not moves) and (
+                    totals[busiest] < self.rebalance_cpu
+                    or totals[busiest] <= self.rebalance_ratio * mean):
+                break
+            # the site that best evens out the pair, if any helps at all
+            gap = totals[busiest] - totals[idlest]
+            sites = [name for name in handles[busiest].sites
+                     if 0 < costs[name] < gap]
+            if not sites:
+                break
+            name = min(sites, key=lambda name: abs(costs[name] - gap / 2))
+            handles[busiest].sites.remove(name)
+            totals[busiest] -= costs[name]
+            totals[idlest] += costs[name]
+            moves.append(name)
+            self.moving[name] = (handles[busiest], handles[idlest])
+        if not moves:
+            return 0
+
+        # take the sites off their old workers now, and give them to the
+        # new ones as the old ones report them stopped (see _released())
+        for source in {self.moving[name][0] for name in moves}:
+            self._assign(source)
+        self.rebalances += 1
+        self.metrics.counter('rebalances_total', 'shard rebalances').inc()
+        self._info('[sup 2.00] rebalancing, moving %s, cpu was %s', ', '.join(
+            f'{name} ({self.moving[name][0].worker_id}->'
+            f'{self.moving[name][1].worker_id})' for name in moves),
+            ', '.join(f'{worker}: {load:.2f}' for worker, load in before.items()))
+        return len(moves)
+
+    def status(self):
+        """Returns list of dicts describing each worker"""
+        now = time.monotonic()
+        return [{'worker': handle.worker_id,
+                 'pid': handle.process.pid if handle.process else None,
+                 'alive': handle.alive,
+                 'sites': len(handle.sites),
+                 'restarts': handle.restarts,
+                 'cpu_ratio': handle.load,
+                 'silent_for': now - handle.last_seen if handle.last_seen else None,
+                } for handle in self.handles]
+
+    def run(self, stop=None, duration=None):
+        """Supervise until the stop event is set, duration seconds pass or
+        ctrl-c, then stop the workers
+        """
+        self.start()
+        end = None if duration is None else time.monotonic() + duration
+        try:
+            while not (stop is not None and stop.is_set()):
+                if end is not None and time.monotonic() >= end:
+                    break
+                conns = {handle.conn: handle for handle in self.handles
+                         if handle.conn is not None}
+                for conn in wait(list(conns), timeout=1.0):
+                    self._receive(conns[conn])
+                self._check()
+                if time.monotonic() - self.last_rebalance >= self.rebalance_every:
+                    self.last_rebalance = time.monotonic()
+                    self.rebalance()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.stop()
+
+    def stop(self, timeout=10):
+        """Ask the workers to stop, taking their last reports, and kill any
+        still running after timeout seconds
+        """
+        for handle in self.handles:
+            handle.restart_at = None
+            if handle.conn is not None:
+                self._send(handle, ('stop',))
+        end = time.monotonic() + timeout
+        while time.monotonic() < end:
+            conns = {handle.conn: handle for handle in self.handles
+                     if handle.conn is not None}
+            if not conns:
+                break
+            for conn in wait(list(conns), timeout=max(0, end - time.monotonic())):
+                self._receive(conns[conn])
+        for handle in self.handles:
+            if handle.process is None:
+                continue
+            handle.process.join(timeout=max(0, end - time.monotonic()))
+            if handle.process.is_alive():
+                handle.process.kill()
+                handle.process.join()
+        self._info('[sup 9.00] workers stopped')
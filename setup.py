@@ -17,6 +17,7 @@ setup(
     url='https://github.com/vrachieru/tplink-smartplug-api',
     packages=find_packages(exclude=('tests',)),
     include_package_data=True,
+    extras_require={'fast': ['numpy']},
     license='MIT',
     classifiers=[
         'Topic :: Scientific/Engineering',
@@ -1 +1,7 @@
-from .api import SmartPlug
\ No newline at end of file
+from .api import BatchResult, SmartPlug
+from .connection import Connection, ConnectionPool
+from .protocol import ProtocolError
+from .rules import CommandError, CountdownRule, ScheduleRule
+from .aio import AsyncSmartPlug
+from .discovery import DiscoveredPlug, discover, find_plug
+from .emeter import EmeterSampler, RingBuffer
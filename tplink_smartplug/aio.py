@@ -0,0 +1,487 @@
+import asyncio
+import datetime
+import json
+
+from .api import pack_batch, unpack_batch
+from .protocol import HEADER, MAX_FRAME, ProtocolError, xor_decrypt, xor_encrypt
+from .rules import CountdownRule, check, countdown_args, parse_countdown, parse_schedule, schedule_args, window_rules
+
+
+class AsyncSmartPlug(object):
+
+    def __init__(self, host, port=9999, timeout=5, persistent=False, semaphore=None):
+        '''
+        Create a new AsyncSmartPlug instance, the asyncio counterpart of SmartPlug.
+
+        Read-only properties return awaitables, so `await plug.is_on` reads
+        like `plug.is_on` on a SmartPlug.  Setters become set_* coroutines.
+
+        To talk to many plugs with bounded concurrency, share one semaphore:
+
+            limit = asyncio.Semaphore(50)
+            plugs = [AsyncSmartPlug(host, semaphore=limit) for host in hosts]
+            states = await asyncio.gather(*(plug.is_on for plug in plugs))
+
+        :param str host: host name or ip address on which the device listens
+        :param int port: port on which the device listens (default: 9999)
+        :param int timeout: timeout for a whole request, in seconds (default: 5)
+        :param bool persistent: keep the connection open between commands (default: False)
+        :param asyncio.Semaphore semaphore: limits requests in flight across plugs sharing it (default: no limit)
+        '''
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.persistent = persistent
+        self.semaphore = semaphore
+        self._streams = None
+        self._lock = None
+
+    @property
+    def info(self):
+        '''
+        Get system information
+
+        :return system information
+        '''
+        return self.command(('system', 'get_sysinfo'))
+
+    @property
+    def device_id(self):
+        '''
+        Get device id
+
+        :return: device id
+        '''
+        return self._info_field('deviceId')
+
+    async def set_device_id(self, device_id):
+        '''
+        Set new device id
+
+        :param str device_id: device id
+        '''
+        return await self.command(('system', 'set_device_id', {'deviceId': device_id}))
+
+    @property
+    def hardware_id(self):
+        '''
+        Get device hardware id
+
+        :return: device hardware id
+        '''
+        return self._info_field('hwId')
+
+    async def set_hardware_id(self, hardware_id):
+        '''
+        Set new hardware id
+
+        :param str hardware_id: hardware id
+        '''
+        return await self.command(('system', 'set_hw_id', {'hwId': hardware_id}))
+
+    @property
+    def model(self):
+        '''
+        Get device model
+
+        :return: device model
+        '''
+        return self._info_field('model')
+
+    @property
+    def mac(self):
+        '''
+        Get mac address
+
+        :return: mac address in hexadecimal with colons, e.g. 01:23:45:67:89:ab
+        '''
+        return self._info_field('mac')
+
+    async def set_mac(self, mac):
+        '''
+        Set new mac address
+
+        :param str mac: mac in hexadecimal with colons, e.g. 01:23:45:67:89:ab
+        '''
+        return await self.command(('system', 'set_mac_addr', {'mac': mac}))
+
+    @property
+    def name(self):
+        '''
+        Get current device name (alias)
+
+        :return: device name aka alias.
+        '''
+        return self._info_field('alias')
+
+    async def set_name(self, name):
+        '''
+        Set the device name aka alias
+
+        :param name: new name
+        '''
+        return await self.command(('system', 'set_dev_alias', {'alias': name}))
+
+    @property
+    def rssi(self):
+        '''
+        Get WiFi signal strength (rssi)
+
+        :return: rssi
+        '''
+        return self._info_field('rssi')
+
+    @property
+    def time(self):
+        '''
+        Get plug date and time
+
+        :return: datetime
+        '''
+        return self._time()
+
+    async def _time(self):
+        dt = await self.command(('time', 'get_time'))
+        return datetime.datetime(dt['year'], dt['month'], dt['mday'], dt['hour'], dt['min'], dt['sec'])
+
+    @property
+    def timezone(self):
+        '''
+        Get timezone
+
+        :return: timezone
+        '''
+        return self.command(('time', 'get_timezone'))
+
+    @property
+    def icon(self):
+        '''
+        Get icon
+
+        :return: plug icon
+        '''
+        return self.command(('system', 'get_dev_icon'))
+
+    async def set_icon(self, icon, hash):
+        '''
+        Set the icon of the plug
+
+        :param str icon: icon id
+        :param str hash: icon hash
+        '''
+        return await self.command(('system', 'set_dev_icon', {'icon': icon, 'hash': hash}))
+
+    @property
+    def location(self):
+        '''
+        Get the plug location
+
+        :return: dict with latitude and longitude
+        '''
+        return self._location()
+
+    async def _location(self):
+        info = await self.info
+        location_keys = ['latitude', 'longitude']
+        return {key: info[key] for key in location_keys}
+
+    async def set_location(self, latitude, longitude):
+        '''
+        Set the plug location
+
+        :param float latitude: location latitude
+        :param float longitude: location longitude
+        '''
+        return await self.command(('system', 'set_dev_location', {'latitude': latitude, 'longitude': longitude}))
+
+    @property
+    def led(self):
+        '''
+        Get the led state
+
+        :return: True if led is on, False otherwise
+        '''
+        return self._led()
+
+    async def _led(self):
+        return bool(1 - await self._info_field('led_off'))
+
+    async def set_led(self, state):
+        '''
+        Set the state of the led (night mode)
+
+        :param bool state: True to set led on, False to set led off
+        '''
+        return await self.command(('system', 'set_led_off', {'off': int(not state)}))
+
+    @property
+    def is_on(self):
+        '''
+        Get whether device is on
+
+        :return: True if device is on, False otherwise
+        '''
+        return self._is_on()
+
+    async def _is_on(self):
+        return bool(await self._info_field('relay_state'))
+
+    async def turn_on(self):
+        '''
+        Turn the plug on
+        '''
+        await self.command(('system', 'set_relay_state', {'state': 1}))
+
+    async def turn_off(self):
+        '''
+        Turn the plug off
+        '''
+        await self.command(('system', 'set_relay_state', {'state': 0}))
+
+    async def reboot(self, delay=1):
+        '''
+        Reboot plug
+
+        :param int delay: reboot delay in seconds (default: 1)
+        '''
+        return await self.command(('system', 'reboot', {'delay': delay}))
+
+    async def factory_reset(self, delay=1):
+        '''
+        Factory reset the plug
+
+        :param int delay: reboot delay in seconds (default: 1)
+        '''
+        return await self.command(('system', 'reset', {'delay': delay}))
+
+    async def emeter_realtime(self):
+        '''
+        Get real-time power readings (HS110 and other plugs with an energy meter)
+
+        :return: dict of readings, keys depend on firmware (see emeter.normalize_realtime)
+        '''
+        return await self.command(('emeter', 'get_realtime'))
+
+    async def emeter_daystat(self, year, month):
+        '''
+        Get daily energy totals for a month
+
+        :param int year: year
+        :param int month: month, 1-12
+        :return: dict with a day_list of daily totals
+        '''
+        return await self.command(('emeter', 'get_daystat', {'year': year, 'month': month}))
+
+    async def emeter_monthstat(self, year):
+        '''
+        Get monthly energy totals for a year
+
+        :param int year: year
+        :return: dict with a month_list of monthly totals
+        '''
+        return await self.command(('emeter', 'get_monthstat', {'year': year}))
+
+    async def emeter_erase(self):
+        '''
+        Erase all stored energy statistics
+        '''
+        return await self.command(('emeter', 'erase_emeter_stat'))
+
+    async def countdown_rules(self):
+        '''
+        Get the countdown rules on the plug
+
+        :return: list of CountdownRule
+        '''
+        response = check('get_rules', await self.command(('count_down', 'get_rules')))
+        return [parse_countdown(rule) for rule in response.get('rule_list', [])]
+
+    async def set_countdown(self, delay, on=False, name='plugger countdown'):
+        '''
+        Switch the plug on or off after delay seconds, replacing any countdown already set
+
+        :param int delay: seconds from now
+        :param bool on: state to switch to (default: off)
+        :param str name: rule name (default: 'plugger countdown')
+        :return: CountdownRule as set, with its id
+        '''
+        rule = CountdownRule(None, delay, on, True, name)
+        check('delete_all_rules', await self.command(('count_down', 'delete_all_rules')))
+        response = check('add_rule', await self.command(('count_down', 'add_rule', countdown_args(rule))))
+        return rule._replace(id=response.get('id'))
+
+    async def clear_countdown(self):
+        '''
+        Delete any countdown rule
+        '''
+        check('delete_all_rules', await self.command(('count_down', 'delete_all_rules')))
+
+    async def schedule_rules(self):
+        '''
+        Get the schedule rules on the plug
+
+        :return: list of ScheduleRule
+        '''
+        response = check('get_rules', await self.command(('schedule', 'get_rules')))
+        return [parse_schedule(rule) for rule in response.get('rule_list', [])]
+
+    async def add_schedule(self, rule):
+        '''
+        Add a schedule rule
+
+        :param ScheduleRule rule: rule to add, its id is ignored
+        :return: id of the new rule
+        '''
+        response = check('add_rule', await self.command(('schedule', 'add_rule', schedule_args(rule._replace(id=None)))))
+        return response.get('id')
+
+    async def delete_schedule(self, rule_id):
+        '''
+        Delete a schedule rule
+
+        :param str rule_id: id of the rule
+        '''
+        check('delete_rule', await self.command(('schedule', 'delete_rule', {'id': rule_id})))
+
+    async def clear_schedules(self):
+        '''
+        Delete every schedule rule
+        '''
+        check('delete_all_rules', await self.command(('schedule', 'delete_all_rules')))
+
+    async def set_windows(self, windows, name='plugger window'):
+        '''
+        Have the plug switch itself on at the start and off at the end of each time window, every day
+
+        :param windows: iterable of (start, end) times, as 'HH:MM' or minutes from midnight
+        :param str name: name to give the rules, replacing rules of that name (default: 'plugger window')
+        :return: list of ScheduleRule as set, with their ids
+        '''
+        rules = window_rules(windows, name)
+        for old in await self.schedule_rules():
+            if old.name == name:
+                await self.delete_schedule(old.id)
+        rules = [rule._replace(id=await self.add_schedule(rule)) for rule in rules]
+        check('set_overall_enable', await self.command(('schedule', 'set_overall_enable', {'enable': 1})))
+        return rules
+
+    async def _info_field(self, key):
+        info = await self.info
+        return info[key]
+
+    async def command(self, cmd):
+        '''
+        Request information from a TP-Link SmartHome Device and return the response
+
+        :param cmd: command to send to the device (can be either tuple, dict or json string)
+        :return: json response
+        '''
+        if isinstance(cmd, tuple):
+            target, cmd, args = (cmd + ({},))[:3]
+            cmd = {target: {cmd: args}}
+
+        response = await self.request(cmd)
+        response = response.get(list(response)[0]) # extract target
+        response = response.get(list(response)[0]) # extract command
+
+        return response
+
+    async def command_many(self, cmds):
+        '''
+        Send several commands in one request and return a result per command
+
+        :param cmds: iterable of (target, cmd) or (target, cmd, args) tuples
+        :return: list of BatchResult, in the order the commands were given
+        '''
+        cmds, request = pack_batch(cmds)
+        return unpack_batch(cmds, await self.request(request))
+
+    async def request(self, request):
+        '''
+        Send a json document to the device and return the whole json response
+
+        :param request: request document (can be either dict or json string)
+        :return: dict response, keyed by target and command
+        '''
+        if isinstance(request, dict):
+            request = json.dumps(request)
+        plainbytes = request.encode()
+        payload = HEADER.pack(len(plainbytes)) + xor_encrypt(plainbytes)
+
+        if self.semaphore is None:
+            data = await asyncio.wait_for(self._send(payload), self.timeout)
+        else:
+            async with self.semaphore:
+                data = await asyncio.wait_for(self._send(payload), self.timeout)
+
+        return json.loads(xor_decrypt(data).decode())
+
+    async def close(self):
+        '''
+        Close a persistent connection to the plug, if one is open
+        '''
+        if self._streams is not None:
+            reader, writer = self._streams
+            self._streams = None
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except OSError:
+                pass
+
+    async def _send(self, payload):
+        if not self.persistent:
+            reader, writer = await asyncio.open_connection(self.host, self.port)
+            try:
+                return await self._exchange(reader, writer, payload)
+            finally:
+                writer.close()
+                try:
+                    await writer.wait_closed()
+                except OSError:
+                    pass
+
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        async with self._lock:
+            reused = self._streams is not None
+            try:
+                return await self._persistent_exchange(payload)
+            except (ConnectionError, OSError):
+                await self.close()
+                if not reused:
+                    raise
+            # the device closed an idle connection, try again on a fresh one
+            try:
+                return await self._persistent_exchange(payload)
+            except:
+                await self.close()
+                raise
+
+    async def _persistent_exchange(self, payload):
+        if self._streams is None:
+            self._streams = await asyncio.open_connection(self.host, self.port)
+        reader, writer = self._streams
+        try:
+            return await self._exchange(reader, writer, payload)
+        except asyncio.CancelledError:
+            # a timeout mid-response leaves the stream out of step
+            await self.close()
+            raise
+
+    async def _exchange(self, reader, writer, payload):
+        writer.write(payload)
+        await writer.drain()
+        try:
+            header = await reader.readexactly(HEADER.size)
+        except asyncio.IncompleteReadError as e:
+            if not e.partial:
+                raise ConnectionResetError('connection closed before a response was received')
+            raise ProtocolError('connection closed inside a frame header')
+        length, = HEADER.unpack(header)
+        if length > MAX_FRAME:
+            raise ProtocolError('response frame of %d bytes exceeds limit of %d' % (length, MAX_FRAME))
+        try:
+            return await reader.readexactly(length)
+        except asyncio.IncompleteReadError as e:
+            raise ProtocolError('connection closed after %d of %d bytes' % (len(e.partial), length))
@@ -1,21 +1,77 @@
 import json
 import socket
-import struct
 import datetime
+from collections import namedtuple
+from time import monotonic
+
+from .connection import default_pool
+from .protocol import HEADER, recv_frame, xor_decrypt, xor_encrypt
+from .rules import (CommandError, CountdownRule, check, countdown_args, parse_countdown, parse_schedule,
+                    schedule_args, window_rules)
+
+# one command's outcome from SmartPlug.command_many
+BatchResult = namedtuple('BatchResult', ['target', 'cmd', 'err_code', 'response'])
+
+
+def pack_batch(cmds):
+    '''
+    Pack several commands into one request document
+
+    :param cmds: iterable of (target, cmd) or (target, cmd, args) tuples
+    :return: tuple of the normalised (target, cmd, args) list and the request dict
+    '''
+    cmds = [(tuple(cmd) + ({},))[:3] for cmd in cmds]
+    request = {}
+    for target, cmd, args in cmds:
+        commands = request.setdefault(target, {})
+        if cmd in commands:
+            raise ValueError('%s.%s given more than once' % (target, cmd))
+        commands[cmd] = args
+    return cmds, request
+
+
+def unpack_batch(cmds, response):
+    '''
+    Split a response document into one BatchResult per command
+
+    :param list cmds: normalised (target, cmd, args) tuples, as from pack_batch
+    :param dict response: response document
+    :return: list of BatchResult, in the order of cmds
+    '''
+    results = []
+    for target, cmd, args in cmds:
+        target_response = response.get(target, {})
+        if cmd in target_response:
+            cmd_response = target_response[cmd]
+        else:
+            # the whole target failed, e.g. emeter on a plug without one
+            cmd_response = dict(target_response) or {'err_code': None, 'err_msg': 'no response'}
+        results.append(BatchResult(target, cmd, cmd_response.get('err_code'), cmd_response))
+    return results
+
 
 class SmartPlug(object):
 
-    def __init__(self, host, port=9999, timeout=5):
+    def __init__(self, host, port=9999, timeout=5, persistent=False, pool=None, cache_ttl=None):
         '''
         Create a new SmartPlug instance.
 
         :param str host: host name or ip address on which the device listens
         :param int port: port on which the device listens (default: 9999)
         :param int timeout: socket timeout (default: 5)
+        :param bool persistent: keep the connection open between commands (default: False)
+        :param ConnectionPool pool: pool to share connections through when persistent (default: shared module pool)
+        :param float cache_ttl: seconds to reuse a sysinfo response for (default: no caching)
         '''
         self.host = host
         self.port = port
         self.timeout = timeout
+        self.persistent = persistent
+        self.pool = pool if pool is not None else default_pool
+        self.cache_ttl = cache_ttl
+        self._sysinfo = None
+        self._sysinfo_time = 0.0
+        self._countdown_id = None
 
     @property
     def info(self):
@@ -24,7 +80,41 @@ class SmartPlug(object):
 
         :return system information
         '''
-        return self.command(('system', 'get_sysinfo'))
+        if self.cache_ttl and self._sysinfo is not None:
+            if monotonic() - self._sysinfo_time < self.cache_ttl:
+                return dict(self._sysinfo)
+
+        info = self.command(('system', 'get_sysinfo'))
+        if self.cache_ttl:
+            self._sysinfo = dict(info)
+            self._sysinfo_time = monotonic()
+        return info
+
+    def invalidate(self):
+        '''
+        Drop the cached system information, so the next read goes to the plug
+        '''
+        self._sysinfo = None
+
+    def _set(self, cmd, **patch):
+        '''
+        Send a command that changes system information and keep the cache in step
+
+        :param tuple cmd: command to send
+        :param patch: sysinfo fields to update in the cache once the plug acknowledges
+        :return: json response
+        '''
+        try:
+            response = self.command(cmd)
+        except:
+            self.invalidate()
+            raise
+
+        if patch and self._sysinfo is not None and response.get('err_code') == 0:
+            self._sysinfo.update(patch)
+        else:
+            self.invalidate()
+        return response
 
     @property
     def device_id(self):
@@ -42,7 +132,7 @@ class SmartPlug(object):
         
         :param str device_id: device id
         '''
-        return self.command(('system', 'set_device_id', {'deviceId': device_id}))
+        return self._set(('system', 'set_device_id', {'deviceId': device_id}), deviceId=device_id)
 
     @property
     def hardware_id(self):
@@ -60,7 +150,7 @@ class SmartPlug(object):
         
         :param str hardware_id: hardware id
         '''
-        return self.command(('system', 'set_hw_id', {'hwId': hardware_id}))
+        return self._set(('system', 'set_hw_id', {'hwId': hardware_id}), hwId=hardware_id)
 
     @property
     def model(self):
@@ -87,7 +177,7 @@ class SmartPlug(object):
         
         :param str mac: mac in hexadecimal with colons, e.g. 01:23:45:67:89:ab
         '''
-        return self.command(('system', 'set_mac_addr', {'mac': mac}))
+        return self._set(('system', 'set_mac_addr', {'mac': mac}), mac=mac)
 
     @property
     def name(self):
@@ -105,7 +195,7 @@ class SmartPlug(object):
 
         :param name: new name
         '''
-        return self.command(('system', 'set_dev_alias', {'alias': name}))
+        return self._set(('system', 'set_dev_alias', {'alias': name}), alias=name)
 
     @property
     def rssi(self):
@@ -173,7 +263,8 @@ class SmartPlug(object):
         :param float latitude: location latitude
         :param float longitude: location longitude
         '''
-        self.command(('system', 'set_dev_location', {'latitude': latitude, 'longitude': longitude}))
+        self._set(('system', 'set_dev_location', {'latitude': latitude, 'longitude': longitude}),
+                  latitude=latitude, longitude=longitude)
 
     @property
     def led(self):
@@ -191,7 +282,7 @@ class SmartPlug(object):
         
         :param bool state: True to set led on, False to set led off
         '''
-        self.command('system', 'set_led_off', {'off': int(not state)})
+        self._set(('system', 'set_led_off', {'off': int(not state)}), led_off=int(not state))
 
     @property
     def is_on(self):
@@ -206,13 +297,13 @@ class SmartPlug(object):
         '''
         Turn the plug on
         '''
-        self.command(('system', 'set_relay_state', {'state': 1}))
+        self._set(('system', 'set_relay_state', {'state': 1}), relay_state=1)
 
     def turn_off(self):
         '''
         Turn the plug off
         '''
-        self.command(('system', 'set_relay_state', {'state': 0}))
+        self._set(('system', 'set_relay_state', {'state': 0}), relay_state=0)
 
     def reboot(self, delay=1):
         '''
@@ -220,7 +311,7 @@ class SmartPlug(object):
 
         :param int delay: reboot delay in seconds (default: 1)
         '''
-        return self.command(('system', 'reboot', {'delay': delay}))
+        return self._set(('system', 'reboot', {'delay': delay}))
 
     def factory_reset(self, delay=1):
         '''
@@ -228,7 +319,153 @@ class SmartPlug(object):
 
         :param int delay: reboot delay in seconds (default: 1)
         '''
-        return self.command(('system', 'reset', {'delay': delay}))
+        return self._set(('system', 'reset', {'delay': delay}))
+
+    def emeter_realtime(self):
+        '''
+        Get real-time power readings (HS110 and other plugs with an energy meter)
+
+        :return: dict of readings, keys depend on firmware (see emeter.normalize_realtime)
+        '''
+        return self.command(('emeter', 'get_realtime'))
+
+    def emeter_daystat(self, year, month):
+        '''
+        Get daily energy totals for a month
+
+        :param int year: year
+        :param int month: month, 1-12
+        :return: dict with a day_list of daily totals
+        '''
+        return self.command(('emeter', 'get_daystat', {'year': year, 'month': month}))
+
+    def emeter_monthstat(self, year):
+        '''
+        Get monthly energy totals for a year
+
+        :param int year: year
+        :return: dict with a month_list of monthly totals
+        '''
+        return self.command(('emeter', 'get_monthstat', {'year': year}))
+
+    def emeter_erase(self):
+        '''
+        Erase all stored energy statistics
+        '''
+        return self.command(('emeter', 'erase_emeter_stat'))
+
+    def countdown_rules(self):
+        '''
+        Get the countdown rules on the plug
+
+        :return: list of CountdownRule
+        '''
+        response = check('get_rules', self.command(('count_down', 'get_rules')))
+        return [parse_countdown(rule) for rule in response.get('rule_list', [])]
+
+    def set_countdown(self, delay, on=False, name='plugger countdown'):
+        '''
+        Switch the plug on or off after delay seconds, replacing any countdown already set
+
+        Setting it again before it runs out starts the delay afresh, so a
+        controller re-arming an off countdown each poll has the plug turn
+        itself off if the controller stops.
+
+        :param int delay: seconds from now
+        :param bool on: state to switch to (default: off)
+        :param str name: rule name (default: 'plugger countdown')
+        :return: CountdownRule as set, with its id
+        '''
+        rule = CountdownRule(self._countdown_id, delay, on, True, name)
+        if rule.id is not None:
+            # one round trip while the rule set last time is still there
+            if self.command(('count_down', 'edit_rule', countdown_args(rule))).get('err_code') == 0:
+                return rule
+        check('delete_all_rules', self.command(('count_down', 'delete_all_rules')))
+        response = check('add_rule', self.command(('count_down', 'add_rule', countdown_args(rule._replace(id=None)))))
+        self._countdown_id = response.get('id')
+        return rule._replace(id=self._countdown_id)
+
+    def clear_countdown(self):
+        '''
+        Delete any countdown rule
+        '''
+        self._countdown_id = None
+        check('delete_all_rules', self.command(('count_down', 'delete_all_rules')))
+
+    def turn_on_for(self, seconds):
+        '''
+        Turn the plug on, and have it turn itself off after seconds unless the countdown is set again
+
+        Once a countdown has been set, arming it and switching cost one round trip.
+
+        :param int seconds: seconds until the plug turns itself off
+        '''
+        if self._countdown_id is None:
+            self.set_countdown(seconds)
+            self.turn_on()
+            return
+
+        rule = CountdownRule(self._countdown_id, seconds, False, True, 'plugger countdown')
+        armed, switched = self.command_many([('count_down', 'edit_rule', countdown_args(rule)),
+                                             ('system', 'set_relay_state', {'state': 1})])
+        if switched.err_code != 0:
+            raise CommandError('set_relay_state', switched.response)
+        if armed.err_code != 0:
+            self._countdown_id = None
+            self.set_countdown(seconds)
+
+    def schedule_rules(self):
+        '''
+        Get the schedule rules on the plug
+
+        :return: list of ScheduleRule
+        '''
+        response = check('get_rules', self.command(('schedule', 'get_rules')))
+        return [parse_schedule(rule) for rule in response.get('rule_list', [])]
+
+    def add_schedule(self, rule):
+        '''
+        Add a schedule rule
+
+        :param ScheduleRule rule: rule to add, its id is ignored
+        :return: id of the new rule
+        '''
+        response = check('add_rule', self.command(('schedule', 'add_rule', schedule_args(rule._replace(id=None)))))
+        return response.get('id')
+
+    def delete_schedule(self, rule_id):
+        '''
+        Delete a schedule rule
+
+        :param str rule_id: id of the rule
+        '''
+        check('delete_rule', self.command(('schedule', 'delete_rule', {'id': rule_id})))
+
+    def clear_schedules(self):
+        '''
+        Delete every schedule rule
+        '''
+        check('delete_all_rules', self.command(('schedule', 'delete_all_rules')))
+
+    def set_windows(self, windows, name='plugger window'):
+        '''
+        Have the plug switch itself on at the start and off at the end of each time window, every day
+
+        Rules named name from an earlier call are replaced, and other
+        schedule rules are left alone.
+
+        :param windows: iterable of (start, end) times, as 'HH:MM' or minutes from midnight
+        :param str name: name to give the rules (default: 'plugger window')
+        :return: list of ScheduleRule as set, with their ids
+        '''
+        rules = window_rules(windows, name)
+        for old in self.schedule_rules():
+            if old.name == name:
+                self.delete_schedule(old.id)
+        rules = [rule._replace(id=self.add_schedule(rule)) for rule in rules]
+        check('set_overall_enable', self.command(('schedule', 'set_overall_enable', {'enable': 1})))
+        return rules
 
     def command(self, cmd):
         '''
@@ -241,23 +478,72 @@ class SmartPlug(object):
             target, cmd, args = (cmd + ({},))[:3]
             cmd = {target: {cmd: args}}
 
-        if isinstance(cmd, dict):
-            cmd = json.dumps(cmd)
-
-        try:
-            sock = socket.create_connection((self.host, self.port), self.timeout)
-            sock.send(self.encrypt(cmd))
-            data = sock.recv(4096)
-        finally:
-            sock.close()
-
-        response = self.decrypt(data[4:])
-        response = json.loads(response)
+        response = self.request(cmd)
         response = response.get(list(response)[0]) # extract target
         response = response.get(list(response)[0]) # extract command
         
         return response
 
+    def command_many(self, cmds):
+        '''
+        Send several commands in one request and return a result per command
+
+        The commands are packed into a single json document, e.g.
+        {"system": {"get_sysinfo": {}}, "emeter": {"get_realtime": {}}},
+        so they cost one round trip between them.
+
+        :param cmds: iterable of (target, cmd) or (target, cmd, args) tuples
+        :return: list of BatchResult, in the order the commands were given
+        '''
+        cmds, request = pack_batch(cmds)
+
+        # anything but a get_ may change sysinfo, and the order the device
+        # applies commands within one request is not guaranteed
+        mutating = any(not cmd.startswith('get_') for target, cmd, args in cmds)
+        try:
+            response = self.request(request)
+        finally:
+            if mutating:
+                self.invalidate()
+
+        results = unpack_batch(cmds, response)
+
+        if self.cache_ttl and not mutating:
+            for result in results:
+                if (result.target, result.cmd) == ('system', 'get_sysinfo') and result.err_code == 0:
+                    self._sysinfo = dict(result.response)
+                    self._sysinfo_time = monotonic()
+
+        return results
+
+    def request(self, request):
+        '''
+        Send a json document to the device and return the whole json response
+
+        :param request: request document (can be either dict or json string)
+        :return: dict response, keyed by target and command
+        '''
+        if isinstance(request, dict):
+            request = json.dumps(request)
+
+        if self.persistent:
+            data = self.pool.request(self.host, self.port, self.timeout, self.encrypt(request))
+        else:
+            sock = socket.create_connection((self.host, self.port), self.timeout)
+            try:
+                sock.sendall(self.encrypt(request))
+                data = recv_frame(sock)
+            finally:
+                sock.close()
+
+        return json.loads(self.decrypt(data))
+
+    def close(self):
+        '''
+        Close any idle persistent connections to the plug
+        '''
+        self.pool.clear(self.host, self.port)
+
     def encrypt(self, plaintext):
         '''
         Encrypt a request for a TP-Link Smart Home Device
@@ -265,17 +551,8 @@ class SmartPlug(object):
         :param request: plaintext request data
         :return: ciphertext request
         '''
-        key = 171
-
         plainbytes = plaintext.encode()
-        buffer = bytearray(struct.pack('>I', len(plainbytes)))
-
-        for plainbyte in plainbytes:
-            cipherbyte = key ^ plainbyte
-            key = cipherbyte
-            buffer.append(cipherbyte)
-
-        return bytes(buffer)
+        return HEADER.pack(len(plainbytes)) + xor_encrypt(plainbytes)
 
     def decrypt(self, ciphertext):
         '''
@@ -284,14 +561,4 @@ class SmartPlug(object):
         :param ciphertext: encrypted response data
         :return: plaintext response
         '''
-        key = 171
-
-        buffer = []
-        for cipherbyte in ciphertext:
-            plainbyte = key ^ cipherbyte
-            key = cipherbyte
-            buffer.append(plainbyte)
-
-        plaintext = bytes(buffer)
-
-        return plaintext.decode()
+        return xor_decrypt(ciphertext).decode()
@@ -0,0 +1,161 @@
+import socket
+import threading
+
+from .protocol import recv_frame
+
+
+class Connection(object):
+
+    def __init__(self, host, port=9999, timeout=5):
+        '''
+        A TCP connection to a TP-Link Smart Home Device that can be reused
+        across several commands.
+
+        :param str host: host name or ip address on which the device listens
+        :param int port: port on which the device listens (default: 9999)
+        :param int timeout: socket timeout (default: 5)
+        '''
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.sock = None
+
+    @property
+    def connected(self):
+        '''
+        :return: True if the underlying socket is open
+        '''
+        return self.sock is not None
+
+    def connect(self):
+        '''
+        Open the underlying socket if it is not already open
+        '''
+        if self.sock is None:
+            self.sock = socket.create_connection((self.host, self.port), self.timeout)
+            self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def close(self):
+        '''
+        Close the underlying socket
+        '''
+        if self.sock is not None:
+            try:
+                self.sock.close()
+            finally:
+                self.sock = None
+
+    def request(self, payload):
+        '''
+        Send an encrypted request and return the encrypted response.
+
+        If the socket was reused from an earlier request and the device has
+        dropped it in the meantime, reconnect once and resend.  Only a reset,
+        broken pipe or close before any reply counts as dropped: after a
+        timeout the device may already have run the command, so it is not
+        sent again.
+
+        :param bytes payload: encrypted request, including the length prefix
+        :return: encrypted response payload, without the length prefix
+        '''
+        reused = self.connected
+        self.connect()
+        try:
+            return self._exchange(payload)
+        except (ConnectionResetError, ConnectionAbortedError, BrokenPipeError):
+            self.close()
+            if not reused:
+                raise
+        except:
+            self.close()
+            raise
+
+        # the device closed an idle connection, try again on a fresh one
+        self.connect()
+        try:
+            return self._exchange(payload)
+        except:
+            self.close()
+            raise
+
+    def _exchange(self, payload):
+        self.sock.sendall(payload)
+        return recv_frame(self.sock)
+
+
+class ConnectionPool(object):
+
+    def __init__(self, max_idle=4):
+        '''
+        A pool of idle connections, shared by every SmartPlug talking to the
+        same host and port.
+
+        :param int max_idle: idle connections kept per device (default: 4)
+        '''
+        self.max_idle = max_idle
+        self._idle = {}
+        self._lock = threading.Lock()
+
+    def acquire(self, host, port=9999, timeout=5):
+        '''
+        Take an idle connection to a device, or make a new (unopened) one
+
+        :return: Connection
+        '''
+        with self._lock:
+            idle = self._idle.get((host, port))
+            if idle:
+                conn = idle.pop()
+                conn.timeout = timeout
+                if conn.sock is not None:
+                    conn.sock.settimeout(timeout)
+                return conn
+        return Connection(host, port, timeout)
+
+    def release(self, conn):
+        '''
+        Return a connection to the pool once a request has completed
+        '''
+        if not conn.connected:
+            return
+        with self._lock:
+            idle = self._idle.setdefault((conn.host, conn.port), [])
+            if len(idle) < self.max_idle:
+                idle.append(conn)
+                return
+        conn.close()
+
+    def request(self, host, port, timeout, payload):
+        '''
+        Send a request over a pooled connection
+
+        :param bytes payload: encrypted request, including the length prefix
+        :return: encrypted response payload, without the length prefix
+        '''
+        conn = self.acquire(host, port, timeout)
+        try:
+            data = conn.request(payload)
+        except:
+            conn.close()
+            raise
+        self.release(conn)
+        return data
+
+    def clear(self, host=None, port=9999):
+        '''
+        Close idle connections, either to one device or to all of them
+
+        :param str host: device to close connections to (default: all devices)
+        :param int port: port of the device (default: 9999)
+        '''
+        with self._lock:
+            if host is None:
+                idle = [conn for conns in self._idle.values() for conn in conns]
+                self._idle.clear()
+            else:
+                idle = self._idle.pop((host, port), [])
+        for conn in idle:
+            conn.close()
+
+
+default_pool = ConnectionPool()
@@ -0,0 +1,88 @@
+import json
+import socket
+from collections import namedtuple
+from time import monotonic
+
+from .protocol import xor_decrypt, xor_encrypt
+
+# a device that answered discovery, with its sysinfo
+DiscoveredPlug = namedtuple('DiscoveredPlug', ['host', 'port', 'sysinfo'])
+
+SYSINFO_REQUEST = xor_encrypt(json.dumps({'system': {'get_sysinfo': {}}}).encode())
+
+
+def normalize_mac(mac):
+    '''
+    Put a mac address in the form the plugs report, e.g. 01:23:45:67:89:AB
+
+    :param str mac: mac address, with or without separators
+    :return: upper case mac address with colons
+    '''
+    digits = ''.join(c for c in mac if c.isalnum()).upper()
+    return ':'.join(digits[i:i + 2] for i in range(0, len(digits), 2))
+
+
+def discover(timeout=1, target='255.255.255.255', port=9999, key='mac', stop=None):
+    '''
+    Broadcast a get_sysinfo request over UDP and collect every reply until the deadline
+
+    Over UDP the request and reply are encrypted as usual but carry no
+    length prefix.
+
+    :param float timeout: seconds to wait for replies (default: 1)
+    :param str target: broadcast address, e.g. 192.168.1.255 for one /24 (default: 255.255.255.255)
+    :param int port: port on which the devices listen (default: 9999)
+    :param str key: 'mac' or 'deviceId', what to key the result by (default: 'mac')
+    :param stop: optional function of the result so far, return True to stop waiting early
+    :return: dict of DiscoveredPlug keyed by mac address or device id
+    '''
+    found = {}
+    deadline = monotonic() + timeout
+
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+        sock.sendto(SYSINFO_REQUEST, (target, port))
+
+        while True:
+            remaining = deadline - monotonic()
+            if remaining <= 0:
+                break
+            sock.settimeout(remaining)
+            try:
+                data, (host, reply_port) = sock.recvfrom(65536)
+            except socket.timeout:
+                break
+
+            try:
+                sysinfo = json.loads(xor_decrypt(data).decode())['system']['get_sysinfo']
+            except (ValueError, KeyError, TypeError):
+                continue    # not a plug, or not a sysinfo reply
+
+            if key == 'mac':
+                ident = normalize_mac(sysinfo.get('mac') or sysinfo.get('mic_mac') or host)
+            else:
+                ident = sysinfo.get(key, host)
+            found[ident] = DiscoveredPlug(host, port, sysinfo)
+
+            if stop is not None and stop(found):
+                break
+    finally:
+        sock.close()
+
+    return found
+
+
+def find_plug(mac, timeout=1, target='255.255.255.255', port=9999):
+    '''
+    Find the current address of a plug by its mac address
+
+    :param str mac: mac address of the plug
+    :param float timeout: seconds to wait for the plug to answer (default: 1)
+    :param str target: broadcast address (default: 255.255.255.255)
+    :param int port: port on which the devices listen (default: 9999)
+    :return: DiscoveredPlug, or None if the plug did not answer
+    '''
+    mac = normalize_mac(mac)
+    found = discover(timeout, target, port, stop=lambda found: mac in found)
+    return found.get(mac)
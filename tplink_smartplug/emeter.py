@@ -0,0 +1,218 @@
+import threading
+import time
+from array import array
+
+FIELDS = ('timestamp', 'voltage', 'current', 'power')
+
+
+def normalize_realtime(reading):
+    '''
+    Convert a get_realtime response to volts, amps and watts
+
+    Older firmware reports voltage, current and power in V, A and W;
+    newer firmware reports voltage_mv, current_ma and power_mw.
+
+    :param dict reading: get_realtime response
+    :return: tuple of (voltage, current, power)
+    '''
+    if 'power_mw' in reading:
+        return (reading['voltage_mv'] / 1000.0,
+                reading['current_ma'] / 1000.0,
+                reading['power_mw'] / 1000.0)
+    return (float(reading['voltage']), float(reading['current']), float(reading['power']))
+
+
+class RingBuffer(object):
+
+    def __init__(self, size):
+        '''
+        A fixed-size buffer of (timestamp, voltage, current, power) samples,
+        one preallocated array per field, overwriting the oldest sample when full.
+
+        :param int size: number of samples kept
+        '''
+        if size < 1:
+            raise ValueError('size must be at least 1')
+        self.size = size
+        self.columns = {field: array('d', bytes(8 * size)) for field in FIELDS}
+        self.count = 0      # samples held, at most size
+        self.head = 0       # slot the next sample goes in
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return self.count
+
+    def append(self, timestamp, voltage, current, power):
+        '''
+        Add a sample, overwriting the oldest one if the buffer is full
+
+        :param float timestamp: seconds since the epoch
+        '''
+        with self.lock:
+            i = self.head
+            columns = self.columns
+            columns['timestamp'][i] = timestamp
+            columns['voltage'][i] = voltage
+            columns['current'][i] = current
+            columns['power'][i] = power
+            self.head = (i + 1) % self.size
+            if self.count < self.size:
+                self.count += 1
+
+    def latest(self):
+        '''
+        :return: dict of the newest sample, or None if empty
+        '''
+        with self.lock:
+            if not self.count:
+                return None
+            i = (self.head - 1) % self.size
+            return {field: self.columns[field][i] for field in FIELDS}
+
+    def _slot(self, n):
+        # physical slot of the n-th oldest sample
+        return (self.head - self.count + n) % self.size
+
+    def _segments(self, seconds=None, now=None):
+        # (start, stop) physical slices, oldest first, covering the window
+        first = 0
+        if seconds is not None:
+            if now is None:
+                now = time.time()
+            since = now - seconds
+            timestamps = self.columns['timestamp']
+            lo, hi = 0, self.count
+            while lo < hi:
+                mid = (lo + hi) // 2
+                if timestamps[self._slot(mid)] < since:
+                    lo = mid + 1
+                else:
+                    hi = mid
+            first = lo
+
+        n = self.count - first
+        if n <= 0:
+            return []
+        start = self._slot(first)
+        if start + n <= self.size:
+            return [(start, start + n)]
+        return [(start, self.size), (0, start + n - self.size)]
+
+    def _views(self, field, segments):
+        view = memoryview(self.columns[field])
+        return [view[start:stop] for start, stop in segments]
+
+    def mean(self, field='power', seconds=None, now=None):
+        '''
+        Mean of a field over the samples in the window
+
+        :param str field: 'voltage', 'current' or 'power' (default: 'power')
+        :param float seconds: window length back from now (default: whole buffer)
+        :param float now: end of the window, seconds since the epoch (default: time.time())
+        :return: float, or None if the window is empty
+        '''
+        with self.lock:
+            views = self._views(field, self._segments(seconds, now))
+            n = sum(len(v) for v in views)
+            return sum(sum(v) for v in views) / n if n else None
+
+    def max(self, field='power', seconds=None, now=None):
+        '''
+        Largest value of a field over the samples in the window
+
+        :return: float, or None if the window is empty
+        '''
+        with self.lock:
+            views = [v for v in self._views(field, self._segments(seconds, now)) if len(v)]
+            return max(max(v) for v in views) if views else None
+
+    def energy(self, seconds=None, now=None):
+        '''
+        Energy used over the window, by the trapezoidal rule over the power samples
+
+        :return: energy in watt hours
+        '''
+        with self.lock:
+            segments = self._segments(seconds, now)
+            timestamps = self._views('timestamp', segments)
+            powers = self._views('power', segments)
+
+            joules = 0.0
+            prev = None
+            for ts, ps in zip(timestamps, powers):
+                if prev is not None and len(ts):
+                    # join across the wrap-around
+                    joules += (ts[0] - prev[0]) * (ps[0] + prev[1]) / 2
+                joules += sum((t1 - t0) * (p0 + p1) / 2
+                              for t0, t1, p0, p1 in zip(ts, ts[1:], ps, ps[1:]))
+                if len(ts):
+                    prev = (ts[-1], ps[-1])
+            return joules / 3600.0
+
+
+class EmeterSampler(object):
+
+    def __init__(self, plug, rate=1.0, size=3600):
+        '''
+        Poll a plug's get_realtime in a background thread into a RingBuffer.
+
+        Polls are on a fixed schedule, so the rate does not drift with the
+        time each request takes; if a request overruns, the missed polls are
+        skipped rather than bunched up.  A plug made with persistent=True
+        saves a handshake per sample.
+
+        :param plug: SmartPlug with an energy meter
+        :param float rate: samples per second (default: 1.0)
+        :param int size: samples kept (default: 3600)
+        '''
+        self.plug = plug
+        self.period = 1.0 / rate
+        self.buffer = RingBuffer(size)
+        self.errors = 0
+        self.last_error = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    def sample(self):
+        '''
+        Take one sample into the buffer
+
+        :return: tuple of (timestamp, voltage, current, power)
+        '''
+        reading = self.plug.emeter_realtime()
+        sample = (time.time(),) + normalize_realtime(reading)
+        self.buffer.append(*sample)
+        return sample
+
+    def start(self):
+        '''
+        Start sampling in a daemon thread
+        '''
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name='emeter-sampler', daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout=None):
+        '''
+        Stop sampling and wait for the thread to finish
+        '''
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def _run(self):
+        next_time = time.monotonic()
+        while not self._stop.is_set():
+            try:
+                self.sample()
+            except Exception as e:
+                self.errors += 1
+                self.last_error = e
+
+            next_time += self.period
+            now = time.monotonic()
+            if next_time < now:
+                next_time = now + self.period - (now - next_time) % self.period
+            self._stop.wait(next_time - now)
@@ -0,0 +1,493 @@
+'''
+Emulate many TP-Link HS1xx plugs on one host, for load testing without hardware.
+
+Every virtual plug speaks the real port 9999 protocol over TCP, length
+prefix and XOR autokey included, from its own port or its own loopback
+address, and the emulator answers UDP discovery for all of them.  Replies
+can be delayed and dropped at random, to look like a busy wifi network.
+
+From the command line, e.g. 1000 plugs on ports 20000-20999:
+
+    $ python -m tplink_smartplug.emulator --count 1000 --port 20000 --latency 0.02 --loss 0.01
+
+or in process:
+
+    emulator = Emulator(make_plugs(100, port=20000), latency=0.01)
+    emulator.run_in_thread()
+    plug = SmartPlug(emulator.plugs[0].host, emulator.plugs[0].port)
+
+Thousands of plugs need as many file descriptors: raise the limit first
+with `ulimit -n`.
+'''
+import argparse
+import asyncio
+import ipaddress
+import json
+import random
+import socket
+import threading
+import time
+
+from .protocol import HEADER, MAX_FRAME, xor_decrypt, xor_encrypt
+
+
+class VirtualPlug(object):
+
+    def __init__(self, host='127.0.0.1', port=9999, alias=None, mac=None, model='HS110(UK)', load=1000.0):
+        '''
+        Create the state of one emulated plug
+
+        :param str host: address to serve on (default: 127.0.0.1)
+        :param int port: port to serve on (default: 9999)
+        :param str alias: device name (default: derived from host and port)
+        :param str mac: mac address (default: derived from host and port)
+        :param str model: model reported in sysinfo; models starting HS110 have an emeter (default: HS110(UK))
+        :param float load: watts drawn while on, reported by the emeter (default: 1000)
+        '''
+        self.host = host
+        self.port = port
+        self.load = load
+        self.has_emeter = model.startswith('HS110')
+        self.relay_since = None
+        self.requests = 0
+        self.rule_ids = 0
+        # the countdown rule and the monotonic time it runs out, if enabled
+        self.countdown = None
+        self.countdown_at = None
+        # schedule rules are stored and reported, not run
+        self.schedules = {}
+        self.schedule_enable = 0
+
+        # unique across a /24 of aliases and across ports
+        ident = (int(ipaddress.IPv4Address(host)) & 0xff) << 16 | port
+        mac = mac or '50:C7:BF:%02X:%02X:%02X' % (ident >> 16, (ident >> 8) & 0xff, ident & 0xff)
+        self.sysinfo = {
+            'sw_ver': '1.5.4 Build 180815 Rel.121440', 'hw_ver': '2.0',
+            'type': 'IOT.SMARTPLUGSWITCH', 'model': model,
+            'mac': mac, 'dev_name': 'Smart Wi-Fi Plug',
+            'alias': alias or 'emulated %s:%d' % (host, port),
+            'relay_state': 0, 'on_time': 0, 'active_mode': 'none',
+            'feature': 'TIM:ENE' if self.has_emeter else 'TIM',
+            'updating': 0, 'icon_hash': '', 'rssi': -55, 'led_off': 0,
+            'latitude': 51.5, 'longitude': -0.1,
+            'hwId': '%032X' % ident, 'fwId': '0' * 32, 'oemId': '0' * 32,
+            'deviceId': '8006%036X' % ident,
+            'next_action': {'type': -1},
+        }
+
+    def handle(self, request):
+        '''
+        Answer a request document as the plug would
+
+        :param dict request: decoded request, e.g. {"system": {"get_sysinfo": {}}}
+        :return: response document
+        '''
+        self.requests += 1
+        self._run_countdown()
+        response = {}
+        for target, commands in request.items():
+            handler = getattr(self, '_' + target, None)
+            if handler is None or not isinstance(commands, dict):
+                response[target] = {'err_code': -1, 'err_msg': 'module not support'}
+                continue
+            response[target] = {}
+            for cmd, args in commands.items():
+                reply = handler(cmd, args or {})
+                if reply is None:
+                    reply = {'err_code': -2, 'err_msg': 'member not support'}
+                else:
+                    reply.setdefault('err_code', 0)
+                response[target][cmd] = reply
+        return response
+
+    def _system(self, cmd, args):
+        info = self.sysinfo
+        if cmd == 'get_sysinfo':
+            if self.relay_since is not None:
+                info['on_time'] = int(time.monotonic() - self.relay_since)
+            return dict(info)
+        if cmd == 'set_relay_state':
+            self._set_relay(args.get('state'))
+            return {}
+        setters = {'set_led_off': ('off', 'led_off'),
+                   'set_dev_alias': ('alias', 'alias'),
+                   'set_mac_addr': ('mac', 'mac'),
+                   'set_device_id': ('deviceId', 'deviceId'),
+                   'set_hw_id': ('hwId', 'hwId')}
+        if cmd in setters:
+            arg, field = setters[cmd]
+            info[field] = args.get(arg)
+            return {}
+        if cmd == 'set_dev_location':
+            info.update(latitude=args.get('latitude'), longitude=args.get('longitude'))
+            return {}
+        if cmd in ('reboot', 'reset'):
+            return {}
+        return None
+
+    def _set_relay(self, state):
+        info = self.sysinfo
+        state = int(bool(state))
+        if state and not info['relay_state']:
+            self.relay_since = time.monotonic()
+        elif not state:
+            self.relay_since = None
+            info['on_time'] = 0
+        info['relay_state'] = state
+
+    def _run_countdown(self):
+        # the countdown only has to have run by the next time anyone looks
+        if self.countdown_at is not None and time.monotonic() >= self.countdown_at:
+            self._set_relay(self.countdown['act'])
+            self.countdown['enable'] = 0
+            self.countdown_at = None
+
+    def _new_rule_id(self):
+        self.rule_ids += 1
+        return '%032X' % self.rule_ids
+
+    def _count_down(self, cmd, args):
+        if cmd == 'get_rules':
+            rules = []
+            if self.countdown is not None:
+                remain = 0
+                if self.countdown_at is not None:
+                    remain = max(0, int(self.countdown_at - time.monotonic()))
+                rules.append(dict(self.countdown, remain=remain))
+            return {'rule_list': rules}
+        if cmd == 'add_rule':
+            if self.countdown is not None:
+                return {'err_code': -10, 'err_msg': 'table is full'}
+            self.countdown = {'id': self._new_rule_id()}
+            cmd = 'edit_rule'
+            args = dict(args, id=self.countdown['id'])
+        if cmd == 'edit_rule':
+            if self.countdown is None or args.get('id') != self.countdown['id']:
+                return {'err_code': -14, 'err_msg': 'entry not exist'}
+            self.countdown.update(enable=int(args.get('enable', 0)), delay=int(args.get('delay', 0)),
+                                  act=int(args.get('act', 0)), name=args.get('name', ''))
+            self.countdown_at = time.monotonic() + self.countdown['delay'] if self.countdown['enable'] else None
+            return {'id': self.countdown['id']}
+        if cmd in ('delete_rule', 'delete_all_rules'):
+            if cmd == 'delete_rule' and (self.countdown is None or args.get('id') != self.countdown['id']):
+                return {'err_code': -14, 'err_msg': 'entry not exist'}
+            self.countdown = self.countdown_at = None
+            return {}
+        return None
+
+    def _schedule(self, cmd, args):
+        if cmd == 'get_rules':
+            return {'rule_list': list(self.schedules.values()), 'enable': self.schedule_enable}
+        if cmd == 'add_rule':
+            rule_id = self._new_rule_id()
+            self.schedules[rule_id] = dict(args, id=rule_id)
+            return {'id': rule_id}
+        if cmd in ('edit_rule', 'delete_rule'):
+            if args.get('id') not in self.schedules:
+                return {'err_code': -14, 'err_msg': 'entry not exist'}
+            if cmd == 'edit_rule':
+                self.schedules[args['id']] = dict(args)
+            else:
+                del self.schedules[args['id']]
+            return {}
+        if cmd == 'delete_all_rules':
+            self.schedules.clear()
+            return {}
+        if cmd == 'set_overall_enable':
+            self.schedule_enable = int(args.get('enable', 0))
+            return {}
+        if cmd == 'get_next_action':
+            return {'type': -1}
+        return None
+
+    def _time(self, cmd, args):
+        if cmd == 'get_time':
+            now = time.localtime()
+            return {'year': now.tm_year, 'month': now.tm_mon, 'mday': now.tm_mday,
+                    'hour': now.tm_hour, 'min': now.tm_min, 'sec': now.tm_sec}
+        if cmd == 'get_timezone':
+            return {'index': 39}
+        return None
+
+    def _emeter(self, cmd, args):
+        if not self.has_emeter:
+            return None
+        if cmd == 'get_realtime':
+            power = self.load if self.sysinfo['relay_state'] else 0.0
+            return {'voltage_mv': 240000, 'current_ma': int(power / 240 * 1000),
+                    'power_mw': int(power * 1000), 'total_wh': 0}
+        if cmd in ('get_daystat', 'get_monthstat'):
+            return {'day_list' if cmd == 'get_daystat' else 'month_list': []}
+        if cmd == 'erase_emeter_stat':
+            return {}
+        return None
+
+
+def make_plugs(count, host='127.0.0.1', port=9999, aliases=False, **kwargs):
+    '''
+    Lay out count virtual plugs, on consecutive ports or consecutive loopback addresses
+
+    :param int count: number of plugs
+    :param str host: address of the first plug (default: 127.0.0.1)
+    :param int port: port of the first plug, or of every plug with aliases (default: 9999)
+    :param bool aliases: give each plug its own address from host upwards, all on port (default: False)
+    :param kwargs: passed to VirtualPlug
+    :return: list of VirtualPlug
+    '''
+    first = ipaddress.IPv4Address(host)
+    if aliases:
+        return [VirtualPlug(str(first + i), port, **kwargs) for i in range(count)]
+    return [VirtualPlug(host, port + i, **kwargs) for i in range(count)]
+
+
+class _DiscoveryProtocol(asyncio.DatagramProtocol):
+
+    def __init__(self, emulator):
+        self.emulator = emulator
+        self.transport = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        try:
+            request = json.loads(xor_decrypt(data).decode())
+        except (ValueError, UnicodeDecodeError):
+            return
+        self.emulator.discover_reply(request, addr, self.transport)
+
+
+class Emulator(object):
+
+    def __init__(self, plugs, latency=0.0, jitter=0.0, loss=0.0, discovery_host='0.0.0.0', discovery_port=None, seed=None):
+        '''
+        Serve a list of VirtualPlug
+
+        :param list plugs: plugs to serve, e.g. from make_plugs
+        :param float latency: seconds before each reply (default: 0)
+        :param float jitter: up to this many more seconds at random (default: 0)
+        :param float loss: chance (0-1) a request gets no reply, so the client times out (default: 0)
+        :param str discovery_host: address to answer discovery on (default: 0.0.0.0)
+        :param int discovery_port: UDP port to answer discovery on (default: none)
+        :param int seed: seed for latency and loss, for repeatable runs (default: random)
+        '''
+        self.plugs = list(plugs)
+        self.latency = latency
+        self.jitter = jitter
+        self.loss = loss
+        self.discovery_host = discovery_host
+        self.discovery_port = discovery_port
+        self.random = random.Random(seed)
+        self.stats = {'connections': 0, 'requests': 0, 'dropped': 0, 'errors': 0, 'discovery': 0}
+        self._servers = []
+        self._transports = []
+        self._reply_socks = {}
+        self._connections = {}      # serving task: its writer
+        self._hosts = set()
+        self._loop = None
+        self._thread = None
+
+    def _delay(self):
+        return self.latency + self.jitter * self.random.random()
+
+    def _lost(self):
+        return self.loss and self.random.random() < self.loss
+
+    async def _serve_plug(self, plug, reader, writer):
+        self.stats['connections'] += 1
+        task = asyncio.current_task()
+        self._connections[task] = writer
+        try:
+            while True:
+                header = await reader.readexactly(HEADER.size)
+                length, = HEADER.unpack(header)
+                if length > MAX_FRAME:
+                    break
+                data = await reader.readexactly(length)
+                self.stats['requests'] += 1
+                if self._lost():
+                    # no reply: hold the connection until the client gives up
+                    self.stats['dropped'] += 1
+                    await reader.read()
+                    break
+                try:
+                    response = plug.handle(json.loads(xor_decrypt(data).decode()))
+                except (ValueError, AttributeError):
+                    # real plugs close the connection on garbage
+                    self.stats['errors'] += 1
+                    break
+                delay = self._delay()
+                if delay:
+                    await asyncio.sleep(delay)
+                payload = json.dumps(response).encode()
+                writer.write(HEADER.pack(len(payload)) + xor_encrypt(payload))
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        except asyncio.CancelledError:
+            # stop() ends open connections: finish quietly, as asyncio's
+            # streams report a handler task that ends cancelled as an error
+            pass
+        finally:
+            self._connections.pop(task, None)
+            writer.close()
+
+    def discover_reply(self, request, addr, transport):
+        '''
+        Answer a discovery request from every plug, each from its own address where it has one
+
+        :param dict request: decoded request
+        :param tuple addr: address the request came from
+        :param transport: datagram transport the request arrived on
+        '''
+        if 'get_sysinfo' not in request.get('system', {}):
+            return
+        self.stats['discovery'] += 1
+        for plug in self.plugs:
+            if self._lost():
+                continue
+            reply = xor_encrypt(json.dumps(plug.handle(request)).encode())
+            self._loop.call_later(self._delay(), self._send_reply, plug.host, reply, addr, transport)
+
+    def _send_reply(self, host, reply, addr, transport):
+        if len(self._hosts) == 1:
+            transport.sendto(reply, addr)
+            return
+        # plugs on loopback aliases each reply from their own address, as
+        # discover() reports the address a reply came from
+        sock = self._reply_socks.get(host)
+        if sock is None:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            sock.bind((host, 0))
+            sock.setblocking(False)
+            self._reply_socks[host] = sock
+        try:
+            sock.sendto(reply, addr)
+        except OSError:
+            self.stats['errors'] += 1
+
+    async def start(self):
+        '''
+        Start serving every plug, and discovery if a discovery port was given
+        '''
+        self._loop = asyncio.get_running_loop()
+        self._hosts = {plug.host for plug in self.plugs}
+        for plug in self.plugs:
+            server = await asyncio.start_server(
+                lambda reader, writer, plug=plug: self._serve_plug(plug, reader, writer),
+                plug.host, plug.port, reuse_address=True, backlog=512)
+            if plug.port == 0:
+                plug.port = server.sockets[0].getsockname()[1]
+            self._servers.append(server)
+        if self.discovery_port is not None:
+            transport, protocol = await self._loop.create_datagram_endpoint(
+                lambda: _DiscoveryProtocol(self), local_addr=(self.discovery_host, self.discovery_port),
+                allow_broadcast=True)
+            if self.discovery_port == 0:
+                self.discovery_port = transport.get_extra_info('sockname')[1]
+            self._transports.append(transport)
+
+    async def stop(self):
+        '''
+        Stop serving and close every socket, clients' connections included
+        '''
+        for server in self._servers:
+            server.close()
+        # let connections just accepted start, so they are ended too
+        await asyncio.sleep(0)
+        while self._connections:
+            connections = dict(self._connections)
+            for task, writer in connections.items():
+                writer.close()
+                task.cancel()
+            await asyncio.gather(*connections, return_exceptions=True)
+        for server in self._servers:
+            await server.wait_closed()
+        for transport in self._transports:
+            transport.close()
+        for sock in self._reply_socks.values():
+            sock.close()
+        self._servers, self._transports, self._reply_socks = [], [], {}
+
+    async def serve_forever(self):
+        '''
+        Start, then serve until cancelled
+        '''
+        await self.start()
+        try:
+            await asyncio.Event().wait()
+        finally:
+            await self.stop()
+
+    def run_in_thread(self):
+        '''
+        Serve from an event loop on a daemon thread, for use from synchronous code
+
+        :return: self, once every plug is listening
+        '''
+        started = threading.Event()
+        failed = []
+
+        def run():
+            loop = asyncio.new_event_loop()
+            try:
+                loop.run_until_complete(self.start())
+            except Exception as e:
+                failed.append(e)
+                started.set()
+                return
+            started.set()
+            loop.run_forever()
+            loop.run_until_complete(self.stop())
+            loop.close()
+
+        self._thread = threading.Thread(target=run, name='plug-emulator', daemon=True)
+        self._thread.start()
+        started.wait()
+        if failed:
+            raise failed[0]
+        return self
+
+    def shutdown(self):
+        '''
+        Stop an emulator started with run_in_thread
+        '''
+        if self._thread is not None:
+            self._loop.call_soon_threadsafe(self._loop.stop)
+            self._thread.join()
+            self._thread = None
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Emulate many TP-Link smart plugs on this host.')
+    parser.add_argument('--count', type=int, default=1, help='number of plugs (default: 1)')
+    parser.add_argument('--host', default='127.0.0.1', help='address of the first plug (default: 127.0.0.1)')
+    parser.add_argument('--port', type=int, default=9999, help='port of the first plug (default: 9999)')
+    parser.add_argument('--aliases', action='store_true',
+                        help='one loopback address per plug, all on --port, instead of one port per plug')
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds before each reply')
+    parser.add_argument('--jitter', type=float, default=0.0, help='up to this many more seconds at random')
+    parser.add_argument('--loss', type=float, default=0.0, help='chance a request gets no reply')
+    parser.add_argument('--discovery-port', type=int, help='UDP port to answer discovery on, e.g. 9999')
+    parser.add_argument('--seed', type=int, help='seed for latency and loss')
+    parser.add_argument('--list', help='write the plugs as json [{host, port, mac}] to this file')
+    args = parser.parse_args(argv)
+
+    plugs = make_plugs(args.count, args.host, args.port, args.aliases)
+    emulator = Emulator(plugs, args.latency, args.jitter, args.loss,
+                        discovery_port=args.discovery_port, seed=args.seed)
+    if args.list:
+        with open(args.list, 'w') as f:
+            json.dump([{'host': p.host, 'port': p.port, 'mac': p.sysinfo['mac']} for p in plugs], f, indent=1)
+
+    print('emulating %d plugs from %s:%d%s' % (len(plugs), plugs[0].host, plugs[0].port,
+          ', discovery on udp %d' % args.discovery_port if args.discovery_port else ''))
+    try:
+        asyncio.run(emulator.serve_forever())
+    except KeyboardInterrupt:
+        pass
+    print(emulator.stats)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,134 @@
+'''
+Framing and the XOR autokey cipher of the HS1xx port 9999 protocol
+
+With numpy installed, payloads of NUMPY_MIN_SIZE bytes or more are coded
+with bitwise_xor and bitwise_xor.accumulate.  Anything smaller, and
+everything without numpy, goes through a pure-Python path that treats the
+message as one big integer: decrypting is one XOR against the message
+shifted by a byte, and encrypting a log2(n)-pass prefix-XOR scan.
+
+That path stands in for a table-driven fallback (a 256x256 XOR table
+indexed per byte).  benchmarks/bench_codec.py times both: from 100 B to
+64 KiB the table runs at 0.4-0.7x the original byte loop, since the
+indexing costs more than the XOR it saves, while the big integer runs at
+3-6x for encrypting and 3-11x for decrypting.
+'''
+import struct
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+HEADER = struct.Struct('>I')
+
+# initial key of the XOR autokey cipher
+KEY = 171
+
+# below this size the big-integer path beats the numpy call overhead
+NUMPY_MIN_SIZE = 512
+
+# largest response we are prepared to buffer, well above any real sysinfo or emeter reply
+MAX_FRAME = 16 * 1024 * 1024
+
+
+class ProtocolError(ValueError):
+    '''
+    Raised when a device sends something that is not a valid response frame
+    '''
+
+
+def recv_into_exactly(sock, view):
+    '''
+    Fill a writable buffer from a socket, however many segments it arrives in
+
+    :param sock: connected socket
+    :param memoryview view: buffer to fill completely
+    '''
+    pos = 0
+    size = len(view)
+    while pos < size:
+        received = sock.recv_into(view[pos:])
+        if not received:
+            if pos == 0 and size == HEADER.size:
+                raise ConnectionResetError('connection closed before a response was received')
+            raise ProtocolError('connection closed after %d of %d bytes' % (pos, size))
+        pos += received
+
+
+def recv_frame(sock, max_size=MAX_FRAME):
+    '''
+    Read one length-prefixed response frame from a socket
+
+    :param sock: connected socket
+    :param int max_size: largest frame to accept (default: 16 MiB)
+    :return: bytearray with the encrypted payload, without the length prefix
+    '''
+    header = bytearray(HEADER.size)
+    recv_into_exactly(sock, memoryview(header))
+    length, = HEADER.unpack(header)
+    if length > max_size:
+        raise ProtocolError('response frame of %d bytes exceeds limit of %d' % (length, max_size))
+
+    payload = bytearray(length)
+    recv_into_exactly(sock, memoryview(payload))
+    return payload
+
+
+def xor_encrypt(plainbytes, use_numpy=None):
+    '''
+    Apply the XOR autokey cipher, where each cipher byte is the XOR of the
+    key and every plain byte up to and including this one
+
+    :param bytes plainbytes: plaintext
+    :param bool use_numpy: force (True) or avoid (False) the numpy path (default: by size)
+    :return: bytes ciphertext, without length prefix
+    '''
+    if not plainbytes:
+        return b''
+    if use_numpy is None:
+        use_numpy = numpy is not None and len(plainbytes) >= NUMPY_MIN_SIZE
+
+    if use_numpy:
+        buffer = numpy.frombuffer(plainbytes, dtype=numpy.uint8).copy()
+        buffer[0] ^= KEY
+        return numpy.bitwise_xor.accumulate(buffer).tobytes()
+
+    # prefix-XOR scan over the whole message as one big integer: after the
+    # pass shifting by k bytes, every byte holds the XOR of the 2k bytes
+    # ending at it, so log2(n) passes cover the key and all earlier bytes
+    data = bytes((KEY,)) + bytes(plainbytes)
+    size = len(data)
+    scan = int.from_bytes(data, 'big')
+    shift = 8
+    while shift < 8 * size:
+        scan ^= scan >> shift
+        shift <<= 1
+    return scan.to_bytes(size, 'big')[1:]
+
+
+def xor_decrypt(cipherbytes, use_numpy=None):
+    '''
+    Invert the XOR autokey cipher, where each plain byte is the XOR of a
+    cipher byte and the cipher byte before it
+
+    :param bytes cipherbytes: ciphertext, without length prefix
+    :param bool use_numpy: force (True) or avoid (False) the numpy path (default: by size)
+    :return: bytes plaintext
+    '''
+    if not cipherbytes:
+        return b''
+    if use_numpy is None:
+        use_numpy = numpy is not None and len(cipherbytes) >= NUMPY_MIN_SIZE
+
+    if use_numpy:
+        cipher = numpy.frombuffer(cipherbytes, dtype=numpy.uint8)
+        plain = numpy.empty_like(cipher)
+        plain[0] = cipher[0] ^ KEY
+        numpy.bitwise_xor(cipher[1:], cipher[:-1], out=plain[1:])
+        return plain.tobytes()
+
+    size = len(cipherbytes)
+    cipher = int.from_bytes(cipherbytes, 'big')
+    previous = int.from_bytes(bytes((KEY,)) + bytes(cipherbytes[:-1]), 'big')
+    return (cipher ^ previous).to_bytes(size, 'big')
@@ -0,0 +1,129 @@
+'''
+Typed views of the plug's on-device rules
+
+HS1xx plugs keep two kinds of rule that run on the plug itself, so they
+still happen if whatever set them goes away:
+
+- count_down: switch the relay on or off once, delay seconds after the rule
+  is set.  Plugs hold a single countdown rule.
+- schedule: switch at a minute of the day on chosen weekdays, and
+  optionally switch back at a later minute.
+'''
+from collections import namedtuple
+
+# a countdown rule.  on is the state it switches the relay to; remaining is
+# the seconds left, as reported by the plug (None for a rule not yet sent)
+CountdownRule = namedtuple('CountdownRule', ['id', 'delay', 'on', 'enable', 'name', 'remaining'],
+                           defaults=[None, 0, False, True, 'countdown', None])
+
+# a schedule rule.  minute and end_minute count from midnight; days are
+# seven flags, Sunday first; end_on is None for no end action
+ScheduleRule = namedtuple('ScheduleRule', ['id', 'name', 'on', 'minute', 'days', 'enable',
+                                           'repeat', 'end_on', 'end_minute'],
+                          defaults=[None, 'schedule', True, 0, (1,) * 7, True, True, None, 0])
+
+
+class CommandError(ValueError):
+    '''
+    The plug answered a command with a non-zero err_code
+    '''
+
+    def __init__(self, cmd, response):
+        super(CommandError, self).__init__('%s failed: %s' % (cmd, response.get('err_msg', response)))
+        self.err_code = response.get('err_code')
+        self.response = response
+
+
+def check(cmd, response):
+    '''
+    Raise CommandError unless the plug accepted the command
+
+    :param str cmd: command name, for the message
+    :param dict response: the command's response
+    :return: response
+    '''
+    if response.get('err_code') != 0:
+        raise CommandError(cmd, response)
+    return response
+
+
+def parse_time(text):
+    '''
+    Convert a time of day to minutes from midnight
+
+    :param text: 'HH:MM', or minutes as an int
+    :return: int minutes from midnight
+    '''
+    if isinstance(text, int):
+        return text
+    hours, minutes = text.split(':')
+    minute = int(hours) * 60 + int(minutes)
+    if not 0 <= minute < 24 * 60:
+        raise ValueError('time of day out of range: %r' % text)
+    return minute
+
+
+def countdown_args(rule):
+    '''
+    :param CountdownRule rule: rule to send
+    :return: dict of add_rule/edit_rule arguments
+    '''
+    args = {'enable': int(rule.enable), 'delay': int(rule.delay), 'act': int(rule.on), 'name': rule.name}
+    if rule.id is not None:
+        args['id'] = rule.id
+    return args
+
+
+def parse_countdown(rule):
+    '''
+    :param dict rule: an entry of count_down get_rules' rule_list
+    :return: CountdownRule
+    '''
+    return CountdownRule(rule.get('id'), rule.get('delay', 0), bool(rule.get('act')),
+                         bool(rule.get('enable')), rule.get('name', ''), rule.get('remain'))
+
+
+def schedule_args(rule):
+    '''
+    :param ScheduleRule rule: rule to send
+    :return: dict of add_rule/edit_rule arguments
+    '''
+    if len(rule.days) != 7:
+        raise ValueError('days needs 7 flags, Sunday first')
+    args = {'name': rule.name, 'enable': int(rule.enable), 'wday': [int(bool(day)) for day in rule.days],
+            'repeat': int(rule.repeat), 'stime_opt': 0, 'smin': parse_time(rule.minute), 'sact': int(rule.on),
+            'etime_opt': -1, 'emin': 0, 'eact': -1,
+            'year': 0, 'month': 0, 'day': 0, 'force': 0, 'latitude': 0, 'longitude': 0}
+    if rule.end_on is not None:
+        args.update(etime_opt=0, emin=parse_time(rule.end_minute), eact=int(rule.end_on))
+    if rule.id is not None:
+        args['id'] = rule.id
+    return args
+
+
+def parse_schedule(rule):
+    '''
+    :param dict rule: an entry of schedule get_rules' rule_list
+    :return: ScheduleRule
+    '''
+    has_end = rule.get('etime_opt', -1) != -1 and rule.get('eact', -1) != -1
+    return ScheduleRule(rule.get('id'), rule.get('name', ''), bool(rule.get('sact')), rule.get('smin', 0),
+                        tuple(rule.get('wday', (0,) * 7)), bool(rule.get('enable')), bool(rule.get('repeat')),
+                        bool(rule.get('eact')) if has_end else None, rule.get('emin', 0) if has_end else 0)
+
+
+def window_rules(windows, name='plugger window'):
+    '''
+    Schedule rules switching on at the start and off at the end of each time window, every day
+
+    :param windows: iterable of (start, end) times, as 'HH:MM' or minutes from midnight
+    :param str name: name of the rules, to find them again (default: 'plugger window')
+    :return: list of ScheduleRule
+    '''
+    rules = []
+    for start, end in windows:
+        start, end = parse_time(start), parse_time(end)
+        if end <= start:
+            raise ValueError('window ends before it starts: %s-%s' % (start, end))
+        rules.append(ScheduleRule(name=name, on=True, minute=start, end_on=False, end_minute=end))
+    return rules